@@ -0,0 +1,48 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""
+Times Semantic-SAM automatic mark generation on CPU for several thread counts.
+
+Usage:
+    python benchmark_cpu.py --image examples/ironing_man.jpg --threads 1 2 4 8
+"""
+
+import argparse
+import time
+
+import torch
+
+from semantic_sam.BaseModel import BaseModel
+from semantic_sam import build_model
+from semantic_sam.utils.arguments import load_opt_from_config_file
+from task_adapter.semantic_sam.tasks import inference_semsam_m2m_auto
+from task_adapter.utils.device import set_cpu_threads
+from task_adapter.utils.image_io import load_image
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--image", default="examples/ironing_man.jpg")
+parser.add_argument("--cfg", default="configs/semantic_sam_only_sa-1b_swinL.yaml")
+parser.add_argument("--ckpt", default="./swinl_only_sam_many2many.pth")
+parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+parser.add_argument("--level", type=int, nargs="+", default=[3])
+parser.add_argument("--text_size", type=int, default=640)
+parser.add_argument("--runs", type=int, default=3)
+args = parser.parse_args()
+
+opt = load_opt_from_config_file(args.cfg)
+model = BaseModel(opt, build_model(opt)).from_pretrained(args.ckpt).eval()
+image = load_image(args.image, args.text_size)
+
+with torch.no_grad():
+    for num_threads in args.threads:
+        set_cpu_threads(num_threads)
+        # warm up allocator and kernels for this thread count
+        inference_semsam_m2m_auto(model, image, args.level, '', '', '0.0', args.text_size, 100, 100, False, device="cpu")
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            _, anns, _ = inference_semsam_m2m_auto(model, image, args.level, '', '', '0.0', args.text_size, 100, 100, False, device="cpu")
+        elapsed = (time.perf_counter() - start) / args.runs
+        print(f"threads={num_threads:3d}  {elapsed:7.2f} s/image  marks={len(anns)}")
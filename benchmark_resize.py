@@ -0,0 +1,45 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""
+Compares the resize backends of the preprocessing stage: time per image,
+and the difference of their output to the 'pil' backend the task adapters
+use by default.
+
+Usage:
+    python benchmark_resize.py --image examples/ironing_man.jpg --text_size 640
+"""
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from task_adapter.utils.image_buffers import resized_size
+from task_adapter.utils.resize import RESIZE_BACKENDS, resize_into
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--image", default="examples/ironing_man.jpg")
+parser.add_argument("--text_size", type=int, default=640)
+parser.add_argument("--backends", nargs="+", default=list(RESIZE_BACKENDS), choices=RESIZE_BACKENDS)
+parser.add_argument("--runs", type=int, default=10)
+args = parser.parse_args()
+
+image = Image.open(args.image).convert("RGB")
+height, width = resized_size(image.size, args.text_size)
+print(f"{image.size[0]}x{image.size[1]} -> {width}x{height}")
+
+reference = resize_into(image, np.empty((height, width, 3), dtype=np.uint8), "pil")
+out = np.empty_like(reference)
+for backend in args.backends:
+    # warm up
+    resize_into(image, out, backend)
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        resize_into(image, out, backend)
+    elapsed = (time.perf_counter() - start) / args.runs
+    diff = np.abs(out.astype(np.int16) - reference)
+    print(f"{backend:>10s}  {elapsed * 1000:8.2f} ms/image  mean |diff|={diff.mean():6.3f}  max |diff|={diff.max():3d}")
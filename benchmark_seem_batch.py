@@ -0,0 +1,64 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""
+Measures the throughput of batched SEEM panoptic mark generation for
+several batch sizes, and checks the marks against per-image calls.
+
+Usage:
+    python benchmark_seem_batch.py --images examples/*.jpg --batch_sizes 1 2 4 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from seem.modeling.BaseModel import BaseModel as BaseModel_Seem
+from seem.utils.distributed import init_distributed as init_distributed_seem
+from seem.modeling import build_model as build_model_seem
+from semantic_sam.utils.arguments import load_opt_from_config_file
+from semantic_sam.utils.constants import COCO_PANOPTIC_CLASSES
+from task_adapter.seem.tasks import inference_seem_pano, inference_seem_pano_batch
+from task_adapter.utils.device import get_device
+from task_adapter.utils.image_io import load_image
+from task_adapter.utils.text_embeddings import text_embeddings
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", nargs="+", default=["examples/ironing_man.jpg"])
+parser.add_argument("--cfg", default="configs/seem_focall_unicl_lang_v1.yaml")
+parser.add_argument("--ckpt", default="./seem_focall_v1.pt")
+parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+parser.add_argument("--text_size", type=int, default=640)
+parser.add_argument("--device", default=None)
+args = parser.parse_args()
+
+opt = init_distributed_seem(load_opt_from_config_file(args.cfg))
+model = BaseModel_Seem(opt, build_model_seem(opt)).from_pretrained(args.ckpt).eval()
+# the model loads on the CPU: --device, else SOM_DEVICE, else CUDA if available
+device = get_device(device=args.device)
+model = model.to(device)
+images = [load_image(path, args.text_size) for path in args.images]
+
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+with torch.no_grad():
+    text_embeddings.activate(model, COCO_PANOPTIC_CLASSES + ["background"])
+    reference = [inference_seem_pano(model, image, args.text_size, device=device)[2] for image in images]
+    for batch_size in args.batch_sizes:
+        # warm up
+        inference_seem_pano_batch(model, images[:batch_size], args.text_size, batch_size=batch_size, device=device)
+        synchronize()
+        start = time.perf_counter()
+        results = inference_seem_pano_batch(model, images, args.text_size, batch_size=batch_size, device=device)
+        synchronize()
+        elapsed = time.perf_counter() - start
+        mismatches = sum(not np.array_equal(label_map, ref) for (_, _, label_map), ref in zip(results, reference))
+        print(f"batch_size={batch_size:3d}  {len(images) / elapsed:7.2f} images/s  mismatches={mismatches}")
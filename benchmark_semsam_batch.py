@@ -0,0 +1,90 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""
+Checks SemanticSamAutomaticMaskGenerator.generate_batch against per-image
+generate calls, and measures its throughput for several batch sizes.
+
+generate_batch encodes groups of images itself instead of through
+evaluate_demo, so this first compares its features for every image with the
+ones evaluate_demo returns, then the marks of both paths.
+
+Usage:
+    python benchmark_semsam_batch.py --images examples/*.jpg --batch_sizes 1 2 4
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from semantic_sam.BaseModel import BaseModel
+from semantic_sam import build_model
+from semantic_sam.utils.arguments import load_opt_from_config_file
+from task_adapter.semantic_sam.tasks.automatic_mask_generator import SemanticSamAutomaticMaskGenerator
+from task_adapter.utils.device import get_device
+from task_adapter.utils.image_io import load_image
+from task_adapter.utils.resize import resize_image
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", nargs="+", default=["examples/ironing_man.jpg"])
+parser.add_argument("--cfg", default="configs/semantic_sam_only_sa-1b_swinL.yaml")
+parser.add_argument("--ckpt", default="./swinl_only_sam_many2many.pth")
+parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4])
+parser.add_argument("--level", type=int, nargs="+", default=[3])
+parser.add_argument("--text_size", type=int, default=640)
+parser.add_argument("--device", default=None)
+args = parser.parse_args()
+
+opt = load_opt_from_config_file(args.cfg)
+model = BaseModel(opt, build_model(opt)).from_pretrained(args.ckpt).eval()
+# the model loads on the CPU: --device, else SOM_DEVICE, else CUDA if available
+device = get_device(device=args.device)
+model = model.to(device)
+images = [
+    torch.from_numpy(resize_image(load_image(path, args.text_size), args.text_size)).permute(2, 0, 1).to(device)
+    for path in args.images
+]
+generator = SemanticSamAutomaticMaskGenerator(model, level=args.level)
+
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def same_marks(a, b):
+    return len(a) == len(b) and all(np.array_equal(x, y) for x, y in zip(a.segmentations, b.segmentations))
+
+
+with torch.no_grad():
+    # features of the batched encoder against evaluate_demo's own
+    for group in generator._group_images(images, max(args.batch_sizes)):
+        features = generator._encode_images([images[i] for i in group])
+        if features is None:
+            continue
+        for j, i in enumerate(group):
+            image = images[i]
+            h, w = image.shape[-2:]
+            generator.enc_features = None
+            generator._process_batch(image, generator.point_grids[0][:1], (h, w), [0, 0, w, h], (h, w))
+            own_mask_features, own_multi_scale = generator.enc_features
+            diff = (features[0][j:j + 1] - own_mask_features).abs().max().item()
+            for f, own in zip(features[1], own_multi_scale):
+                diff = max(diff, (f[j:j + 1] - own).abs().max().item())
+            print(f"image {i}: max feature difference {diff:.3g}")
+
+    reference = [generator.generate(image) for image in images]
+    for batch_size in args.batch_sizes:
+        # warm up
+        generator.generate_batch(images[:batch_size], batch_size=batch_size)
+        synchronize()
+        start = time.perf_counter()
+        results = generator.generate_batch(images, batch_size=batch_size)
+        synchronize()
+        elapsed = time.perf_counter() - start
+        mismatches = sum(not same_marks(anns, ref) for anns, ref in zip(results, reference))
+        print(f"batch_size={batch_size:3d}  {len(images) / elapsed:7.2f} images/s  mismatches={mismatches}")
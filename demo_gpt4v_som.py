@@ -8,6 +8,7 @@
 #   Hao Zhang (hzhangcx@connect.ust.hk)
 # --------------------------------------------------------
 import io
+import re
 import gradio as gr
 import torch
 import argparse
@@ -16,6 +17,8 @@ from PIL import Image
 from seem.modeling.BaseModel import BaseModel as BaseModel_Seem
 from seem.utils.distributed import init_distributed as init_distributed_seem
 from seem.modeling import build_model as build_model_seem
+from task_adapter.utils.device import get_device
+from task_adapter.utils.text_embeddings import text_embeddings
 from task_adapter.seem.tasks import interactive_seem_m2m_auto, inference_seem_pano, inference_seem_interactive
 
 # semantic sam
@@ -33,6 +36,9 @@ from task_adapter.sam.tasks.inference_sam_m2m_interactive import inference_sam_m
 
 
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.label_map import segmentation_mask
+from task_adapter.utils.mark_index import MarkIndex
+from task_adapter.utils.mark_labels import MarkLabeler
 from detectron2.data import MetadataCatalog
 metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
@@ -68,21 +74,30 @@ opt_seem = init_distributed_seem(opt_seem)
 '''
 build model
 '''
-model_semsam = BaseModel(opt_semsam, build_model(opt_semsam)).from_pretrained(semsam_ckpt).eval().cuda()
-model_sam = sam_model_registry["vit_h"](checkpoint=sam_ckpt).eval().cuda()
-model_seem = BaseModel_Seem(opt_seem, build_model_seem(opt_seem)).from_pretrained(seem_ckpt).eval().cuda()
+# SOM_DEVICE, else CUDA if available, else CPU; fp16 autocast only on CUDA
+device = get_device()
+model_semsam = BaseModel(opt_semsam, build_model(opt_semsam)).from_pretrained(semsam_ckpt).eval().to(device)
+model_sam = sam_model_registry["vit_h"](checkpoint=sam_ckpt).eval().to(device)
+model_seem = BaseModel_Seem(opt_seem, build_model_seem(opt_seem)).from_pretrained(seem_ckpt).eval().to(device)
 
 with torch.no_grad():
-    with torch.autocast(device_type='cuda', dtype=torch.float16):
-        model_seem.model.sem_seg_head.predictor.lang_encoder.get_text_embeddings(COCO_PANOPTIC_CLASSES + ["background"], is_eval=True)
+    with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+        text_embeddings.activate(model_seem, COCO_PANOPTIC_CLASSES + ["background"])
+
+# opt-in: candidate class names of the marks, sent to GPT-4V with the message
+mark_labeler = MarkLabeler(model_seem)
 
 history_images = []
 history_masks = []
+history_indexes = []
 history_texts = []
+history_label_mode = '1'
 @torch.no_grad()
-def inference(image, slider, mode, alpha, label_mode, anno_mode, *args, **kwargs):
+def inference(image, slider, mode, alpha, label_mode, anno_mode, class_names=False, *args, **kwargs):
     global history_images; history_images = []
     global history_masks; history_masks = []    
+    global history_indexes; history_indexes = []
+    global history_label_mode; history_label_mode = '1'
 
     _image = image['background'].convert('RGB')
     _mask = image['layers'][0].convert('L') if image['layers'] else None
@@ -116,44 +131,69 @@ def inference(image, slider, mode, alpha, label_mode, anno_mode, *args, **kwargs
         label_mode = 'a'
     else:
         label_mode = '1'
+    history_label_mode = label_mode
+    hooks = [mark_labeler] if class_names else []
 
     text_size, hole_scale, island_scale=640,100,100
     text, text_part, text_thresh = '','','0.0'
-    with torch.autocast(device_type='cuda', dtype=torch.float16):
+    with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
         semantic=False
 
         if mode == "Interactive":
-            labeled_array, num_features = label(np.asarray(_mask))
-            spatial_masks = torch.stack([torch.from_numpy(labeled_array == i+1) for i in range(num_features)])
+            # stroke labels, turned into prompts without a mask per stroke
+            spatial_masks, _ = label(np.asarray(_mask))
 
         if model_name == 'semantic-sam':
             model = model_semsam
-            output, mask = inference_semsam_m2m_auto(model, _image, level, text, text_part, text_thresh, text_size, hole_scale, island_scale, semantic, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, *args, **kwargs)
+            output, mask, label_map = inference_semsam_m2m_auto(model, _image, level, text, text_part, text_thresh, text_size, hole_scale, island_scale, semantic, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, hooks=hooks, *args, **kwargs)
 
         elif model_name == 'sam':
             model = model_sam
             if mode == "Automatic":
-                output, mask = inference_sam_m2m_auto(model, _image, text_size, label_mode, alpha, anno_mode)
+                output, mask, label_map = inference_sam_m2m_auto(model, _image, text_size, label_mode, alpha, anno_mode, hooks=hooks)
             elif mode == "Interactive":
-                output, mask = inference_sam_m2m_interactive(model, _image, spatial_masks, text_size, label_mode, alpha, anno_mode)
+                output, mask, label_map = inference_sam_m2m_interactive(model, _image, spatial_masks, text_size, label_mode, alpha, anno_mode, hooks=hooks)
 
         elif model_name == 'seem':
             model = model_seem
             if mode == "Automatic":
-                output, mask = inference_seem_pano(model, _image, text_size, label_mode, alpha, anno_mode)
+                output, mask, label_map = inference_seem_pano(model, _image, text_size, label_mode, alpha, anno_mode, hooks=hooks)
             elif mode == "Interactive":
-                output, mask = inference_seem_interactive(model, _image, spatial_masks, text_size, label_mode, alpha, anno_mode)
+                output, mask, label_map = inference_seem_interactive(model, _image, spatial_masks, text_size, label_mode, alpha, anno_mode, hooks=hooks)
 
         # convert output to PIL image
         history_masks.append(mask)
+        history_indexes.append(MarkIndex(mask, output.shape[:2], label_map=label_map))
         history_images.append(Image.fromarray(output))
         return (output, [])
 
 
+def mark_text(n, label_mode):
+    if label_mode != 'a':
+        return str(n)
+    chars = []
+    while n:
+        n, remainder = divmod(n - 1, 26)
+        chars.append(chr(97 + remainder))
+    return ''.join(reversed(chars))
+
+def class_names_prompt(annotations, label_mode):
+    # the candidate class names MarkLabeler attached, keyed by the drawn mark
+    marks = []
+    for i, ann in enumerate(annotations):
+        if ann.get('class_names'):
+            mark = ann.get('hierarchical_label') or mark_text(int(ann.get('label', i + 1)), label_mode)
+            marks.append(f"[{mark}] {', '.join(ann['class_names'])}")
+    if not marks:
+        return ''
+    return '\nCandidate classes of the marks, which may be wrong: ' + '; '.join(marks)
+
 def gpt4v_response(message, history):
     global history_images
     global history_texts; history_texts = []    
     try:
+        if history_masks:
+            message = message + class_names_prompt(history_masks[0], history_label_mode)
         res = request_gpt4v(message, history_images[0])
         history_texts.append(res)
         return res
@@ -162,19 +202,16 @@ def gpt4v_response(message, history):
 
 def highlight(mode, alpha, label_mode, anno_mode, *args, **kwargs):
     res = history_texts[0]
-    # find the seperate numbers in sentence res
-    res = res.split(' ')
-    res = [r.replace('.','').replace(',','').replace(')','').replace('"','') for r in res]
-    # find all numbers in '[]'
-    res = [r for r in res if '[' in r]
-    res = [r.split('[')[1] for r in res]
-    res = [r.split(']')[0] for r in res]
-    res = [r for r in res if r.isdigit()]
-    res = list(set(res))
+    # find the mark numbers cited in '[]', e.g. [3] or, for hierarchical
+    # marks, [3.2]
+    res = list(dict.fromkeys(re.findall(r'\[(\d+(?:\.\d+)*)\]', res)))
     sections = []
-    for i, r in enumerate(res):
-        mask_i = history_masks[0][int(r)-1]['segmentation']
-        sections.append((mask_i, r))
+    for r in res:
+        ann = history_indexes[0].annotation(r)
+        if ann is None:
+            # GPT-4V may cite a mark that was never drawn
+            continue
+        sections.append((segmentation_mask(ann['segmentation']), r))
     return (history_images[0], sections)
 
 '''
@@ -192,6 +229,7 @@ highlightBtn = gr.Button("Highlight")
 bot = gr.Chatbot(label="GPT-4V + SoM", height=256)
 slider_alpha = gr.Slider(0, 1, value=0.05, label="Mask Alpha") #info="Choose in [0, 1]"
 label_mode = gr.Radio(['Number', 'Alphabet'], value='Number', label="Mark Mode")
+class_names = gr.Checkbox(value=False, label="Send candidate class names of the marks")
 
 title = "Set-of-Mark (SoM) Visual Prompting for Extraordinary Visual Grounding in GPT-4V"
 description = "This is a demo for SoM Prompting to unleash extraordinary visual grounding in GPT-4V. Please upload an image and them click the 'Run' button to get the image with marks. Then chat with GPT-4V below!"
@@ -210,6 +248,7 @@ with demo:
                 with gr.Row():
                     slider_alpha.render()
                     label_mode.render()
+                class_names.render()
         with gr.Column():
             image_out.render()
             runBtn.render()
@@ -217,7 +256,7 @@ with demo:
     with gr.Row():    
         gr.ChatInterface(chatbot=bot, fn=gpt4v_response)
 
-    runBtn.click(inference, inputs=[image, slider, mode, slider_alpha, label_mode, anno_mode],
+    runBtn.click(inference, inputs=[image, slider, mode, slider_alpha, label_mode, anno_mode, class_names],
               outputs = image_out)
     highlightBtn.click(highlight, inputs=[image, mode, slider_alpha, label_mode, anno_mode],
               outputs = image_out)
@@ -11,12 +11,18 @@
 import gradio as gr
 import torch
 import argparse
+import contextlib
+import threading
+from collections import OrderedDict
 
 # seem
 from seem.modeling.BaseModel import BaseModel as BaseModel_Seem
 from seem.utils.distributed import init_distributed as init_distributed_seem
 from seem.modeling import build_model as build_model_seem
+from task_adapter.utils.device import get_device
+from task_adapter.utils.text_embeddings import text_embeddings
 from task_adapter.seem.tasks import interactive_seem_m2m_auto, inference_seem_pano, inference_seem_interactive
+from task_adapter.seem.tasks.inference_seem_interactive import SeemInteractiveBackend
 
 # semantic sam
 from semantic_sam.BaseModel import BaseModel
@@ -29,9 +35,10 @@ from task_adapter.semantic_sam.tasks import inference_semsam_m2m_auto, prompt_sw
 # sam
 from segment_anything import sam_model_registry
 from task_adapter.sam.tasks.inference_sam_m2m_auto import inference_sam_m2m_auto
-from task_adapter.sam.tasks.inference_sam_m2m_interactive import inference_sam_m2m_interactive
+from task_adapter.sam.tasks.inference_sam_m2m_interactive import inference_sam_m2m_interactive, SamInteractiveBackend
+from task_adapter.utils.embedding_cache import image_digest
+from task_adapter.utils.interactive_session import InteractiveSession
 
-from scipy.ndimage import label
 import numpy as np
 
 '''
@@ -52,16 +59,55 @@ opt_seem = init_distributed_seem(opt_seem)
 '''
 build model
 '''
-model_semsam = BaseModel(opt_semsam, build_model(opt_semsam)).from_pretrained(semsam_ckpt).eval().cuda()
-model_sam = sam_model_registry["vit_h"](checkpoint=sam_ckpt).eval().cuda()
-model_seem = BaseModel_Seem(opt_seem, build_model_seem(opt_seem)).from_pretrained(seem_ckpt).eval().cuda()
+# SOM_DEVICE, else CUDA if available, else CPU; fp16 autocast only on CUDA
+device = get_device()
+model_semsam = BaseModel(opt_semsam, build_model(opt_semsam)).from_pretrained(semsam_ckpt).eval().to(device)
+model_sam = sam_model_registry["vit_h"](checkpoint=sam_ckpt).eval().to(device)
+model_seem = BaseModel_Seem(opt_seem, build_model_seem(opt_seem)).from_pretrained(seem_ckpt).eval().to(device)
 
 with torch.no_grad():
-    with torch.autocast(device_type='cuda', dtype=torch.float16):
-        model_seem.model.sem_seg_head.predictor.lang_encoder.get_text_embeddings(COCO_PANOPTIC_CLASSES + ["background"], is_eval=True)
+    with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+        text_embeddings.activate(model_seem, COCO_PANOPTIC_CLASSES + ["background"])
+
+# user session hash -> [lock, image key, InteractiveSession] of the user's last
+# interactive request, so further strokes on the same image only decode what
+# changed. A session is only used and closed under its lock; the least
+# recently used users beyond max_sessions have theirs closed.
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+max_sessions = 8
+
+def close_session(entry):
+    if entry[2] is not None:
+        entry[2].close()
+    entry[1] = entry[2] = None
+
+@contextlib.contextmanager
+def interactive_session(user, model_name, backend, image, text_size):
+    key = (model_name, image_digest(np.asarray(image)), text_size)
+    with sessions_lock:
+        entry = sessions.setdefault(user, [threading.Lock(), None, None])
+        sessions.move_to_end(user)
+        evicted = [sessions.popitem(last=False)[1] for _ in range(len(sessions) - max_sessions)]
+    for old in evicted:
+        with old[0]:
+            close_session(old)
+    with entry[0]:
+        try:
+            if entry[1] != key:
+                close_session(entry)
+                entry[2] = InteractiveSession(backend, image, text_size)
+                entry[1] = key
+            yield entry[2]
+        finally:
+            # evicted while waiting for the lock or running
+            with sessions_lock:
+                evicted = sessions.get(user) is not entry
+            if evicted:
+                close_session(entry)
 
 @torch.no_grad()
-def inference(image, slider, mode, alpha, label_mode, anno_mode, *args, **kwargs):
+def inference(image, slider, mode, alpha, label_mode, anno_mode, request: gr.Request, *args, **kwargs):
     _image = image['background'].convert('RGB')
     _mask = image['layers'][0].convert('L') if image['layers'] else None
 
@@ -97,30 +143,28 @@ def inference(image, slider, mode, alpha, label_mode, anno_mode, *args, **kwargs
 
     text_size, hole_scale, island_scale=640,100,100
     text, text_part, text_thresh = '','','0.0'
-    with torch.autocast(device_type='cuda', dtype=torch.float16):
+    with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
         semantic=False
 
-        if mode == "Interactive":
-            labeled_array, num_features = label(np.asarray(_mask))
-            spatial_masks = torch.stack([torch.from_numpy(labeled_array == i+1) for i in range(num_features)])
-
         if model_name == 'semantic-sam':
             model = model_semsam
-            output, mask = inference_semsam_m2m_auto(model, _image, level, text, text_part, text_thresh, text_size, hole_scale, island_scale, semantic, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, *args, **kwargs)
+            output, mask, label_map = inference_semsam_m2m_auto(model, _image, level, text, text_part, text_thresh, text_size, hole_scale, island_scale, semantic, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, *args, **kwargs)
 
         elif model_name == 'sam':
             model = model_sam
             if mode == "Automatic":
-                output, mask = inference_sam_m2m_auto(model, _image, text_size, label_mode, alpha, anno_mode)
+                output, mask, label_map = inference_sam_m2m_auto(model, _image, text_size, label_mode, alpha, anno_mode)
             elif mode == "Interactive":
-                output, mask = inference_sam_m2m_interactive(model, _image, spatial_masks, text_size, label_mode, alpha, anno_mode)
+                with interactive_session(request.session_hash, model_name, SamInteractiveBackend(model), _image, text_size) as session:
+                    output, mask, label_map = session.update(np.asarray(_mask), label_mode, alpha, anno_mode)
 
         elif model_name == 'seem':
             model = model_seem
             if mode == "Automatic":
-                output, mask = inference_seem_pano(model, _image, text_size, label_mode, alpha, anno_mode)
+                output, mask, label_map = inference_seem_pano(model, _image, text_size, label_mode, alpha, anno_mode)
             elif mode == "Interactive":
-                output, mask = inference_seem_interactive(model, _image, spatial_masks, text_size, label_mode, alpha, anno_mode)
+                with interactive_session(request.session_hash, model_name, SeemInteractiveBackend(model), _image, text_size) as session:
+                    output, mask, label_map = session.update(np.asarray(_mask), label_mode, alpha, anno_mode)
 
         return output
 
@@ -5,10 +5,14 @@
 # Written by Hao Zhang (hzhangcx@connect.ust.hk)
 # --------------------------------------------------------
 
+import time
 import torch
 import numpy as np
 from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.generator_registry import generators
+from task_adapter.utils.pipeline import InferenceBackend, InferencePipeline
+from task_adapter.utils.presets import latency_tracker, num_prompts, resolve_preset
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -20,44 +24,32 @@ from segment_anything import SamAutomaticMaskGenerator
 metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
 
-def inference_sam_m2m_auto(model, image, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image)
-    image_ori = np.asarray(image_ori)
+class SamAutoBackend(InferenceBackend):
+    """
+    Automatic mask generation with SAM. SamAutomaticMaskGenerator takes the
+    HWC numpy image and runs the encoder itself, so all model work is in
+    decode.
+    """
 
-    mask_generator = SamAutomaticMaskGenerator(model)
-    outputs = mask_generator.generate(image_ori)
+    needs_tensor = False
 
-    from task_adapter.utils.visualizer import Visualizer
-    visual = Visualizer(image_ori, metadata=metadata)
-    sorted_anns = sorted(outputs, key=(lambda x: x['area']), reverse=True)
-    label = 1
-    # for ann in sorted_anns:
-    #     mask = ann['segmentation']
-    #     color_mask = np.random.random((1, 3)).tolist()[0]
-    #     # color_mask = [int(c*255) for c in color_mask]
-    #     demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-    #     label += 1
-    # im = demo.get_image()
+    def __init__(self, model, device=None, preset='balanced', latency_budget=None):
+        super().__init__(model, device)
+        self.preset = preset
+        self.latency_budget = latency_budget
 
-    mask_map = np.zeros(image_ori.shape, dtype=np.uint8)    
-    for i, ann in enumerate(sorted_anns):
-        mask = ann['segmentation']
-        color_mask = np.random.random((1, 3)).tolist()[0]
-        # color_mask = [int(c*255) for c in color_mask]
-        demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-        # assign the mask to the mask_map
-        mask_map[mask == 1] = label
-        label += 1
-    im = demo.get_image()    
-    # fig=plt.figure(figsize=(10, 10))
-    # plt.imshow(image_ori)
-    # show_anns(outputs)
-    # fig.canvas.draw()
-    # im=Image.frombytes('RGB', fig.canvas.get_width_height(), fig.canvas.tostring_rgb())
-    return im, sorted_anns
+    def decode(self, ctx):
+        num_pixels = ctx.image_ori.shape[0] * ctx.image_ori.shape[1]
+        _, params, _ = resolve_preset('sam', self.preset, self.latency_budget, num_pixels=num_pixels)
+        start = time.perf_counter()
+        mask_generator = ctx.resources.enter_context(generators.acquire(SamAutomaticMaskGenerator, self.model, **params))
+        ctx.annotations = mask_generator.generate(ctx.image_ori)
+        latency_tracker.record('sam', num_prompts(params), num_pixels, time.perf_counter() - start)
+
+
+def inference_sam_m2m_auto(model, image, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask'], preset='balanced', latency_budget=None, hooks=()):
+    pipeline = InferencePipeline(SamAutoBackend(model, preset=preset, latency_budget=latency_budget), hooks)
+    return pipeline(image, text_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
 
 
 def remove_small_regions(
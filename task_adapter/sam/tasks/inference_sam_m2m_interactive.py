@@ -10,6 +10,10 @@ import torch.nn.functional as F
 import numpy as np
 from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.embedding_cache import set_image_cached
+from task_adapter.utils.generator_registry import generators
+from task_adapter.utils.pipeline import InferenceBackend, InferencePipeline, binary_masks_to_annotations
+from task_adapter.utils.stroke_prompts import StrokePrompts, stroke_labels
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -65,117 +69,47 @@ def sam_interactive_mask(mask_generator, points, in_points, in_labels, mask_inpu
     masks = data["masks"].reshape(nm, -1, h, w)
     scores = (data['iou_preds'] + data['stability_score']).reshape(nm, -1)
 
-    index = torch.stack([torch.arange(nm).cuda(), scores.argmax(dim=1)]).tolist()
+    index = torch.stack([torch.arange(nm, device=scores.device), scores.argmax(dim=1)]).tolist()
     return masks[index]
 
-def inference_sam_m2m_interactive(model, image, spatial_masks, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image)
-
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
-
-    orig_size = images.shape[-2:]
-    orig_h, orig_w = orig_size
-    crop_box = [0,0,orig_w,orig_h]
-
-    spatial_masks = spatial_masks[:, None].float().cuda()
-    spatial_masks = F.interpolate(spatial_masks, size=(orig_h, orig_w), mode='bicubic', align_corners=False) > 0
-
-    # generate single center point
-    # n,_,h,w = spatial_masks.shape
-    # mask_dt = (distance_transform((~F.pad(spatial_masks, pad=(1, 1, 1, 1), mode='constant', value=0)).float())[:,:,1:-1,1:-1]).reshape(n,-1)
-    # max_xy_idx = torch.stack([torch.arange(n), mask_dt.max(dim=-1)[1].cpu()]).tolist()
-    # next_mask = torch.zeros(spatial_masks.shape, device=torch.cuda.current_device()).bool()
-    # next_mask = next_mask.view(n,-1)
-    # next_mask[max_xy_idx] = True
-    # next_mask = next_mask.reshape((n,1,h,w))
-    # points = next_mask.nonzero()[:,2:].flip(dims=[1]).cpu().numpy()
-
-    # stack sampled points
-    acc_points = []
-    for i in range(len(spatial_masks)):
-        points = spatial_masks[i:i+1].nonzero()[:,2:].flip(dims=[1]).cpu().numpy()
-        rand_ids = np.random.choice(points.shape[0], size=40, replace=True)
-        points = points[rand_ids]
-        acc_points.append(points)
-    _np = len(acc_points)
-    points = np.concatenate(acc_points)
-
-    mask_generator = SamAutomaticMaskGenerator(model)
-    mask_generator.predictor.set_image(image_ori)
-    im_size = image_ori.shape[:-1]
-
-    transformed_points = mask_generator.predictor.transform.apply_coords(points, im_size)
-    in_points = torch.as_tensor(transformed_points, device=mask_generator.predictor.device).reshape(_np,-1,2).transpose(0,1)
-    in_labels = torch.ones((in_points.shape[0], _np), dtype=torch.int, device=mask_generator.predictor.device)
-
-    masks = sam_interactive_mask(mask_generator, points, in_points.transpose(0,1), in_labels.transpose(0,1), None)
-
-    masks = masks > 0.0
-    iou_preds = torch.ones(masks.shape[0], dtype=torch.float32)
-    points = torch.zeros((masks.shape[0], 2), dtype=torch.float32)
-
-    mask_data = MaskData(
-        masks=masks,
-        iou_preds=iou_preds,
-        points=points,
-    )
+class SamInteractiveBackend(InferenceBackend):
+    """
+    One set of SAM masks per user stroke, prompted with points sampled
+    from the stroke.
+    """
 
-    mask_data["stability_score"] = torch.ones(masks.shape[0], dtype=torch.float32)
-    del masks
+    def prepare_prompts(self, ctx):
+        labels, num_strokes = stroke_labels(ctx.inputs['spatial_masks'])
+        prompts = StrokePrompts(labels, num_strokes, ctx.image_ori.shape[:2], num_points=40)
+        ctx.prompts = prompts.points.reshape(-1, 2), num_strokes
 
-    mask_data["boxes"] = batched_mask_to_box(mask_data["masks"])
-    mask_data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(mask_data["boxes"]))])
-
-    # Compress to RLE
-    mask_data["masks"] = uncrop_masks(mask_data["masks"], crop_box, orig_h, orig_w)
-    mask_data["rles"] = mask_to_rle_pytorch(mask_data["masks"])
-    del mask_data["masks"]
-    mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-
-    # Write mask records
-    outputs = []
-    for idx in range(len(mask_data["segmentations"])):
-        ann = {
-            "segmentation": mask_data["segmentations"][idx],
-            "area": area_from_rle(mask_data["rles"][idx]),
-            "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-            "predicted_iou": mask_data["iou_preds"][idx].item(),
-            "point_coords": [mask_data["points"][idx].tolist()],
-            "stability_score": mask_data["stability_score"][idx].item(),
-            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-        }
-        outputs.append(ann)
-
-    from task_adapter.utils.visualizer import Visualizer
-    visual = Visualizer(image_ori, metadata=metadata)
-    sorted_anns = sorted(outputs, key=(lambda x: x['area']), reverse=True)
-    label = 1
-    # for ann in sorted_anns:
-    #     mask = ann['segmentation']
-    #     demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-    #     label += 1
-    # im = demo.get_image()
-
-    mask_map = np.zeros(image_ori.shape, dtype=np.uint8)    
-    for i, ann in enumerate(sorted_anns):
-        mask = ann['segmentation']
-        color_mask = np.random.random((1, 3)).tolist()[0]
-        # color_mask = [int(c*255) for c in color_mask]
-        demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-        # assign the mask to the mask_map
-        mask_map[mask == 1] = label
-        label += 1
-    im = demo.get_image()    
-    # fig=plt.figure(figsize=(10, 10))
-    # plt.imshow(image_ori)
-    # show_anns(outputs)
-    # fig.canvas.draw()
-    # im=Image.frombytes('RGB', fig.canvas.get_width_height(), fig.canvas.tostring_rgb())
-    return im, sorted_anns
+    def encode(self, ctx):
+        mask_generator = ctx.resources.enter_context(generators.acquire(SamAutomaticMaskGenerator, self.model))
+        ctx.resources.callback(mask_generator.predictor.reset_image)
+        # follow-up strokes on the same image reuse its embedding
+        set_image_cached(mask_generator.predictor, ctx.image_ori)
+        ctx.features = mask_generator
+
+    def decode(self, ctx):
+        mask_generator = ctx.features
+        points, _np = ctx.prompts
+        im_size = ctx.image_ori.shape[:-1]
+
+        transformed_points = mask_generator.predictor.transform.apply_coords(points, im_size)
+        in_points = torch.as_tensor(transformed_points, device=mask_generator.predictor.device).reshape(_np,-1,2).transpose(0,1)
+        in_labels = torch.ones((in_points.shape[0], _np), dtype=torch.int, device=mask_generator.predictor.device)
+
+        ctx.outputs = sam_interactive_mask(mask_generator, points, in_points.transpose(0,1), in_labels.transpose(0,1), None)
+
+    def postprocess(self, ctx):
+        ctx.annotations = binary_masks_to_annotations(ctx.outputs > 0.0)
+        # the mask of stroke i is decoded i-th
+        ctx.annotations.set_column('stroke', list(range(1, len(ctx.annotations) + 1)))
+
+
+def inference_sam_m2m_interactive(model, image, spatial_masks, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None, hooks=()):
+    pipeline = InferencePipeline(SamInteractiveBackend(model, device), hooks)
+    return pipeline(image, text_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, spatial_masks=spatial_masks)
 
 
 def remove_small_regions(
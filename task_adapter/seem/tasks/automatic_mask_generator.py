@@ -9,7 +9,7 @@ import torch
 import torch.nn as nn
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 from segment_anything.modeling import Sam
 from segment_anything.utils.amg import (
@@ -30,6 +30,17 @@ from segment_anything.utils.amg import (
     uncrop_masks,
     uncrop_points,
 )
+from task_adapter.utils.device import get_device
+from task_adapter.utils.annotation_set import AnnotationSet
+from task_adapter.utils.label_map import rles_to_label_map
+from task_adapter.utils.mask_postprocess import postprocess_mask_batch
+from task_adapter.utils.memory import (
+    MemoryBudgetBatcher,
+    is_oom_error,
+    peak_memory_since,
+    release_memory,
+    reset_peak_memory,
+)
 
 
 class SeemAutomaticMaskGenerator:
@@ -49,6 +60,8 @@ class SeemAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        memory_budget: Optional[int] = None,
+        device: Optional[Union[str, torch.device]] = None,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -90,9 +103,16 @@ class SeemAutomaticMaskGenerator:
             to remove disconnected regions and holes in masks with area smaller
             than min_mask_region_area. Requires opencv.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
-            'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
-            For large resolutions, 'binary_mask' may consume large amounts of
-            memory.
+            'uncompressed_rle', 'coco_rle' or 'label_map'. 'coco_rle' requires
+            pycocotools. For large resolutions, 'binary_mask' may consume large
+            amounts of memory. 'label_map' returns all masks painted into one
+            int32 HW map instead of one mask per record, see generate.
+          memory_budget (int or None): If set, the number of bytes point batches
+            may use. points_per_batch is then ignored and the batch size is
+            derived from the budget and the image size, shrinking on
+            out-of-memory errors and growing while there is headroom.
+          device (str, torch.device or None): The device to run on. Defaults to
+            the device of the model, see task_adapter.utils.device.get_device.
         """
 
         assert (points_per_side is None) != (
@@ -113,6 +133,7 @@ class SeemAutomaticMaskGenerator:
             "binary_mask",
             "uncompressed_rle",
             "coco_rle",
+            "label_map",
         ], f"Unknown output_mode {output_mode}."
         if output_mode == "coco_rle":
             from pycocotools import mask as mask_utils  # type: ignore # noqa: F401
@@ -132,14 +153,15 @@ class SeemAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.batcher = MemoryBudgetBatcher(memory_budget) if memory_budget is not None else None
 
         # dilate conv
         self.dilation = nn.Conv2d(in_channels=1, out_channels=1, kernel_size=7, stride=1, padding=3, bias=False)
         self.dilation.weight.data.fill_(1.0)
-        self.dilation.cuda()
+        self.dilation.to(get_device(model, device))
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(self, image: np.ndarray) -> AnnotationSet:
         """
         Generates masks for the given image.
 
@@ -147,8 +169,9 @@ class SeemAutomaticMaskGenerator:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
 
         Returns:
-           list(dict(str, any)): A list over records for masks. Each record is
-             a dict containing the following keys:
+           AnnotationSet: The records for masks, stored column-wise. It
+             behaves as a list over dict-like records, each containing the
+             following keys:
                segmentation (dict(str, any) or np.ndarray): The mask. If
                  output_mode='binary_mask', is an array of shape HW. Otherwise,
                  is a dictionary containing the RLE.
@@ -162,6 +185,12 @@ class SeemAutomaticMaskGenerator:
                  is filtered on using the stability_score_thresh parameter.
                crop_box (list(float)): The crop of the image used to generate
                  the mask, given in XYWH format.
+
+           If output_mode='label_map', returns (np.ndarray, AnnotationSet)
+             instead: an int32 HW map in which every pixel holds the label of
+             the smallest mask covering it (0 if none), and the records without
+             'segmentation', sorted by decreasing area and numbered from 1 in
+             their 'label' key.
         """
 
         # Generate masks
@@ -174,6 +203,34 @@ class SeemAutomaticMaskGenerator:
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
             )
+        return self._write_mask_records(mask_data, image.shape[-2:])
+
+    @torch.no_grad()
+    def generate_stream(self, image: np.ndarray) -> Iterator[Tuple[AnnotationSet, bool]]:
+        """
+        Generates masks for the given image progressively.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+
+        Yields:
+          (AnnotationSet, bool): Mask records in the format returned by
+            generate, and whether they are final. Every point batch yields the
+            masks that passed its quality filters as provisional records; these
+            may still be removed by NMS or changed by small-region
+            postprocessing. The last item holds the final records, identical
+            to the output of generate.
+        """
+        for mask_data, is_final in self._generate_masks_stream(image):
+            if is_final and self.min_mask_region_area > 0:
+                mask_data = self.postprocess_small_regions(
+                    mask_data,
+                    self.min_mask_region_area,
+                    max(self.box_nms_thresh, self.crop_nms_thresh),
+                )
+            yield self._write_mask_records(mask_data, image.shape[-2:]), is_final
+
+    def _write_mask_records(self, mask_data: MaskData, orig_size: Tuple[int, ...]):
         # Encode masks
         if self.output_mode == "coco_rle":
             mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
@@ -183,22 +240,24 @@ class SeemAutomaticMaskGenerator:
             mask_data["segmentations"] = mask_data["rles"]
 
         # Write mask records
-        curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-                "predicted_iou": mask_data["iou_preds"][idx].item(),
-                "point_coords": [mask_data["points"][idx].tolist()],
-                "stability_score": mask_data["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-            }
-            curr_anns.append(ann)
+        curr_anns = AnnotationSet.from_mask_data(mask_data, mask_data["segmentations"])
+
+        if self.output_mode == "label_map":
+            # Paint by decreasing area so smaller masks stay visible
+            curr_anns = curr_anns.sort_by("area")
+            curr_anns.set_column("label", range(1, len(curr_anns) + 1))
+            label_map = rles_to_label_map(curr_anns.segmentations, orig_size)
+            curr_anns.segmentations = None
+            return label_map, curr_anns
 
         return curr_anns
 
     def _generate_masks(self, image: np.ndarray) -> MaskData:
+        for data, _ in self._generate_masks_stream(image):
+            pass
+        return data
+
+    def _generate_masks_stream(self, image: np.ndarray) -> Iterator[Tuple[MaskData, bool]]:
         orig_size = image.shape[-2:]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
@@ -207,8 +266,11 @@ class SeemAutomaticMaskGenerator:
         # Iterate over image crops
         data = MaskData()
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+            for crop_data, crop_done in self._process_crop_stream(image, crop_box, layer_idx, orig_size):
+                if crop_done:
+                    data.cat(crop_data)
+                else:
+                    yield crop_data, False
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -224,15 +286,19 @@ class SeemAutomaticMaskGenerator:
             data.filter(keep_by_nms)
 
         data.to_numpy()
-        return data
+        yield data, True
 
-    def _process_crop(
+    def _process_crop_stream(
         self,
         image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
-    ) -> MaskData:
+    ) -> Iterator[Tuple[MaskData, bool]]:
+        """
+        Yields the masks of every point batch, in the original image frame,
+        followed by the deduplicated masks of the whole crop.
+        """
         # Crop the image and calculate embeddings
         x0, y0, x1, y1 = crop_box
         cropped_im = image#[y0:y1, x0:x1, :]
@@ -247,9 +313,11 @@ class SeemAutomaticMaskGenerator:
         data = MaskData()
         self.enc_features=None
 
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(cropped_im, points, cropped_im_size, crop_box, orig_size)
+        for batch_data in self._process_point_batches(cropped_im, points_for_image, cropped_im_size, crop_box, orig_size):
             data.cat(batch_data)
+            batch_data["boxes"] = uncrop_boxes_xyxy(batch_data["boxes"], crop_box)
+            batch_data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(batch_data["rles"]))])
+            yield batch_data, False
             del batch_data
 
         # Remove duplicates within this crop.
@@ -266,7 +334,47 @@ class SeemAutomaticMaskGenerator:
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
 
-        return data
+        yield data, True
+
+    def _process_point_batches(
+        self,
+        images,
+        points_for_image: np.ndarray,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ):
+        """
+        Runs the points through _process_batch and yields the results. With a
+        memory budget the batch size is re-evaluated before every batch, and a
+        batch that runs out of memory is retried with fewer points.
+        """
+        if self.batcher is None:
+            for (points,) in batch_iterator(self.points_per_batch, points_for_image):
+                yield self._process_batch(images, points, im_size, crop_box, orig_size)
+            return
+
+        device = images.device
+        pixels_per_point = int(im_size[0]) * int(im_size[1])
+        start = 0
+        while start < len(points_for_image):
+            points = points_for_image[start:start + self.batcher.batch_size(pixels_per_point)]
+            # the first batch also runs the image encoder, so it says little
+            # about the cost of a point
+            mem_start = reset_peak_memory(device) if self.enc_features is not None else None
+            try:
+                batch_data = self._process_batch(images, points, im_size, crop_box, orig_size)
+            except RuntimeError as e:
+                if not is_oom_error(e) or not self.batcher.backoff(len(points), pixels_per_point):
+                    raise
+                batch_data = None
+            if batch_data is None:
+                # free the failed batch only once the traceback is gone
+                release_memory(device)
+                continue
+            self.batcher.update(len(points), pixels_per_point, peak_memory_since(device, mem_start))
+            start += len(points)
+            yield batch_data
 
     def _process_batch(
         self,
@@ -295,38 +403,18 @@ class SeemAutomaticMaskGenerator:
         else:
             masks, iou_preds = self.predictor.model.evaluate_demo(batch_inputs, self.enc_features[0], self.enc_features[1], self.enc_features[2])
 
-        data = MaskData(
-            masks=masks,
-            iou_preds=iou_preds,
-            points=points,
-        )
+        # Filter, threshold, box and RLE-encode the masks in one fused stage
+        data = MaskData(**postprocess_mask_batch(
+            masks,
+            iou_preds,
+            points,
+            crop_box,
+            orig_size,
+            self.pred_iou_thresh,
+            self.stability_score_thresh,
+            self.stability_score_offset,
+        ))
         del masks
-        # Filter by predicted IoU
-        if self.pred_iou_thresh > 0.0:
-            keep_mask = data["iou_preds"] > self.pred_iou_thresh
-            data.filter(keep_mask)
-
-        # Calculate stability score
-        data["stability_score"] = calculate_stability_score(
-            data["masks"], 0.0, self.stability_score_offset
-        )
-        if self.stability_score_thresh > 0.0:
-            keep_mask = data["stability_score"] >= self.stability_score_thresh
-            data.filter(keep_mask)
-
-        # Threshold masks and calculate boxes
-        data["masks"] = data["masks"] > 0.0
-        data["boxes"] = batched_mask_to_box(data["masks"])
-
-        # Filter boxes that touch crop boundaries
-        keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
-        if not torch.all(keep_mask):
-            data.filter(keep_mask)
-
-        # Compress to RLE
-        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
-        del data["masks"]
 
         return data
 
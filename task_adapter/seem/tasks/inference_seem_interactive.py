@@ -10,6 +10,9 @@ import torch.nn.functional as F
 import numpy as np
 from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.pipeline import InferenceBackend, InferencePipeline, binary_masks_to_annotations
+from task_adapter.utils.stroke_prompts import StrokePrompts, stroke_labels
+from task_adapter.utils.text_embeddings import text_embeddings
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -39,91 +42,33 @@ from segment_anything.utils.amg import (
 )
 
 
-def inference_seem_interactive(model, image, spatial_masks, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image)
-
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
-
-    orig_size = images.shape[-2:]
-    orig_h, orig_w = orig_size
-    crop_box = [0,0,orig_w,orig_h]
-
-    data = {"image": images, "height": orig_h, "width": orig_w}
-
-    spatial_masks = spatial_masks[:, None].float().cuda()
-    spatial_masks = F.interpolate(spatial_masks, size=(orig_h, orig_w), mode='bicubic', align_corners=False) > 0
-    data['spatial_query'] = {'rand_shape': spatial_masks}
-
-    model.model.metadata = metadata
-    masks, _ = model.model.evaluate_demo([data])
-    masks = masks > 0.0
-    iou_preds = torch.ones(masks.shape[0], dtype=torch.float32)
-    points = torch.zeros((masks.shape[0], 2), dtype=torch.float32)
-
-    mask_data = MaskData(
-        masks=masks,
-        iou_preds=iou_preds,
-        points=points,
-    )
-
-    mask_data["stability_score"] = torch.ones(masks.shape[0], dtype=torch.float32)
-    del masks
+class SeemInteractiveBackend(InferenceBackend):
+    """
+    One SEEM mask per user stroke, prompted with the stroke itself.
+    """
 
-    mask_data["boxes"] = batched_mask_to_box(mask_data["masks"])
-    mask_data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(mask_data["boxes"]))])
+    def prepare_prompts(self, ctx):
+        labels, num_strokes = stroke_labels(ctx.inputs['spatial_masks'])
+        prompts = StrokePrompts(labels, num_strokes, ctx.image_ori.shape[:2])
+        ctx.prompts = {'rand_shape': prompts.masks(ctx.device)[:, None]}
 
-    # Compress to RLE
-    mask_data["masks"] = uncrop_masks(mask_data["masks"], crop_box, orig_h, orig_w)
-    mask_data["rles"] = mask_to_rle_pytorch(mask_data["masks"])
-    del mask_data["masks"]
-    mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+    def decode(self, ctx):
+        orig_h, orig_w = ctx.image_ori.shape[:2]
+        data = {"image": ctx.images, "height": orig_h, "width": orig_w, "spatial_query": ctx.prompts}
+        # metadata is shared model state, guarded like the vocabulary
+        with text_embeddings.lock(self.model):
+            self.model.model.metadata = metadata
+            ctx.outputs, _ = self.model.model.evaluate_demo([data])
 
-    # Write mask records
-    outputs = []
-    for idx in range(len(mask_data["segmentations"])):
-        ann = {
-            "segmentation": mask_data["segmentations"][idx],
-            "area": area_from_rle(mask_data["rles"][idx]),
-            "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-            "predicted_iou": mask_data["iou_preds"][idx].item(),
-            "point_coords": [mask_data["points"][idx].tolist()],
-            "stability_score": mask_data["stability_score"][idx].item(),
-            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-        }
-        outputs.append(ann)
+    def postprocess(self, ctx):
+        ctx.annotations = binary_masks_to_annotations(ctx.outputs > 0.0)
+        # the mask of stroke i is decoded i-th
+        ctx.annotations.set_column('stroke', list(range(1, len(ctx.annotations) + 1)))
 
-    from task_adapter.utils.visualizer import Visualizer
-    visual = Visualizer(image_ori, metadata=metadata)
-    sorted_anns = sorted(outputs, key=(lambda x: x['area']), reverse=True)
-    label = 1
-    # for ann in sorted_anns:
-    #     mask = ann['segmentation']
-    #     color_mask = np.random.random((1, 3)).tolist()[0]
-    #     # color_mask = [int(c*255) for c in color_mask]
-    #     demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-    #     label += 1
-    # im = demo.get_image()
 
-    mask_map = np.zeros(image_ori.shape, dtype=np.uint8)    
-    for i, ann in enumerate(sorted_anns):
-        mask = ann['segmentation']
-        color_mask = np.random.random((1, 3)).tolist()[0]
-        # color_mask = [int(c*255) for c in color_mask]
-        demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-        # assign the mask to the mask_map
-        mask_map[mask == 1] = label
-        label += 1
-    im = demo.get_image()
-    # fig=plt.figure(figsize=(10, 10))
-    # plt.imshow(image_ori)
-    # show_anns(outputs)
-    # fig.canvas.draw()
-    # im=Image.frombytes('RGB', fig.canvas.get_width_height(), fig.canvas.tostring_rgb())
-    return im, sorted_anns
+def inference_seem_interactive(model, image, spatial_masks, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None, hooks=()):
+    pipeline = InferencePipeline(SeemInteractiveBackend(model, device), hooks)
+    return pipeline(image, text_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, spatial_masks=spatial_masks)
 
 
 def remove_small_regions(
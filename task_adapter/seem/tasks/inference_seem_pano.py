@@ -5,13 +5,17 @@
 # Written by Hao Zhang (hzhangcx@connect.ust.hk)
 # --------------------------------------------------------
 
+import math
 import torch
 import numpy as np
 from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.pipeline import InferenceBackend, InferencePipeline, panoptic_to_annotations
+from task_adapter.utils.text_embeddings import text_embeddings, vocabulary_metadata
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
+from semantic_sam.utils.constants import COCO_PANOPTIC_CLASSES
 import matplotlib.pyplot as plt
 import cv2
 import io
@@ -38,87 +42,63 @@ from segment_anything.utils.amg import (
 )
 
 
-def inference_seem_pano(model, image, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image)
-
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
-
-    orig_size = images.shape[-2:]
-    orig_h, orig_w = orig_size
-    crop_box = [0,0,orig_w,orig_h]
-
-    data = {"image": images, "height": orig_h, "width": orig_w}
-    batch_inputs = [data]
-
-    model.model.metadata = metadata
-    outputs = model.model.evaluate(batch_inputs)
-
-    pano_mask = outputs[0]['panoptic_seg'][0]
-    pano_info = outputs[0]['panoptic_seg'][1]
-
-    masks = []
-    for seg_info in pano_info:
-        masks += [pano_mask == seg_info['id']]
-    masks = torch.stack(masks, dim=0)
-    iou_preds = torch.ones(masks.shape[0], dtype=torch.float32)
-    points = torch.zeros((masks.shape[0], 2), dtype=torch.float32)
-
-    mask_data = MaskData(
-        masks=masks,
-        iou_preds=iou_preds,
-        points=points,
-    )
-    mask_data["stability_score"] = torch.ones(masks.shape[0], dtype=torch.float32)
-    del masks
-
-    mask_data["boxes"] = batched_mask_to_box(mask_data["masks"])
-    mask_data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(mask_data["boxes"]))])
-
-    # Compress to RLE
-    mask_data["masks"] = uncrop_masks(mask_data["masks"], crop_box, orig_h, orig_w)
-    mask_data["rles"] = mask_to_rle_pytorch(mask_data["masks"])
-    del mask_data["masks"]
-    mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-
-    # Write mask records
-    outputs = []
-    for idx in range(len(mask_data["segmentations"])):
-        ann = {
-            "segmentation": mask_data["segmentations"][idx],
-            "area": area_from_rle(mask_data["rles"][idx]),
-            "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-            "predicted_iou": mask_data["iou_preds"][idx].item(),
-            "point_coords": [mask_data["points"][idx].tolist()],
-            "stability_score": mask_data["stability_score"][idx].item(),
-            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-        }
-        outputs.append(ann)
-
-    from task_adapter.utils.visualizer import Visualizer
-    visual = Visualizer(image_ori, metadata=metadata)
-    # create a full zero image as the image_orig
-    sorted_anns = sorted(outputs, key=(lambda x: x['area']), reverse=True)
-    label = 1
-    mask_map = np.zeros(image_ori.shape, dtype=np.uint8)    
-    for i, ann in enumerate(sorted_anns):
-        mask = ann['segmentation']
-        color_mask = np.random.random((1, 3)).tolist()[0]
-        # color_mask = [int(c*255) for c in color_mask]
-        demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-        # assign the mask to the mask_map
-        mask_map[mask == 1] = label
-        label += 1
-    im = demo.get_image()
-    # fig=plt.figure(figsize=(10, 10))
-    # plt.imshow(image_ori)
-    # show_anns(outputs)
-    # fig.canvas.draw()
-    # im=Image.frombytes('RGB', fig.canvas.get_width_height(), fig.canvas.tostring_rgb())
-    return im, sorted_anns
+COCO_VOCABULARY = COCO_PANOPTIC_CLASSES + ["background"]
+
+
+class SeemPanoBackend(InferenceBackend):
+    """
+    SEEM panoptic segmentation, one mask per segment. vocabulary is the list
+    of class names to segment, COCO panoptic if None; its text embeddings
+    come from the shared TextEmbeddingStore, and are active on the model
+    only while it decodes.
+    """
+
+    def __init__(self, model, device=None, vocabulary=None):
+        super().__init__(model, device)
+        self.vocabulary = vocabulary
+        self.metadata = metadata if vocabulary is None else vocabulary_metadata(vocabulary)
+
+    def decode(self, ctx):
+        self.decode_batch([ctx])
+
+    def decode_batch(self, ctxs):
+        batch_inputs = []
+        for ctx in ctxs:
+            orig_h, orig_w = ctx.image_ori.shape[:2]
+            batch_inputs.append({"image": ctx.images, "height": orig_h, "width": orig_w})
+        # the vocabulary is set on the shared model: hold it until evaluate
+        # returns, so concurrent requests never see each other's
+        with text_embeddings.vocabulary(self.model, COCO_VOCABULARY if self.vocabulary is None else self.vocabulary, self.metadata):
+            outputs = self.model.model.evaluate(batch_inputs)
+        for ctx, output in zip(ctxs, outputs):
+            ctx.outputs = [output]
+
+    def batch_key(self, size):
+        # images padded to the same size give the same backbone input alone
+        # as in a batch
+        divisibility = getattr(self.model.model, "size_divisibility", 0)
+        if divisibility > 1:
+            return tuple(math.ceil(x / divisibility) * divisibility for x in size)
+        return size
+
+    def postprocess(self, ctx):
+        pano_mask, pano_info = ctx.outputs[0]['panoptic_seg']
+        ctx.annotations = panoptic_to_annotations(pano_mask, [seg_info['id'] for seg_info in pano_info])
+
+
+def inference_seem_pano(model, image, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None, vocabulary=None, hooks=()):
+    pipeline = InferencePipeline(SeemPanoBackend(model, device, vocabulary), hooks)
+    return pipeline(image, text_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
+
+
+def inference_seem_pano_batch(model, images, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None, batch_size=4, vocabulary=None, hooks=()):
+    """
+    inference_seem_pano for a list of images, running model.model.evaluate
+    on up to batch_size images of the same padded size at once. Returns
+    the list of per-image results, in input order.
+    """
+    pipeline = InferencePipeline(SeemPanoBackend(model, device, vocabulary), hooks)
+    return pipeline.batch(images, text_size, batch_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
 
 
 def remove_small_regions(
@@ -7,8 +7,10 @@
 
 import torch
 import numpy as np
-from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.device import get_device
+from task_adapter.utils.resize import resize_image
+from task_adapter.utils.generator_registry import generators
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -18,21 +20,17 @@ import io
 from .automatic_mask_generator import SeemAutomaticMaskGenerator
 metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
-def interactive_seem_m2m_auto(model, image, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image)
+def interactive_seem_m2m_auto(model, image, text_size, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None):
+    device = get_device(model, device)
+    image_ori = resize_image(image, text_size)
+    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).to(device)
 
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
-
-    mask_generator = SeemAutomaticMaskGenerator(model)
-    outputs = mask_generator.generate(images)
+    with generators.acquire(SeemAutomaticMaskGenerator, model, device=device) as mask_generator:
+        outputs = mask_generator.generate(images)
 
     from task_adapter.utils.visualizer import Visualizer
     visual = Visualizer(image_ori, metadata=metadata)
-    sorted_anns = sorted(outputs, key=(lambda x: x['area']), reverse=True)
+    sorted_anns = outputs.sort_by('area')
     label = 1
     for ann in sorted_anns:
         mask = ann['segmentation']
@@ -4,11 +4,14 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import math
+
 import numpy as np
 import torch
+from detectron2.structures import ImageList
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 # from
 # from .modeling import Sam
 # from .predictor import SamPredictor
@@ -30,6 +33,17 @@ from semantic_sam.utils.sam_utils.amg import (
     uncrop_masks,
     uncrop_points,
 )
+from task_adapter.utils.annotation_set import AnnotationSet
+from task_adapter.utils.label_map import rles_to_label_map
+from task_adapter.utils.mask_nms import mask_nms
+from task_adapter.utils.mask_postprocess import postprocess_mask_batch
+from task_adapter.utils.memory import (
+    MemoryBudgetBatcher,
+    is_oom_error,
+    peak_memory_since,
+    release_memory,
+    reset_peak_memory,
+)
 
 
 def prompt_switch(p):
@@ -68,6 +82,8 @@ class SemanticSamAutomaticMaskGenerator:
         min_mask_region_area: int = 10,
         output_mode: str = "binary_mask",
         level: list = [1, 2, 3, 4, 5, 6],
+        memory_budget: Optional[int] = None,
+        mask_nms_thresh: float = 0.0,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -109,9 +125,20 @@ class SemanticSamAutomaticMaskGenerator:
             to remove disconnected regions and holes in masks with area smaller
             than min_mask_region_area. Requires opencv.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
-            'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
-            For large resolutions, 'binary_mask' may consume large amounts of
-            memory.
+            'uncompressed_rle', 'coco_rle' or 'label_map'. 'coco_rle' requires
+            pycocotools. For large resolutions, 'binary_mask' may consume large
+            amounts of memory. 'label_map' returns all masks painted into one
+            int32 HW map instead of one mask per record, see generate.
+          level (list(int)): The granularity levels to predict. Every point
+            prompt yields one mask per level.
+          memory_budget (int or None): If set, the number of bytes point batches
+            may use. points_per_batch is then ignored and the batch size is
+            derived from the budget, the image size and the number of levels,
+            shrinking on out-of-memory errors and growing while there is headroom.
+          mask_nms_thresh (float): If >0, the mask IoU cutoff used by a final
+            non-maximal suppression that removes near-identical masks, e.g.
+            the same object predicted at several levels. Box NMS alone keeps
+            many of these because their boxes differ slightly.
         """
         self.level = [prompt_switch(l) for l in level]
         assert (points_per_side is None) != (
@@ -132,6 +159,7 @@ class SemanticSamAutomaticMaskGenerator:
             "binary_mask",
             "uncompressed_rle",
             "coco_rle",
+            "label_map",
         ], f"Unknown output_mode {output_mode}."
         if output_mode == "coco_rle":
             from pycocotools import mask as mask_utils  # type: ignore # noqa: F401
@@ -151,9 +179,11 @@ class SemanticSamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.mask_nms_thresh = mask_nms_thresh
+        self.batcher = MemoryBudgetBatcher(memory_budget) if memory_budget is not None else None
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(self, image: np.ndarray) -> AnnotationSet:
         """
         Generates masks for the given image.
 
@@ -161,8 +191,9 @@ class SemanticSamAutomaticMaskGenerator:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
 
         Returns:
-           list(dict(str, any)): A list over records for masks. Each record is
-             a dict containing the following keys:
+           AnnotationSet: The records for masks, stored column-wise. It
+             behaves as a list over dict-like records, each containing the
+             following keys:
                segmentation (dict(str, any) or np.ndarray): The mask. If
                  output_mode='binary_mask', is an array of shape HW. Otherwise,
                  is a dictionary containing the RLE.
@@ -176,11 +207,109 @@ class SemanticSamAutomaticMaskGenerator:
                  is filtered on using the stability_score_thresh parameter.
                crop_box (list(float)): The crop of the image used to generate
                  the mask, given in XYWH format.
+
+           If output_mode='label_map', returns (np.ndarray, AnnotationSet)
+             instead: an int32 HW map in which every pixel holds the label of
+             the smallest mask covering it (0 if none), and the records without
+             'segmentation', sorted by decreasing area and numbered from 1 in
+             their 'label' key.
         """
 
         # Generate masks
         mask_data = self._generate_masks(image)
+        mask_data = self._postprocess_masks(mask_data)
+        return self._write_mask_records(mask_data, image.shape[-2:])
+
+    @torch.no_grad()
+    def generate_stream(self, image: np.ndarray) -> Iterator[Tuple[AnnotationSet, bool]]:
+        """
+        Generates masks for the given image progressively.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+
+        Yields:
+          (AnnotationSet, bool): Mask records in the format returned by
+            generate, and whether they are final. Every point batch yields the
+            masks that passed its quality filters as provisional records; these
+            may still be removed by NMS or changed by small-region
+            postprocessing. The last item holds the final records, identical
+            to the output of generate.
+        """
+        for mask_data, is_final in self._generate_masks_stream(image):
+            if is_final:
+                mask_data = self._postprocess_masks(mask_data)
+            yield self._write_mask_records(mask_data, image.shape[-2:]), is_final
 
+    @torch.no_grad()
+    def generate_batch(self, images: List[torch.Tensor], batch_size: int = 4) -> List[Any]:
+        """
+        Generates masks for several images, running the image encoder on up
+        to batch_size images per call. Images that pad to the same size are
+        encoded together; the decoder of evaluate_demo takes one image per
+        call, so the point batches of each image then run on its slice of the
+        group's features. The results match calling generate on every image
+        up to the floating point differences of a batched backbone pass;
+        benchmark_semsam_batch.py measures both.
+
+        Arguments:
+          images (list(torch.Tensor)): The images to generate masks for, in
+            the format taken by generate.
+          batch_size (int): The maximum number of images encoded at once.
+
+        Returns:
+          list: The output of generate for every image, in input order.
+        """
+        results = [None] * len(images)
+        for group in self._group_images(images, batch_size):
+            features = self._encode_images([images[i] for i in group])
+            for j, i in enumerate(group):
+                enc_features = None
+                if features is not None:
+                    enc_features = (features[0][j:j + 1], [f[j:j + 1] for f in features[1]])
+                mask_data = self._generate_masks(images[i], enc_features)
+                mask_data = self._postprocess_masks(mask_data)
+                results[i] = self._write_mask_records(mask_data, images[i].shape[-2:])
+            del features
+        return results
+
+    def _group_images(self, images: List[torch.Tensor], batch_size: int) -> List[List[int]]:
+        # Group by the size images are padded to before the backbone
+        divisibility = getattr(self.predictor.model, "size_divisibility", 0)
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, image in enumerate(images):
+            h, w = image.shape[-2:]
+            if divisibility > 1:
+                h, w = math.ceil(h / divisibility) * divisibility, math.ceil(w / divisibility) * divisibility
+            groups.setdefault((h, w), []).append(i)
+        return [
+            group[start:start + batch_size]
+            for group in groups.values()
+            for start in range(0, len(group), batch_size)
+        ]
+
+    def _encode_images(self, images: List[torch.Tensor]):
+        """
+        Runs the backbone and pixel decoder on a group of images, and returns
+        (mask_features, multi_scale_features) batched over the group.
+        evaluate_demo only encodes one image per call, so this mirrors its
+        normalization, padding and pixel decoder call for the group; keep
+        the two in sync, and compare them with benchmark_semsam_batch.py
+        when updating Semantic-SAM. Returns None for a single image or a
+        model without these modules, in which case evaluate_demo encodes
+        the image itself.
+        """
+        model = self.predictor.model
+        required = ("backbone", "sem_seg_head", "pixel_mean", "pixel_std", "size_divisibility")
+        if len(images) == 1 or not all(hasattr(model, name) for name in required):
+            return None
+        images = [(x.to(model.device) - model.pixel_mean) / model.pixel_std for x in images]
+        images = ImageList.from_tensors(images, model.size_divisibility)
+        features = model.backbone(images.tensor)
+        mask_features, _, multi_scale_features = model.sem_seg_head.pixel_decoder.forward_features(features, None)
+        return mask_features, multi_scale_features
+
+    def _postprocess_masks(self, mask_data: MaskData) -> MaskData:
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
             mask_data = self.postprocess_small_regions(
@@ -188,6 +317,18 @@ class SemanticSamAutomaticMaskGenerator:
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
             )
+        # Remove near-identical masks predicted at different levels
+        if self.mask_nms_thresh > 0 and len(mask_data["rles"]) > 1:
+            keep_by_mask_nms = mask_nms(
+                mask_data["rles"],
+                mask_data["boxes"],
+                mask_data["iou_preds"],
+                self.mask_nms_thresh,
+            )
+            mask_data.filter(torch.as_tensor(keep_by_mask_nms))
+        return mask_data
+
+    def _write_mask_records(self, mask_data: MaskData, orig_size: Tuple[int, ...]):
         # Encode masks
         if self.output_mode == "coco_rle":
             mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
@@ -197,22 +338,24 @@ class SemanticSamAutomaticMaskGenerator:
             mask_data["segmentations"] = mask_data["rles"]
 
         # Write mask records
-        curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-                "predicted_iou": mask_data["iou_preds"][idx].item(),
-                "point_coords": [mask_data["points"][idx].tolist()],
-                "stability_score": mask_data["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-            }
-            curr_anns.append(ann)
+        curr_anns = AnnotationSet.from_mask_data(mask_data, mask_data["segmentations"])
+
+        if self.output_mode == "label_map":
+            # Paint by decreasing area so smaller masks stay visible
+            curr_anns = curr_anns.sort_by("area")
+            curr_anns.set_column("label", range(1, len(curr_anns) + 1))
+            label_map = rles_to_label_map(curr_anns.segmentations, orig_size)
+            curr_anns.segmentations = None
+            return label_map, curr_anns
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(self, image: np.ndarray, enc_features=None) -> MaskData:
+        for data, _ in self._generate_masks_stream(image, enc_features):
+            pass
+        return data
+
+    def _generate_masks_stream(self, image: np.ndarray, enc_features=None) -> Iterator[Tuple[MaskData, bool]]:
         orig_size = image.shape[-2:]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
@@ -223,9 +366,11 @@ class SemanticSamAutomaticMaskGenerator:
         data = MaskData()
         # import ipdb; ipdb.set_trace()
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-
-            data.cat(crop_data)
+            for crop_data, crop_done in self._process_crop_stream(image, crop_box, layer_idx, orig_size, enc_features):
+                if crop_done:
+                    data.cat(crop_data)
+                else:
+                    yield crop_data, False
         # import ipdb; ipdb.set_trace()
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -241,15 +386,21 @@ class SemanticSamAutomaticMaskGenerator:
             data.filter(keep_by_nms)
 
         data.to_numpy()
-        return data
+        yield data, True
 
-    def _process_crop(
+    def _process_crop_stream(
         self,
         image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
-    ) -> MaskData:
+        enc_features=None,
+    ) -> Iterator[Tuple[MaskData, bool]]:
+        """
+        Yields the masks of every point batch, in the original image frame,
+        followed by the deduplicated masks of the whole crop. enc_features
+        are precomputed encoder features for the crop, if any.
+        """
         # Crop the image and calculate embeddings
         x0, y0, x1, y1 = crop_box
         cropped_im = image#[y0:y1, x0:x1, :]
@@ -262,11 +413,13 @@ class SemanticSamAutomaticMaskGenerator:
 
         # Generate masks for this crop in batches
         data = MaskData()
-        self.enc_features=None
+        self.enc_features=enc_features
         # import ipdb; ipdb.set_trace()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(cropped_im,points, cropped_im_size, crop_box, orig_size)
+        for batch_data in self._process_point_batches(cropped_im, points_for_image, cropped_im_size, crop_box, orig_size):
             data.cat(batch_data)
+            batch_data["boxes"] = uncrop_boxes_xyxy(batch_data["boxes"], crop_box)
+            batch_data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(batch_data["rles"]))])
+            yield batch_data, False
             del batch_data
 
         keep_by_nms = batched_nms(
@@ -282,7 +435,47 @@ class SemanticSamAutomaticMaskGenerator:
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
 
-        return data
+        yield data, True
+
+    def _process_point_batches(
+        self,
+        images,
+        points_for_image: np.ndarray,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ):
+        """
+        Runs the points through _process_batch and yields the results. With a
+        memory budget the batch size is re-evaluated before every batch, and a
+        batch that runs out of memory is retried with fewer points.
+        """
+        if self.batcher is None:
+            for (points,) in batch_iterator(self.points_per_batch, points_for_image):
+                yield self._process_batch(images, points, im_size, crop_box, orig_size)
+            return
+
+        device = images.device
+        pixels_per_point = len(self.level) * int(im_size[0]) * int(im_size[1])
+        start = 0
+        while start < len(points_for_image):
+            points = points_for_image[start:start + self.batcher.batch_size(pixels_per_point)]
+            # the first batch also runs the image encoder, so it says little
+            # about the cost of a point
+            mem_start = reset_peak_memory(device) if self.enc_features is not None else None
+            try:
+                batch_data = self._process_batch(images, points, im_size, crop_box, orig_size)
+            except RuntimeError as e:
+                if not is_oom_error(e) or not self.batcher.backoff(len(points), pixels_per_point):
+                    raise
+                batch_data = None
+            if batch_data is None:
+                # free the failed batch only once the traceback is gone
+                release_memory(device)
+                continue
+            self.batcher.update(len(points), pixels_per_point, peak_memory_since(device, mem_start))
+            start += len(points)
+            yield batch_data
 
     def _process_batch(
         self,
@@ -307,37 +500,19 @@ class SemanticSamAutomaticMaskGenerator:
         else:
             masks, iou_preds= self.predictor.model.evaluate_demo(batch_inputs,None,None,self.enc_features[0],self.enc_features[1], level=self.level)
 
-        data = MaskData(
-            masks=masks,
-            iou_preds=iou_preds.flatten(),
-            points=torch.as_tensor(points[:,None].repeat(1,len(self.level), 1).view(-1,4)),
-        )
+        # Filter, threshold, box and RLE-encode the masks in one fused stage
+        data = MaskData(**postprocess_mask_batch(
+            masks,
+            iou_preds.flatten(),
+            torch.as_tensor(points[:,None].repeat(1,len(self.level), 1).view(-1,4)),
+            crop_box,
+            orig_size,
+            self.pred_iou_thresh,
+            self.stability_score_thresh,
+            self.stability_score_offset,
+            always_filter=True,
+        ))
         del masks
-        # Filter by predicted IoU
-        keep_mask = data["iou_preds"] > self.pred_iou_thresh
-        data.filter(keep_mask)
-
-        # Calculate stability score
-        data["stability_score"] = calculate_stability_score(
-            data["masks"], 0.0, self.stability_score_offset
-        )
-        # if self.stability_score_thresh > 0.0:
-        keep_mask = data["stability_score"] >= self.stability_score_thresh
-        data.filter(keep_mask)
-
-        # Threshold masks and calculate boxes
-        data["masks"] = data["masks"] > 0.0
-        data["boxes"] = batched_mask_to_box(data["masks"])
-
-        # Filter boxes that touch crop boundaries
-        keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
-        if not torch.all(keep_mask):
-            data.filter(keep_mask)
-
-        # Compress to RLE
-        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
-        del data["masks"]
 
         return data
 
@@ -5,10 +5,14 @@
 # Written by Hao Zhang (hzhangcx@connect.ust.hk)
 # --------------------------------------------------------
 
+import time
 import torch
 import numpy as np
 from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.generator_registry import generators
+from task_adapter.utils.pipeline import InferenceBackend, InferencePipeline
+from task_adapter.utils.presets import latency_tracker, num_prompts, resolve_preset
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -18,51 +22,32 @@ import io
 from .automatic_mask_generator import SemanticSamAutomaticMaskGenerator
 metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
-def inference_semsam_m2m_auto(model, image, level, all_classes, all_parts, thresh, text_size, hole_scale, island_scale, semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image)
+class SemanticSamAutoBackend(InferenceBackend):
+    """
+    Automatic multi-granularity mask generation with Semantic-SAM. The mask
+    generator runs the image encoder itself, so all model work is in decode.
+    """
 
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
+    def __init__(self, model, level, device=None, preset='balanced', latency_budget=None):
+        super().__init__(model, device)
+        self.level = level
+        self.preset = preset
+        self.latency_budget = latency_budget
 
-    mask_generator = SemanticSamAutomaticMaskGenerator(model,points_per_side=32,
-            pred_iou_thresh=0.88,
-            stability_score_thresh=0.92,
-            min_mask_region_area=10,
-            level=level,
+    def decode(self, ctx):
+        num_pixels = ctx.image_ori.shape[0] * ctx.image_ori.shape[1]
+        _, params, level = resolve_preset('semantic-sam', self.preset, self.latency_budget, self.level, num_pixels)
+        start = time.perf_counter()
+        mask_generator = ctx.resources.enter_context(
+            generators.acquire(SemanticSamAutomaticMaskGenerator, self.model, level=level, **params)
         )
-    outputs = mask_generator.generate(images)
+        ctx.annotations = mask_generator.generate(ctx.images)
+        latency_tracker.record('semantic-sam', num_prompts(params, level), num_pixels, time.perf_counter() - start)
 
-    from task_adapter.utils.visualizer import Visualizer
-    visual = Visualizer(image_ori, metadata=metadata)
-    sorted_anns = sorted(outputs, key=(lambda x: x['area']), reverse=True)
-    label = 1
-    # for ann in sorted_anns:
-    #     mask = ann['segmentation']
-    #     color_mask = np.random.random((1, 3)).tolist()[0]
-    #     # color_mask = [int(c*255) for c in color_mask]
-    #     demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-    #     label += 1
-    # im = demo.get_image()
 
-    mask_map = np.zeros(image_ori.shape, dtype=np.uint8)    
-    for i, ann in enumerate(sorted_anns):
-        mask = ann['segmentation']
-        color_mask = np.random.random((1, 3)).tolist()[0]
-        # color_mask = [int(c*255) for c in color_mask]
-        demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode=label_mode, alpha=alpha, anno_mode=anno_mode)
-        # assign the mask to the mask_map
-        mask_map[mask == 1] = label
-        label += 1
-    im = demo.get_image()    
-    # fig=plt.figure(figsize=(10, 10))
-    # plt.imshow(image_ori)
-    # show_anns(outputs)
-    # fig.canvas.draw()
-    # im=Image.frombytes('RGB', fig.canvas.get_width_height(), fig.canvas.tostring_rgb())
-    return im, sorted_anns
+def inference_semsam_m2m_auto(model, image, level, all_classes, all_parts, thresh, text_size, hole_scale, island_scale, semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None, preset='balanced', latency_budget=None, hierarchy=False, hooks=()):
+    pipeline = InferencePipeline(SemanticSamAutoBackend(model, level, device, preset, latency_budget), hooks)
+    return pipeline(image, text_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, hierarchy=hierarchy)
 
 
 def remove_small_regions(
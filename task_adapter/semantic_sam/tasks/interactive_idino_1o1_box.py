@@ -7,8 +7,9 @@
 
 import torch
 import numpy as np
-from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.device import get_device
+from task_adapter.utils.resize import resize_image
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -17,16 +18,12 @@ from semantic_sam.utils import box_ops
 
 metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
-def interactive_infer_image_box(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image['image'])
-    mask_ori = transform1(image['mask'])
-    width = image_ori.size[0]
-    height = image_ori.size[1]
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
+def interactive_infer_image_box(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, device=None):
+    device = get_device(model, device)
+    image_ori = resize_image(image['image'], text_size)
+    mask_ori = resize_image(image['mask'], text_size)
+    height, width = image_ori.shape[:2]
+    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).to(device)
     all_classes, all_parts=all_classes.strip().strip("\"[]").split(':'),all_parts.strip().strip("\"[]").split(':')
 
 
@@ -44,7 +41,7 @@ def interactive_infer_image_box(model, image,all_classes,all_parts, thresh,text_
         box_xyxy = BitMasks(flaten_mask > 0).get_bounding_boxes().tensor
         h = mask_ori.shape[0]
         w = mask_ori.shape[1]
-        box_xywh = (box_ops.box_xyxy_to_cxcywh(box_xyxy) / torch.as_tensor([w, h, w, h])).cuda()
+        box_xywh = (box_ops.box_xyxy_to_cxcywh(box_xyxy) / torch.as_tensor([w, h, w, h])).to(device)
 
         # point_=points.mean(0)[None]
         # point=point_.clone()
@@ -7,23 +7,20 @@
 
 import torch
 import numpy as np
-from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.device import get_device
+from task_adapter.utils.resize import resize_image
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
 metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
-def interactive_infer_image(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, label_mode='1', alpha=0.1, anno_mode=['Mask']):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image['image'])
-    mask_ori = transform1(image['mask'])
-    width = image_ori.size[0]
-    height = image_ori.size[1]
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
+def interactive_infer_image(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, label_mode='1', alpha=0.1, anno_mode=['Mask'], device=None):
+    device = get_device(model, device)
+    image_ori = resize_image(image['image'], text_size)
+    mask_ori = resize_image(image['mask'], text_size)
+    height, width = image_ori.shape[:2]
+    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).to(device)
     all_classes, all_parts=all_classes.strip().strip("\"[]").split(':'),all_parts.strip().strip("\"[]").split(':')
 
 
@@ -106,16 +103,12 @@ def interactive_infer_image(model, image,all_classes,all_parts, thresh,text_size
 
     return reses,[reses[i] for i in ids]
 
-def interactive_infer_image_3l(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image['image'])
-    mask_ori = transform1(image['mask'])
-    width = image_ori.size[0]
-    height = image_ori.size[1]
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
+def interactive_infer_image_3l(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, device=None):
+    device = get_device(model, device)
+    image_ori = resize_image(image['image'], text_size)
+    mask_ori = resize_image(image['mask'], text_size)
+    height, width = image_ori.shape[:2]
+    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).to(device)
     all_classes, all_parts=all_classes.strip().strip("\"[]").split(':'),all_parts.strip().strip("\"[]").split(':')
 
 
@@ -203,16 +196,12 @@ def interactive_infer_image_3l(model, image,all_classes,all_parts, thresh,text_s
 
     return reses,[reses[i] for i in ids]
 
-def interactive_infer_image_semantic(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None):
-    t = []
-    t.append(transforms.Resize(int(text_size), interpolation=Image.BICUBIC))
-    transform1 = transforms.Compose(t)
-    image_ori = transform1(image['image'])
-    mask_ori = transform1(image['mask'])
-    width = image_ori.size[0]
-    height = image_ori.size[1]
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
+def interactive_infer_image_semantic(model, image,all_classes,all_parts, thresh,text_size,hole_scale,island_scale,semantic, refimg=None, reftxt=None, audio_pth=None, video_pth=None, device=None):
+    device = get_device(model, device)
+    image_ori = resize_image(image['image'], text_size)
+    mask_ori = resize_image(image['mask'], text_size)
+    height, width = image_ori.shape[:2]
+    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).to(device)
     all_classes, all_parts=all_classes.strip().strip("\"[]").split(':'),all_parts.strip().strip("\"[]").split(':')
 
 
@@ -1,7 +1,11 @@
+import threading
 import torch
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from torchvision import transforms
 from task_adapter.utils.visualizer import Visualizer
+from task_adapter.utils.device import get_device
+from task_adapter.utils.mask_nms import packed_iou_matrix
 from typing import Tuple
 from PIL import Image
 from detectron2.data import MetadataCatalog
@@ -9,19 +13,33 @@ metadata = MetadataCatalog.get('coco_2017_train_panoptic')
 
 
 class SemanticSAMPredictor:
-    def __init__(self, model, thresh=0.5, text_size=640, hole_scale=100, island_scale=100):
+    def __init__(self, model, thresh=0.5, text_size=640, hole_scale=100, island_scale=100, device=None):
         """
         thresh: iou thresh to filter low confidence objects
         text_size: resize the input image short edge for the model to process
         hole_scale: fill in small holes as in SAM
         island_scale: remove small regions as in SAM
+        device: device for the prompts, defaults to the device of the model
         """
         self.model = model
+        self.device = get_device(model, device)
         self.thresh = thresh
         self.text_size = hole_scale
         self.hole_scale = hole_scale
         self.island_scale = island_scale
         self.point = None
+        # cleans up the up to 6 candidates of a click, started on first use
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def close(self):
+        """
+        Stops the threads that clean up candidate masks.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
 
     def predict(self, image_ori, image, point=None):
         """
@@ -33,9 +51,9 @@ class SemanticSAMPredictor:
         data = {"image": image, "height": height, "width": width}
         # import ipdb; ipdb.set_trace()
         if point is None:
-            point = torch.tensor([[0.5, 0.5, 0.006, 0.006]]).cuda()
+            point = torch.tensor([[0.5, 0.5, 0.006, 0.006]], device=self.device)
         else:
-            point = torch.tensor(point).cuda()
+            point = torch.tensor(point, device=self.device)
             point_ = point
             point = point_.clone()
             point[0, 0] = point_[0, 0]
@@ -55,58 +73,66 @@ class SemanticSAMPredictor:
         return masks, ious
 
     def process_multi_mask(self, masks, ious, image_ori):
-        pred_masks_poses = masks
-        reses = []
+        """
+        Renders the candidates of one click, best first, skipping those below
+        thresh and near-duplicates (IoU > 0.95) of better ones. Returns the
+        renderings by decreasing IoU and by increasing area.
+        """
         ious = ious[0, 0]
         ids = torch.argsort(ious, descending=True)
+        ious = [round(float(iou), 2) for iou in ious[ids]]
+        # one transfer for all candidates
+        masks = (masks[ids] > 0.0).cpu().numpy()
+        pairwise = packed_iou_matrix(masks)
 
-        text_res = ''
-        mask_ls = []
-        ious_res = []
-        areas = []
-        for i, (pred_masks_pos, iou) in enumerate(zip(pred_masks_poses[ids], ious[ids])):
-            iou = round(float(iou), 2)
-            texts = f'{iou}'
-            mask = (pred_masks_pos > 0.0).cpu().numpy()
-            area = mask.sum()
-            conti = False
-            if iou < self.thresh:
-                conti = True
-            for m in mask_ls:
-                if np.logical_and(mask, m).sum() / np.logical_or(mask, m).sum() > 0.95:
-                    conti = True
-                    break
-            if i == len(pred_masks_poses[ids]) - 1 and mask_ls == []:
+        kept = []
+        for i, iou in enumerate(ious):
+            conti = iou < self.thresh or any(pairwise[i, k] > 0.95 for k in kept)
+            if i == len(ious) - 1 and kept == []:
                 conti = False
-            if conti:
-                continue
-            ious_res.append(iou)
-            mask_ls.append(mask)
-            areas.append(area)
-            mask, _ = self.remove_small_regions(mask, int(self.hole_scale), mode="holes")
-            mask, _ = self.remove_small_regions(mask, int(self.island_scale), mode="islands")
-            mask = (mask).astype(np.float)
-            out_txt = texts
-            visual = Visualizer(image_ori, metadata=metadata)
-            color = [0., 0., 1.0]
-            demo = visual.draw_binary_mask(mask, color=color, text=texts)
+            if not conti:
+                kept.append(i)
+        areas = [int(masks[i].sum()) for i in kept]
+
+        # cv2 releases the GIL, so the candidates are cleaned up in parallel
+        cleaned = list(self._postprocess_pool().map(self._fill_and_prune, [masks[i] for i in kept]))
+
+        # one figure with the image drawn once; every candidate's artists are
+        # removed again after it is rendered
+        visual = Visualizer(image_ori, metadata=metadata)
+        ax = visual.output.ax
+        base = set(ax.get_children())
+        point_x0 = max(0, int(self.point[0, 0]) - 3)
+        point_x1 = min(image_ori.shape[1], int(self.point[0, 0]) + 3)
+        point_y0 = max(0, int(self.point[0, 1]) - 3)
+        point_y1 = min(image_ori.shape[0], int(self.point[0, 1]) + 3)
+        color = [0., 0., 1.0]
+        reses = []
+        for i, mask in zip(kept, cleaned):
+            demo = visual.draw_binary_mask(mask, color=color, text=f'{ious[i]}')
             res = demo.get_image()
-            point_x0 = max(0, int(self.point[0, 0]) - 3)
-            point_x1 = min(image_ori.shape[1], int(self.point[0, 0]) + 3)
-            point_y0 = max(0, int(self.point[0, 1]) - 3)
-            point_y1 = min(image_ori.shape[0], int(self.point[0, 1]) + 3)
-            res[point_y0:point_y1, point_x0:point_x1, 0] = 255
-            res[point_y0:point_y1, point_x0:point_x1, 1] = 0
-            res[point_y0:point_y1, point_x0:point_x1, 2] = 0
+            for artist in ax.get_children():
+                if artist not in base:
+                    artist.remove()
+            res[point_y0:point_y1, point_x0:point_x1] = [255, 0, 0]
             reses.append(Image.fromarray(res))
-            text_res = text_res + ';' + out_txt
-        ids = list(torch.argsort(torch.tensor(areas), descending=False))
-        ids = [int(i) for i in ids]
+        ids = [int(i) for i in np.argsort(areas, kind='stable')]
 
         torch.cuda.empty_cache()
 
         return reses, [reses[i] for i in ids]
 
+    def _postprocess_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=6)
+            return self._pool
+
+    def _fill_and_prune(self, mask):
+        mask, _ = self.remove_small_regions(mask, int(self.hole_scale), mode="holes")
+        mask, _ = self.remove_small_regions(mask, int(self.island_scale), mode="islands")
+        return mask.astype(np.uint8)
+
     def predict_masks(self, image_ori, image, point=None):
         masks, ious = self.predict(image_ori, image, point)
         return self.process_multi_mask(masks, ious, image_ori)
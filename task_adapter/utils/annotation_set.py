@@ -0,0 +1,306 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+# Record key -> column holding it
+_COLUMNS = {
+    "area": "areas",
+    "bbox": "boxes",
+    "predicted_iou": "predicted_ious",
+    "point_coords": "point_coords",
+    "stability_score": "stability_scores",
+    "crop_box": "crop_boxes",
+}
+_MISSING = object()
+
+
+def _numpy(x: Any) -> np.ndarray:
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _xyxy_to_xywh(boxes: np.ndarray) -> np.ndarray:
+    boxes = np.array(boxes).reshape(-1, 4)
+    boxes[:, 2:] -= boxes[:, :2]
+    return boxes
+
+
+class AnnotationSet:
+    """
+    Mask records stored column-wise: one NumPy array per field instead of
+    one dict per mask, so sorting, filtering and top-k are single array
+    operations however many masks there are.
+
+    For existing callers it behaves like the list of records the generators
+    used to return: len(), iteration and integer indexing give
+    AnnotationRecord views that read and write the columns through the
+    usual keys ('segmentation', 'area', 'bbox', 'predicted_iou',
+    'point_coords', 'stability_score', 'crop_box'). Other keys set on a
+    record, like 'label', are kept in per-set extra columns. Indexing with
+    a slice, an index array or a boolean mask returns a new AnnotationSet.
+
+    segmentations is a list, since masks and RLEs differ in size, or None
+    if the records carry no 'segmentation'.
+    """
+
+    __slots__ = (
+        "segmentations",
+        "areas",
+        "boxes",
+        "predicted_ious",
+        "point_coords",
+        "stability_scores",
+        "crop_boxes",
+        "extra",
+    )
+
+    def __init__(
+        self,
+        segmentations: Optional[List[Any]],
+        areas: np.ndarray,
+        boxes: np.ndarray,
+        predicted_ious: np.ndarray,
+        point_coords: np.ndarray,
+        stability_scores: np.ndarray,
+        crop_boxes: np.ndarray,
+        extra: Optional[Dict[str, List[Any]]] = None,
+    ) -> None:
+        self.segmentations = segmentations
+        self.areas = areas
+        self.boxes = boxes
+        self.predicted_ious = predicted_ious
+        self.point_coords = point_coords
+        self.stability_scores = stability_scores
+        self.crop_boxes = crop_boxes
+        self.extra = {} if extra is None else extra
+
+    @classmethod
+    def from_mask_data(cls, mask_data, segmentations: Optional[List[Any]] = None) -> "AnnotationSet":
+        """
+        Builds the records of a MaskData with 'rles', XYXY 'boxes',
+        'iou_preds', 'points', 'stability_score' and 'crop_boxes'. Boxes are
+        converted to XYWH like in the records.
+        """
+        rles = mask_data["rles"]
+        return cls(
+            segmentations=list(segmentations) if segmentations is not None else None,
+            areas=np.array([sum(rle["counts"][1::2]) for rle in rles], dtype=np.int64),
+            boxes=_xyxy_to_xywh(_numpy(mask_data["boxes"])),
+            predicted_ious=_numpy(mask_data["iou_preds"]).reshape(-1),
+            point_coords=_numpy(mask_data["points"]),
+            stability_scores=_numpy(mask_data["stability_score"]).reshape(-1),
+            crop_boxes=_xyxy_to_xywh(_numpy(mask_data["crop_boxes"])),
+        )
+
+    @classmethod
+    def from_records(cls, anns: Sequence[Dict[str, Any]]) -> "AnnotationSet":
+        """
+        Builds a set from a list of record dicts, e.g. the output of
+        segment_anything's SamAutomaticMaskGenerator.
+        """
+        n = len(anns)
+        extra_keys = {k for ann in anns for k in ann if k != "segmentation" and k not in _COLUMNS}
+        return cls(
+            segmentations=[ann["segmentation"] for ann in anns] if all("segmentation" in ann for ann in anns) else None,
+            areas=np.array([ann["area"] for ann in anns], dtype=np.int64),
+            boxes=np.array([ann["bbox"] for ann in anns]).reshape(n, 4),
+            predicted_ious=np.array([ann.get("predicted_iou", 1.0) for ann in anns], dtype=np.float32),
+            point_coords=np.array([ann.get("point_coords", [[0.0, 0.0]])[0] for ann in anns], dtype=np.float32).reshape(n, -1 if n else 2),
+            stability_scores=np.array([ann.get("stability_score", 1.0) for ann in anns], dtype=np.float32),
+            crop_boxes=np.array([ann.get("crop_box", [0, 0, 0, 0]) for ann in anns]).reshape(n, 4),
+            extra={k: [ann.get(k, _MISSING) for ann in anns] for k in extra_keys},
+        )
+
+    @classmethod
+    def concat(cls, sets: Sequence["AnnotationSet"]) -> "AnnotationSet":
+        """
+        Returns the records of several sets, in order. Extra keys missing
+        from some of the sets are missing from their records.
+        """
+        sets = list(sets)
+        if not sets:
+            return cls(
+                segmentations=[],
+                areas=np.zeros(0, dtype=np.int64),
+                boxes=np.zeros((0, 4), dtype=np.int64),
+                predicted_ious=np.zeros(0, dtype=np.float32),
+                point_coords=np.zeros((0, 2), dtype=np.float32),
+                stability_scores=np.zeros(0, dtype=np.float32),
+                crop_boxes=np.zeros((0, 4), dtype=np.int64),
+            )
+        extra_keys = list(dict.fromkeys(k for s in sets for k in s.extra))
+        has_segmentations = all(s.segmentations is not None for s in sets)
+        return cls(
+            segmentations=[m for s in sets for m in s.segmentations] if has_segmentations else None,
+            areas=np.concatenate([s.areas for s in sets]),
+            boxes=np.concatenate([s.boxes for s in sets]),
+            predicted_ious=np.concatenate([s.predicted_ious for s in sets]),
+            point_coords=np.concatenate([s.point_coords for s in sets]),
+            stability_scores=np.concatenate([s.stability_scores for s in sets]),
+            crop_boxes=np.concatenate([s.crop_boxes for s in sets]),
+            extra={k: [v for s in sets for v in s.extra.get(k, [_MISSING] * len(s))] for k in extra_keys},
+        )
+
+    def __len__(self) -> int:
+        return len(self.areas)
+
+    def __iter__(self) -> Iterator["AnnotationRecord"]:
+        return (AnnotationRecord(self, i) for i in range(len(self)))
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray, List[int]]):
+        if isinstance(index, (int, np.integer)):
+            if not -len(self) <= index < len(self):
+                raise IndexError("AnnotationSet index out of range")
+            return AnnotationRecord(self, int(index) % len(self))
+        return self.take(np.arange(len(self))[index])
+
+    def __repr__(self) -> str:
+        return f"AnnotationSet(num_masks={len(self)}, extra={sorted(self.extra)})"
+
+    def column(self, key: str) -> Union[np.ndarray, List[Any]]:
+        """
+        Returns the values of a record key for all records: an array for the
+        standard keys, a list for 'segmentation' and extra keys.
+        """
+        if key == "segmentation":
+            return self.segmentations
+        if key in _COLUMNS:
+            return getattr(self, _COLUMNS[key])
+        return self.extra[key]
+
+    def set_column(self, key: str, values: Sequence[Any]) -> None:
+        assert len(values) == len(self), f"Column {key} needs {len(self)} values."
+        if key == "segmentation":
+            self.segmentations = list(values)
+        elif key in _COLUMNS:
+            setattr(self, _COLUMNS[key], np.asarray(values))
+        else:
+            self.extra[key] = list(values)
+
+    def take(self, idx: np.ndarray) -> "AnnotationSet":
+        """
+        Returns the records at the given indices, in that order.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        index_list = idx.tolist()
+        return AnnotationSet(
+            segmentations=[self.segmentations[i] for i in index_list] if self.segmentations is not None else None,
+            areas=self.areas[idx],
+            boxes=self.boxes[idx],
+            predicted_ious=self.predicted_ious[idx],
+            point_coords=self.point_coords[idx],
+            stability_scores=self.stability_scores[idx],
+            crop_boxes=self.crop_boxes[idx],
+            extra={k: [v[i] for i in index_list] for k, v in self.extra.items()},
+        )
+
+    def sort_by(self, key: str = "area", descending: bool = True) -> "AnnotationSet":
+        """
+        Returns the records sorted by a standard key. The sort is stable, so
+        the result matches sorted(anns, key=lambda x: x[key], reverse=descending).
+        """
+        values = self.column(key)
+        order = np.argsort(-values if descending else values, kind="stable")
+        return self.take(order)
+
+    def filter(self, keep: np.ndarray) -> "AnnotationSet":
+        """
+        Returns the records where the boolean array keep is True.
+        """
+        return self.take(np.nonzero(np.asarray(keep, dtype=bool))[0])
+
+    def top_k(self, k: int, key: str = "predicted_iou") -> "AnnotationSet":
+        """
+        Returns the k records with the highest values of a standard key,
+        in decreasing order.
+        """
+        values = self.column(key)
+        if k < len(self):
+            candidates = np.argpartition(-values, k - 1)[:k]
+            # keep ties in input order, like a stable sort would
+            candidates = np.sort(candidates)
+        else:
+            candidates = np.arange(len(self))
+        return self.take(candidates[np.argsort(-values[candidates], kind="stable")])
+
+    def to_records(self) -> List[Dict[str, Any]]:
+        """
+        Returns the records as plain dicts, e.g. for serialization.
+        """
+        return [dict(record) for record in self]
+
+
+class AnnotationRecord(MutableMapping):
+    """
+    Dict-like view of one record of an AnnotationSet. Values are converted
+    to Python types on access, matching the dicts the generators used to
+    return.
+    """
+
+    __slots__ = ("_set", "_index")
+
+    def __init__(self, annotations: AnnotationSet, index: int) -> None:
+        self._set = annotations
+        self._index = index
+
+    def __getitem__(self, key: str) -> Any:
+        s, i = self._set, self._index
+        if key == "segmentation":
+            if s.segmentations is None:
+                raise KeyError(key)
+            return s.segmentations[i]
+        if key == "area":
+            return int(s.areas[i])
+        if key in ("predicted_iou", "stability_score"):
+            return float(getattr(s, _COLUMNS[key])[i])
+        if key == "point_coords":
+            return [s.point_coords[i].tolist()]
+        if key in _COLUMNS:
+            return getattr(s, _COLUMNS[key])[i].tolist()
+        value = s.extra.get(key, None)
+        if value is None or value[i] is _MISSING:
+            raise KeyError(key)
+        return value[i]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        s, i = self._set, self._index
+        if key == "segmentation":
+            if s.segmentations is None:
+                s.segmentations = [None] * len(s)
+            s.segmentations[i] = value
+        elif key == "point_coords":
+            s.point_coords[i] = value[0]
+        elif key in _COLUMNS:
+            getattr(s, _COLUMNS[key])[i] = value
+        else:
+            s.extra.setdefault(key, [_MISSING] * len(s))[i] = value
+
+    def __delitem__(self, key: str) -> None:
+        s, i = self._set, self._index
+        if key == "segmentation" or key in _COLUMNS or key not in self:
+            raise KeyError(key)
+        s.extra[key][i] = _MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        s, i = self._set, self._index
+        if s.segmentations is not None:
+            yield "segmentation"
+        yield from _COLUMNS
+        for key, values in s.extra.items():
+            if values[i] is not _MISSING:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr({key: self[key] for key in self if key != "segmentation"})
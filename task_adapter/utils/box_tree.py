@@ -0,0 +1,98 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import math
+
+import numpy as np
+
+from typing import List, Tuple
+
+
+class BoxTree:
+    """
+    Static R-tree over Nx4 inclusive XYXY boxes, packed with the
+    sort-tile-recursive method. A query visits O(log N) levels and only the
+    nodes overlapping the query box, so finding the k boxes that intersect
+    a box costs O(log N + k) rather than O(N). query_all runs many queries
+    with a few array operations per level.
+
+    Arguments:
+      boxes (np.ndarray): The boxes, Nx4 in inclusive XYXY format.
+      node_size (int): The number of children of a node.
+    """
+
+    def __init__(self, boxes: np.ndarray, node_size: int = 8) -> None:
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self._levels = self._build(node_size)
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def _build(self, node_size: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # Leaves are the boxes, tiled by center in x, then in y within every
+        # vertical slice. Every level stores its node boxes and the start of
+        # each node's children in the level below; the children of a node
+        # are contiguous.
+        n = len(self.boxes)
+        if n == 0:
+            return []
+        num_leaves = math.ceil(n / node_size)
+        num_slices = math.ceil(math.sqrt(num_leaves))
+        slice_len = num_slices * node_size
+        centers = self.boxes[:, :2] + self.boxes[:, 2:]
+        order = np.argsort(centers[:, 0], kind="stable")
+        for start in range(0, n, slice_len):
+            chunk = order[start:start + slice_len]
+            order[start:start + slice_len] = chunk[np.argsort(centers[chunk, 1], kind="stable")]
+        self._leaf_order = order
+
+        levels = []
+        boxes = self.boxes[order]
+        while True:
+            starts = np.arange(0, len(boxes), node_size)
+            node_boxes = np.concatenate([
+                np.minimum.reduceat(boxes[:, :2], starts),
+                np.maximum.reduceat(boxes[:, 2:], starts),
+            ], axis=1)
+            levels.append((node_boxes, starts))
+            if len(node_boxes) == 1:
+                break
+            boxes = node_boxes
+        return levels[::-1]
+
+    def query(self, box: np.ndarray) -> np.ndarray:
+        """
+        Returns the indices of the boxes that intersect the inclusive XYXY box.
+        """
+        return self.query_all(np.asarray(box).reshape(1, 4))[1]
+
+    def query_all(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Runs the queries of Mx4 inclusive XYXY boxes at once, walking the tree
+        level by level for all of them. Returns (query index, box index) for
+        every intersecting pair.
+        """
+        queries = np.asarray(queries).reshape(-1, 4)
+        if not self._levels:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+        q = np.arange(len(queries))
+        nodes = np.zeros(len(queries), dtype=np.int64)
+        for depth, (node_boxes, starts) in enumerate(self._levels):
+            hit = _intersect(node_boxes[nodes], queries[q])
+            q, nodes = q[hit], nodes[hit]
+            # Expand the surviving nodes into their children in the level below
+            num_below = len(self._levels[depth + 1][0]) if depth + 1 < len(self._levels) else len(self.boxes)
+            ends = np.append(starts[1:], num_below)
+            lengths = ends[nodes] - starts[nodes]
+            q = np.repeat(q, lengths)
+            nodes = np.repeat(starts[nodes] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        leaves = self._leaf_order[nodes]
+        hit = _intersect(self.boxes[leaves], queries[q])
+        return q[hit], leaves[hit]
+
+
+def _intersect(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return (a[:, 0] <= b[:, 2]) & (a[:, 2] >= b[:, 0]) & (a[:, 1] <= b[:, 3]) & (a[:, 3] >= b[:, 1])
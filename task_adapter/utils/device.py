@@ -0,0 +1,53 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import os
+from typing import Optional, Union
+
+import torch
+
+_cpu_threads_configured = False
+
+
+def get_device(model=None, device: Optional[Union[str, torch.device]] = None) -> torch.device:
+    """
+    Resolves the device the task adapters run on. In order of precedence:
+    the explicit device, to which the model is moved if its parameters are
+    elsewhere, the device of the model's parameters, the SOM_DEVICE
+    environment variable, and finally CUDA if it is available, else CPU.
+    Inputs thus always end up on the device of the weights. The first time
+    CPU is picked, SOM_NUM_THREADS is applied if it is set.
+    """
+    params = next(iter(model.parameters()), None) if hasattr(model, "parameters") else None
+    if device is not None:
+        device = torch.device(device)
+        if params is not None and params.device != device:
+            model.to(device)
+    elif params is not None:
+        device = params.device
+    elif os.environ.get("SOM_DEVICE"):
+        device = torch.device(os.environ["SOM_DEVICE"])
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if device.type == "cpu" and not _cpu_threads_configured:
+        set_cpu_threads()
+    return device
+
+
+def set_cpu_threads(num_threads: Optional[int] = None) -> int:
+    """
+    Sets the number of threads used for intra-op parallelism on CPU, from
+    num_threads or the SOM_NUM_THREADS environment variable, and returns the
+    number in effect. Leaves the torch default (one per physical core) if
+    neither is given.
+    """
+    global _cpu_threads_configured
+    _cpu_threads_configured = True
+    if num_threads is None and os.environ.get("SOM_NUM_THREADS"):
+        num_threads = int(os.environ["SOM_NUM_THREADS"])
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
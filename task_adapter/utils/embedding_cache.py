@@ -0,0 +1,94 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+def image_digest(image: np.ndarray) -> Tuple[str, Tuple[int, ...]]:
+    """
+    Returns a key identifying an image array by content and resolution.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).hexdigest(), image.shape
+
+
+class EmbeddingCache:
+    """
+    Keeps image encoder outputs across requests, so a follow-up request on
+    the same image, e.g. one more interactive stroke, only runs the prompt
+    encoder and the mask decoder.
+
+    Entries are evicted least recently used first once they take more than
+    max_bytes, or there are more than max_entries of them. Keys include the
+    model, which the entries keep alive.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, max_entries: int = 32) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+
+def set_image_cached(predictor, image: np.ndarray, cache: Optional[EmbeddingCache] = None) -> bool:
+    """
+    Like SamPredictor.set_image, but takes the image embedding from cache if
+    the same image was set before on a predictor of the same model, and
+    stores it there otherwise. Returns True on a cache hit.
+    """
+    cache = sam_embeddings if cache is None else cache
+    key = (predictor.model, image_digest(image))
+    cached = cache.get(key)
+    if cached is not None:
+        predictor.reset_image()
+        predictor.features, predictor.original_size, predictor.input_size = cached
+        predictor.is_image_set = True
+        return True
+    predictor.set_image(image)
+    features = predictor.features
+    cache.put(key, (features, predictor.original_size, predictor.input_size), features.numel() * features.element_size())
+    return False
+
+
+# SAM ViT image embeddings, 4 MB each in float32
+sam_embeddings = EmbeddingCache()
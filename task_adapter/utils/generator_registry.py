@@ -0,0 +1,84 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import copy
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, Iterator, List, Tuple
+
+
+def _hashable(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+class GeneratorRegistry:
+    """
+    Keeps the mask generators of the task adapters alive across requests.
+
+    A generator is built once per (class, model, configuration). Generators
+    keep per-call state, such as the encoder features of the current image
+    or the image set on a SamPredictor, so one instance serves one request
+    at a time: concurrent requests for the same configuration get shallow
+    copies of the first instance. The copies share its point grids, kernels
+    and model, and only get their own predictor state and batch sizer. Idle
+    instances are reused, so a configuration ends up with as many instances
+    as it had concurrent requests.
+    """
+
+    def __init__(self) -> None:
+        self._templates: Dict[Tuple, Any] = {}
+        self._idle: Dict[Tuple, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, generator_cls, model, **kwargs) -> Iterator[Any]:
+        """
+        Yields a generator_cls(model, **kwargs) that is not in use by another
+        thread, and returns it to the registry afterwards.
+        """
+        key = (generator_cls, id(model), _hashable(kwargs))
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            generator = idle.pop() if idle else None
+            template = self._templates.get(key)
+        if generator is None:
+            if template is None:
+                generator = generator_cls(model, **kwargs)
+                with self._lock:
+                    # keep the model alive as long as its id is used in the key
+                    template = self._templates.setdefault(key, (model, generator))
+                if template[1] is not generator:
+                    generator = _clone(template[1])
+            else:
+                generator = _clone(template[1])
+        try:
+            yield generator
+        finally:
+            with self._lock:
+                self._idle[key].append(generator)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._templates.clear()
+            self._idle.clear()
+
+
+def _clone(generator: Any) -> Any:
+    clone = copy.copy(generator)
+    # SamPredictor holds the features of the image set on it
+    if hasattr(clone.predictor, "reset_image"):
+        clone.predictor = copy.copy(clone.predictor)
+        clone.predictor.reset_image()
+    if getattr(clone, "batcher", None) is not None:
+        clone.batcher = copy.copy(clone.batcher)
+    return clone
+
+
+generators = GeneratorRegistry()
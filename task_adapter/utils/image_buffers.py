@@ -0,0 +1,119 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+def resized_size(size: Tuple[int, int], short_side: int) -> Tuple[int, int]:
+    """
+    Returns the (height, width) transforms.Resize(short_side) resizes a PIL
+    image of (width, height) size to: the short side becomes short_side and
+    the long side keeps the aspect ratio, rounded down.
+    """
+    w, h = size
+    if w <= h:
+        return int(short_side * h / w), short_side
+    return short_side, int(short_side * w / h)
+
+
+class ImageBuffer:
+    """
+    A preallocated HxWx3 uint8 image, in page-locked host memory when the
+    device is CUDA, plus its device copy. array and host share memory, and
+    tensor() returns a CHW view, so resizing into array is the only host
+    copy a request makes. Call wait() before writing array.
+    """
+
+    def __init__(self, height: int, width: int, device: torch.device) -> None:
+        self.device = device
+        pin = device.type == "cuda"
+        self.host = torch.empty((height, width, 3), dtype=torch.uint8, pin_memory=pin)
+        self.array = self.host.numpy()
+        self._device_host = torch.empty_like(self.host, device=device) if pin else self.host
+        self._uploaded: Optional[torch.cuda.Event] = None
+
+    @property
+    def nbytes(self) -> int:
+        return self.host.numel() * (2 if self._device_host is not self.host else 1)
+
+    def wait(self) -> None:
+        """
+        Blocks until the last upload from the buffer is done, so the host
+        side can be written again.
+        """
+        if self._uploaded is not None:
+            self._uploaded.synchronize()
+            self._uploaded = None
+
+    def tensor(self) -> torch.Tensor:
+        """
+        Returns the image as a CHW view on the device, copying it there
+        asynchronously if the device is not the CPU.
+        """
+        if self._device_host is not self.host:
+            self._device_host.copy_(self.host, non_blocking=True)
+            self._uploaded = torch.cuda.Event()
+            self._uploaded.record()
+        return self._device_host.permute(2, 0, 1)
+
+
+class ImageBufferPool:
+    """
+    Reuses ImageBuffers across requests, keyed by image size and device, so
+    the pinned host memory and the device copy are allocated once per size
+    instead of once per request. A buffer serves one request at a time.
+    Idle buffers beyond max_idle_bytes are freed, least recently used first.
+    """
+
+    def __init__(self, max_idle_bytes: int = 256 * 1024 * 1024) -> None:
+        self.max_idle_bytes = max_idle_bytes
+        self._idle: "OrderedDict[Tuple, List[ImageBuffer]]" = OrderedDict()
+        self._idle_bytes = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, height: int, width: int, device: torch.device) -> Iterator[ImageBuffer]:
+        """
+        Yields an ImageBuffer of the given size that is not in use by another
+        request, and returns it to the pool afterwards. Views of the buffer
+        must not be used after that.
+        """
+        key = (height, width, str(device))
+        with self._lock:
+            idle = self._idle.get(key)
+            buffer = idle.pop() if idle else None
+            if buffer is not None:
+                self._idle_bytes -= buffer.nbytes
+                if not idle:
+                    del self._idle[key]
+        if buffer is None:
+            buffer = ImageBuffer(height, width, device)
+        try:
+            yield buffer
+        finally:
+            with self._lock:
+                self._idle.setdefault(key, []).append(buffer)
+                self._idle.move_to_end(key)
+                self._idle_bytes += buffer.nbytes
+                while self._idle_bytes > self.max_idle_bytes and self._idle:
+                    oldest_key, oldest = next(iter(self._idle.items()))
+                    self._idle_bytes -= oldest.pop(0).nbytes
+                    if not oldest:
+                        del self._idle[oldest_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._idle.clear()
+            self._idle_bytes = 0
+
+
+image_buffers = ImageBufferPool()
@@ -0,0 +1,54 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+from typing import BinaryIO, Optional, Union
+
+from PIL import Image
+
+from task_adapter.utils.image_buffers import resized_size
+
+
+def draft_image(image: Image.Image, short_side: int) -> Image.Image:
+    """
+    Configures a JPEG that has not been decoded yet to decode at the
+    smallest DCT scale (1/2, 1/4 or 1/8) that keeps its short side at or
+    above short_side, so the precise resize afterwards starts from a few
+    times fewer pixels. Images in other formats, or already decoded, are
+    left as they are. Modifies and returns image.
+    """
+    if image.format == "JPEG":
+        height, width = resized_size(image.size, short_side)
+        image.draft("RGB", (width, height))
+    return image
+
+
+def open_draft(image: Image.Image, short_side: int) -> Image.Image:
+    """
+    Returns a drafted copy of a JPEG that has not been decoded yet, opened
+    again from its file, so the preprocessing decodes fewer pixels without
+    changing the size or mode of the caller's image. Other images are
+    returned as they are. The caller closes the copy if it differs from
+    image.
+    """
+    filename = getattr(image, "filename", "")
+    if image.format != "JPEG" or not image.tile or not filename:
+        return image
+    return draft_image(Image.open(filename), short_side)
+
+
+def load_image(fp: Union[str, BinaryIO], short_side: Optional[int] = None) -> Image.Image:
+    """
+    Opens and decodes an image as RGB. If short_side is given, i.e. the image
+    will be resized to the text_size of the task adapters, JPEGs are decoded
+    at reduced resolution with draft_image. Their size then differs from the
+    file's, but the adapters only depend on the aspect ratio; the long side
+    of the resized image can differ by a pixel from a full decode.
+    """
+    image = Image.open(fp)
+    if short_side is not None and min(image.size) > short_side:
+        draft_image(image, short_side)
+    image.load()
+    return image if image.mode == "RGB" else image.convert("RGB")
@@ -0,0 +1,132 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import hashlib
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+from scipy.ndimage import find_objects, label
+
+from task_adapter.utils.annotation_set import AnnotationSet
+from task_adapter.utils.pipeline import InferenceBackend, InferenceContext, InferencePipeline, StageHook
+
+
+def stroke_signature(labeled: np.ndarray, index: int, bounds: Tuple[slice, slice]) -> str:
+    """
+    Returns a key identifying one connected stroke of a labeled scribble
+    layer by its position and pixels, so a stroke redrawn anywhere, or
+    merged with another, gets a new key.
+    """
+    crop = np.ascontiguousarray(labeled[bounds] == index)
+    digest = hashlib.blake2b(crop.data, digest_size=16)
+    digest.update(repr([(s.start, s.stop) for s in bounds]).encode())
+    return digest.hexdigest()
+
+
+class InteractiveSession:
+    """
+    Keeps the state of interactive segmentation on one image across
+    scribble edits: the image is preprocessed and encoded once, and every
+    update only decodes the strokes that were added or changed since the
+    previous one. The marks of unchanged strokes are reused, and those of
+    erased strokes dropped.
+
+    Strokes are the connected components of the scribble layer, like in the
+    one-shot interactive adapters, and each one gets one mark: the record
+    whose 'stroke' column is the stroke's label in the decoded spatial
+    masks. Sessions are not thread-safe; use one per user.
+
+    Arguments:
+      backend (InferenceBackend): An interactive backend, which takes the
+        stroke label array as 'spatial_masks' in its inputs and decodes one
+        mask per stroke, e.g. SamInteractiveBackend or
+        SeemInteractiveBackend. Records without a 'stroke' column are
+        matched to the strokes by position.
+      image (PIL.Image): The image being annotated.
+      text_size (int): The short side the image is resized to.
+      hooks (list(StageHook)): Called around every stage, like the hooks of
+        an InferencePipeline.
+    """
+
+    def __init__(self, backend: InferenceBackend, image: Image.Image, text_size: int, hooks: Sequence[StageHook] = ()) -> None:
+        self.pipeline = InferencePipeline(backend, hooks)
+        self.ctx = InferenceContext(image, text_size, backend.device, {})
+        # stroke signature -> its one-record AnnotationSet
+        self._marks: Dict[str, AnnotationSet] = {}
+        try:
+            # resources, e.g. the image buffer and the generator, stay
+            # acquired until close
+            self.pipeline._run_stage("preprocess", [self.ctx], lambda: backend.preprocess_image(self.ctx))
+            self.pipeline._run_stage("encode", [self.ctx], lambda: backend.encode(self.ctx))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self) -> "InteractiveSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.ctx.resources.close()
+        self._marks.clear()
+
+    def update(
+        self,
+        scribble: np.ndarray,
+        label_mode: str = '1',
+        alpha: float = 0.1,
+        anno_mode: List[str] = ['Mask'],
+    ) -> Tuple[np.ndarray, AnnotationSet, np.ndarray]:
+        """
+        Returns (rendered image, records, label map) for the current
+        scribble layer, an HxW array at the resolution of the image, nonzero
+        where the user drew.
+        """
+        ctx = self.ctx
+        labeled, _ = label(np.asarray(scribble))
+        signatures = [stroke_signature(labeled, i + 1, bounds) for i, bounds in enumerate(find_objects(labeled))]
+
+        new = [i for i, signature in enumerate(signatures) if signature not in self._marks]
+        if new:
+            # all new strokes in one decoder call, relabeled 1..len(new)
+            relabel = np.zeros(len(signatures) + 1, dtype=np.int32)
+            relabel[np.array(new) + 1] = np.arange(1, len(new) + 1)
+            ctx.inputs = {'spatial_masks': relabel[labeled]}
+            backend = self.pipeline.backend
+            for stage, fn in (("preprocess", backend.prepare_prompts), ("decode", backend.decode), ("postprocess", backend.postprocess)):
+                self.pipeline._run_stage(stage, [ctx], lambda: fn(ctx))
+            annotations = ctx.annotations
+            if not isinstance(annotations, AnnotationSet):
+                annotations = AnnotationSet.from_records(annotations)
+            rows = self._stroke_rows(annotations, len(new))
+            for stroke, i in enumerate(new):
+                self._marks[signatures[i]] = annotations[rows[stroke]:rows[stroke] + 1]
+        self._marks = {signature: self._marks[signature] for signature in signatures}
+
+        ctx.inputs = {'label_mode': label_mode, 'alpha': alpha, 'anno_mode': anno_mode}
+        ctx.annotations = AnnotationSet.concat(list(self._marks.values()))
+        for stage in ("annotate", "render", "encode_output"):
+            self.pipeline._run_stage(stage, [ctx], lambda: getattr(self.pipeline, stage)(ctx))
+        return ctx.rendered, ctx.annotations, ctx.label_map
+
+    @staticmethod
+    def _stroke_rows(annotations: AnnotationSet, num_strokes: int) -> List[int]:
+        # row of the record of each stroke 1..num_strokes, from the 'stroke'
+        # column the backend sets, else by position if there is one record
+        # per stroke; the column is dropped, its numbers are per decode
+        strokes = annotations.extra.pop('stroke', None)
+        if strokes is None:
+            if len(annotations) != num_strokes:
+                raise ValueError(f"The backend returned {len(annotations)} records for {num_strokes} strokes and no 'stroke' column to match them.")
+            return list(range(num_strokes))
+        rows = {int(stroke): row for row, stroke in enumerate(strokes)}
+        missing = [stroke for stroke in range(1, num_strokes + 1) if stroke not in rows]
+        if missing:
+            raise ValueError(f"The backend returned no record for strokes {missing}.")
+        return [rows[stroke] for stroke in range(1, num_strokes + 1)]
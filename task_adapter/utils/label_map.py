@@ -0,0 +1,87 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+
+def rle_foreground_indices(rle: Dict[str, Any]) -> np.ndarray:
+    """
+    Returns the flat, column-major indices of the foreground pixels of an
+    uncompressed RLE without decoding it to a dense mask.
+    """
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    # Runs alternate background/foreground, starting with background
+    starts = (np.cumsum(counts) - counts)[1::2]
+    lengths = counts[1::2]
+    if len(lengths) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    run_offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return run_offsets + np.arange(int(lengths.sum()), dtype=np.int64)
+
+
+def segmentation_mask(segmentation: Any) -> np.ndarray:
+    """
+    Returns the binary HW mask of a segmentation that is either an
+    uncompressed RLE or already a mask.
+    """
+    if not isinstance(segmentation, dict):
+        return np.asarray(segmentation, dtype=bool)
+    h, w = segmentation["size"]
+    mask = np.zeros(h * w, dtype=bool)
+    mask[rle_foreground_indices(segmentation)] = True
+    return mask.reshape(w, h).T
+
+
+def rles_to_label_map(
+    rles: Sequence[Dict[str, Any]], size: Tuple[int, int], labels: Optional[Sequence[int]] = None
+) -> np.ndarray:
+    """
+    Paints uncompressed RLEs into a single int32 HW label map, in the given
+    order, so later masks are drawn over earlier ones. Pixels covered by no
+    mask are 0. labels defaults to 1..N.
+    """
+    h, w = int(size[0]), int(size[1])
+    if labels is None:
+        labels = range(1, len(rles) + 1)
+    # RLEs are column-major, so paint the transposed map
+    label_map = np.zeros(h * w, dtype=np.int32)
+    for rle, label in zip(rles, labels):
+        label_map[rle_foreground_indices(rle)] = label
+    return np.ascontiguousarray(label_map.reshape(w, h).T)
+
+
+def masks_to_label_map(
+    masks: Sequence[np.ndarray], size: Tuple[int, int], labels: Optional[Sequence[int]] = None
+) -> np.ndarray:
+    """
+    Paints binary HW masks into a single int32 HW label map, in the given
+    order, so later masks are drawn over earlier ones. Pixels covered by no
+    mask are 0. labels defaults to 1..N.
+    """
+    h, w = int(size[0]), int(size[1])
+    if len(masks) == 0:
+        return np.zeros((h, w), dtype=np.int32)
+    masks = np.asarray(masks, dtype=bool).reshape(-1, h, w)
+    labels = np.arange(1, len(masks) + 1, dtype=np.int32) if labels is None else np.asarray(labels, dtype=np.int32)
+    # the last mask covering every pixel is the first one in reverse order;
+    # argmax gives 0 where none does, so check that pixel of the mask
+    top = len(masks) - 1 - np.argmax(masks[::-1], axis=0)
+    covered = np.take_along_axis(masks, top[None], axis=0)[0]
+    return np.where(covered, labels[top], 0).astype(np.int32, copy=False)
+
+
+def segmentations_to_label_map(
+    segmentations: Sequence[Any], size: Tuple[int, int], labels: Optional[Sequence[int]] = None
+) -> np.ndarray:
+    """
+    Like masks_to_label_map, for segmentations that are uncompressed RLEs,
+    painted without decoding them, or binary masks.
+    """
+    if len(segmentations) and all(isinstance(s, dict) for s in segmentations):
+        return rles_to_label_map(segmentations, size, labels)
+    return masks_to_label_map([segmentation_mask(s) for s in segmentations], size, labels)
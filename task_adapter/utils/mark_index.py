@@ -0,0 +1,166 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import math
+
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from task_adapter.utils.box_tree import BoxTree
+from task_adapter.utils.mask_nms import pack_segmentation
+
+
+class MarkIndex:
+    """
+    Spatial index over the marks of one result, built once and queried by
+    highlighting, interactive refinement and API callers instead of
+    decoding masks again.
+
+    It holds a label map giving the topmost mark of every pixel, and a
+    static R-tree over the mark boxes, packed with the sort-tile-recursive
+    method, for queries that need every mark at a location. Candidates
+    from the tree are checked against the bit-packed masks. Marks are
+    z-ordered by area, smallest on top, like they are drawn, and queries
+    return them topmost first.
+
+    Arguments:
+      anns (list(dict)): Mask records as returned by the task adapters, with
+        a 'segmentation' (binary mask or uncompressed RLE) and an XYWH
+        'bbox'. A record's mark number is its 'label' key if present, else
+        its 1-based position; it is the value of the record's pixels in the
+        label map. Records with a 'hierarchical_label' (e.g. '3.2', drawn
+        instead of the number with hierarchy=True) can also be looked up by
+        it.
+      image_size (tuple(int, int) or None): The HW size of the masks.
+        Inferred from the first segmentation if None.
+      node_size (int): The number of children of an R-tree node.
+      label_map (np.ndarray or None): The int32 label map the task adapters
+        return with the records, reused instead of painting it again.
+    """
+
+    def __init__(
+        self,
+        anns: List[Dict[str, Any]],
+        image_size: Optional[Tuple[int, int]] = None,
+        node_size: int = 8,
+        label_map: Optional[np.ndarray] = None,
+    ) -> None:
+        if image_size is None:
+            image_size = _segmentation_size(anns[0]["segmentation"]) if anns else (0, 0)
+        self.image_size = (int(image_size[0]), int(image_size[1]))
+        self.annotations = anns
+        self.labels = np.array([ann.get("label", i + 1) for i, ann in enumerate(anns)], dtype=np.int64)
+        self.boxes = np.array([
+            [ann["bbox"][0], ann["bbox"][1], ann["bbox"][0] + ann["bbox"][2], ann["bbox"][1] + ann["bbox"][3]]
+            for ann in anns
+        ], dtype=np.int64).reshape(-1, 4)
+        self.areas = np.array([ann["area"] for ann in anns], dtype=np.int64)
+        self._packed = [pack_segmentation(ann["segmentation"], box) for ann, box in zip(anns, self.boxes)]
+        # Topmost first: smallest area, ties broken by drawing order
+        self._z = np.empty(len(anns), dtype=np.int64)
+        self._z[np.lexsort((-np.arange(len(anns)), self.areas))] = np.arange(len(anns))
+        self._by_label = {int(label): i for i, label in enumerate(self.labels)}
+        # drawn text -> mark number, for marks drawn with hierarchical labels
+        self.hierarchical_labels = {
+            str(ann["hierarchical_label"]): int(label)
+            for ann, label in zip(anns, self.labels)
+            if ann.get("hierarchical_label") is not None
+        }
+        self.label_map = self._build_label_map() if label_map is None else label_map
+        self._tree = BoxTree(self.boxes, node_size)
+
+    def __len__(self) -> int:
+        return len(self.annotations)
+
+    def resolve(self, text: Union[int, str]) -> Optional[int]:
+        """
+        Returns the mark number of a mark's drawn text, e.g. '3.2' or '7', as
+        cited in a reply, or None if no mark was drawn with it.
+        """
+        text = str(text)
+        if self.hierarchical_labels:
+            return self.hierarchical_labels.get(text)
+        return int(text) if text.isdigit() and int(text) in self._by_label else None
+
+    def annotation(self, label: Union[int, str]) -> Optional[Dict[str, Any]]:
+        """
+        Returns the record of a mark number, or of a mark's drawn text like
+        '3.2', or None if there is no such mark.
+        """
+        if isinstance(label, str):
+            label = self.resolve(label)
+            if label is None:
+                return None
+        i = self._by_label.get(int(label))
+        return None if i is None else self.annotations[i]
+
+    def mark_at(self, x: int, y: int) -> int:
+        """
+        Returns the topmost mark containing pixel (x, y), or 0 if none does.
+        """
+        h, w = self.image_size
+        if not (0 <= x < w and 0 <= y < h):
+            return 0
+        return int(self.label_map[int(y), int(x)])
+
+    def marks_at(self, x: int, y: int) -> List[int]:
+        """
+        Returns every mark containing pixel (x, y), topmost first.
+        """
+        x, y = int(x), int(y)
+        hits = [
+            i for i in self._tree.query(np.array([x, y, x, y]))
+            if self._contains(i, x, y)
+        ]
+        return self._sorted_labels(hits)
+
+    def marks_in_box(self, box: Sequence[float]) -> List[int]:
+        """
+        Returns every mark with at least one pixel in the inclusive XYXY box,
+        topmost first.
+        """
+        box = np.array([math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3])], dtype=np.int64)
+        hits = [i for i in self._tree.query(box) if self._intersects(i, box)]
+        return self._sorted_labels(hits)
+
+    def _sorted_labels(self, idx: List[int]) -> List[int]:
+        idx = np.array(idx, dtype=np.int64)
+        return self.labels[idx[np.argsort(self._z[idx])]].tolist()
+
+    def _build_label_map(self) -> np.ndarray:
+        h, w = self.image_size
+        # Paint bottom to top into the transposed map, column by column
+        label_map_t = np.zeros((w, h), dtype=np.int32)
+        for i in np.argsort(-self._z):
+            x0, bits = self._packed[i]
+            if len(bits) == 0:
+                continue
+            columns = np.unpackbits(bits, axis=1, count=h).astype(bool)
+            label_map_t[x0 : x0 + len(columns)][columns] = self.labels[i]
+        return np.ascontiguousarray(label_map_t.T)
+
+    def _contains(self, i: int, x: int, y: int) -> bool:
+        x0, bits = self._packed[i]
+        if not 0 <= x - x0 < len(bits):
+            return False
+        return bool(bits[x - x0, y // 8] >> (7 - y % 8) & 1)
+
+    def _intersects(self, i: int, box: np.ndarray) -> bool:
+        x0, bits = self._packed[i]
+        h = self.image_size[0]
+        bx0, bx1 = max(box[0], self.boxes[i, 0]), min(box[2], self.boxes[i, 2])
+        by0, by1 = max(box[1], 0), min(box[3], h - 1)
+        if bx1 < bx0 or by1 < by0:
+            return False
+        columns = np.unpackbits(bits[bx0 - x0 : bx1 - x0 + 1], axis=1, count=h)
+        return bool(columns[:, by0 : by1 + 1].any())
+
+
+def _segmentation_size(segmentation: Any) -> Tuple[int, int]:
+    if isinstance(segmentation, dict):
+        return tuple(segmentation["size"])
+    return segmentation.shape[:2]
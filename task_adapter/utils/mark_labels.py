@@ -0,0 +1,234 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import threading
+import weakref
+from typing import Any, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from task_adapter.utils.annotation_set import AnnotationSet
+from task_adapter.utils.label_map import segmentation_mask
+from task_adapter.utils.pipeline import InferenceContext, StageHook
+from task_adapter.utils.text_embeddings import text_embeddings
+
+
+def _cell_areas(h: int, w: int, stride: int) -> np.ndarray:
+    # pixels in every cell of the stride grid, fewer in the last row and column
+    heights = np.diff(np.minimum(np.arange(0, h + stride, stride), h))
+    widths = np.diff(np.minimum(np.arange(0, w + stride, stride), w))
+    return np.outer(heights, widths).reshape(-1).astype(np.float32)
+
+
+def mask_coverage(segmentations: Sequence[Any], stride: int = 4) -> torch.Tensor:
+    """
+    Returns the fraction of every stride x stride cell each HxW binary mask
+    or uncompressed RLE covers, as an M x (ceil(H/stride) * ceil(W/stride))
+    float matrix; cells cut by the image border count only their pixels
+    inside it. Small masks keep their weight instead of vanishing like with
+    nearest downsampling.
+    """
+    if len(segmentations) == 0:
+        return torch.zeros((0, 0))
+    h, w = segmentation_mask(segmentations[0]).shape[:2]
+    # cell corners, the last row and column of cells cut at the border
+    ys = np.minimum(np.arange(0, h + stride, stride), h)
+    xs = np.minimum(np.arange(0, w + stride, stride), w)
+    coverage = np.empty((len(segmentations), (len(ys) - 1) * (len(xs) - 1)), dtype=np.float32)
+    for i, segmentation in enumerate(segmentations):
+        # cell sums from the integral image, four lookups per cell
+        corners = cv2.integral(segmentation_mask(segmentation).view(np.uint8))[ys][:, xs]
+        cells = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        coverage[i] = cells.reshape(-1)
+    coverage /= _cell_areas(h, w, stride)
+    return torch.from_numpy(coverage)
+
+
+def score_marks(
+    segmentations: Sequence[Any],
+    query_embeddings: torch.Tensor,
+    query_masks: torch.Tensor,
+    class_embeddings: torch.Tensor,
+    logit_scale: float = 1.0,
+    stride: int = 4,
+) -> torch.Tensor:
+    """
+    Returns the M x C class probabilities of M marks, given the Q x D class
+    embeddings and Q x h x w mask logits of SEEM's decoder queries, the
+    masks at 1/stride of the image resolution, and the C x D text embeddings
+    of a vocabulary.
+
+    The feature of every mark is the mean of the query embeddings, each
+    weighted by how much of the mark its mask covers, both on the stride
+    grid. All marks are then scored with one matrix multiply against the
+    text embeddings, like SEEM scores its own queries.
+    """
+    num_classes = class_embeddings.shape[0]
+    if len(segmentations) == 0:
+        return torch.zeros((0, num_classes))
+    h, w = segmentation_mask(segmentations[0]).shape[:2]
+    gh, gw = -(-h // stride), -(-w // stride)
+    device = query_embeddings.device
+    # pixels of every mark in every cell
+    coverage = mask_coverage(segmentations, stride).to(device) * torch.from_numpy(_cell_areas(h, w, stride)).to(device)
+    # masks are predicted for the padded input: the image is their top-left
+    masks = query_masks.float()
+    if masks.shape[-2] < gh or masks.shape[-1] < gw:
+        masks = F.interpolate(masks[None], size=(gh, gw), mode="bilinear", align_corners=False)[0]
+    masks = masks[:, :gh, :gw].sigmoid().reshape(len(masks), gh * gw)
+    weights = coverage @ masks.T
+    weights = weights / weights.sum(dim=1, keepdim=True).clamp(min=1e-6)
+    features = F.normalize(weights @ F.normalize(query_embeddings.float(), dim=-1), dim=-1)
+    logits = logit_scale * features @ F.normalize(class_embeddings.float().to(device), dim=-1).T
+    return logits.softmax(dim=-1)
+
+
+def attach_labels(
+    annotations: AnnotationSet,
+    scores: torch.Tensor,
+    class_names: Sequence[str],
+    top_k: int = 3,
+) -> AnnotationSet:
+    """
+    Stores the top_k class names of every mark under 'class_names' and their
+    scores under 'class_scores', best first.
+    """
+    k = min(top_k, scores.shape[1]) if len(scores) else 0
+    values, indices = scores.topk(k, dim=1) if k else (scores[:, :0], scores[:, :0].long())
+    annotations.set_column("class_names", [[class_names[j] for j in row] for row in indices.tolist()])
+    annotations.set_column("class_scores", values.tolist())
+    return annotations
+
+
+class MarkLabeler(StageHook):
+    """
+    Labels the marks of every pipeline it is registered with, e.g. through
+    the hooks argument of the inference adapters: after annotate, every
+    mark is scored against a vocabulary with score_marks, and the top_k
+    class names and scores are attached to each record.
+
+    The query embeddings and masks are recorded from the SEEM forward pass
+    the backend runs anyway, e.g. for inference_seem_pano; other backends
+    get one SEEM pass per image, never one per mark. A custom vocabulary is
+    scored with its cached embeddings from the TextEmbeddingStore, without
+    activating it on the model.
+
+    Arguments:
+      seem_model: The SEEM BaseModel.
+      vocabulary (list(str) or None): The class names, including a trailing
+        'background'; the vocabulary active on the model if None.
+      top_k (int): The number of labels per mark.
+      stride (int): The downsampling of SEEM's masks relative to its input.
+    """
+
+    def __init__(self, seem_model, vocabulary: Optional[List[str]] = None, top_k: int = 3, stride: int = 4) -> None:
+        self.seem_model = seem_model
+        self.vocabulary = vocabulary
+        self.top_k = top_k
+        self.stride = stride
+        # contexts decoding on this thread, in batch order, and the next one
+        # to take a recorded sample
+        self._local = threading.local()
+        # context -> (query embeddings, query masks) of its image
+        self._queries: "weakref.WeakKeyDictionary[InferenceContext, Tuple[torch.Tensor, torch.Tensor]]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._handle = seem_model.model.sem_seg_head.predictor.register_forward_hook(self._record)
+
+    def close(self) -> None:
+        """
+        Stops recording SEEM's forward passes.
+        """
+        self._handle.remove()
+
+    def before_stage(self, stage: str, ctx: InferenceContext) -> None:
+        pending = self._pending()
+        if stage == "decode":
+            pending.append(ctx)
+        elif pending:
+            # left by a decode that raised
+            pending.clear()
+            self._local.next = 0
+
+    def after_stage(self, stage: str, ctx: InferenceContext) -> None:
+        if stage == "decode":
+            pending = self._pending()
+            if ctx in pending:
+                pending.remove(ctx)
+            if not pending:
+                self._local.next = 0
+            return
+        if stage != "annotate":
+            return
+        with self._lock:
+            queries = self._queries.pop(ctx, None)
+        if len(ctx.annotations) == 0:
+            return
+        if queries is None:
+            queries = self._run_seem(ctx)
+        if self.vocabulary is not None:
+            class_embeddings = text_embeddings.embeddings(self.seem_model, self.vocabulary)
+            class_names = list(self.vocabulary)
+        else:
+            # the active vocabulary and its names, read together
+            with text_embeddings.lock(self.seem_model):
+                class_embeddings = text_embeddings.active(self.seem_model)
+                class_names = self._active_class_names(class_embeddings.shape[0])
+        with torch.no_grad():
+            scores = score_marks(
+                ctx.annotations.segmentations, *queries, class_embeddings, text_embeddings.logit_scale(self.seem_model), self.stride
+            )
+        attach_labels(ctx.annotations, scores, class_names, self.top_k)
+
+    def _pending(self) -> List[InferenceContext]:
+        if not hasattr(self._local, "pending"):
+            self._local.pending = []
+            self._local.next = 0
+        return self._local.pending
+
+    def _record(self, module, inputs, outputs) -> None:
+        # forward hook of SEEM's predictor; only passes run for contexts
+        # decoding on this thread are recorded
+        pending = getattr(self._local, "pending", None)
+        if not pending or not isinstance(outputs, dict):
+            return
+        embeddings, masks = outputs.get("pred_captions"), outputs.get("pred_masks")
+        if embeddings is None or masks is None or embeddings.shape[:2] != masks.shape[:2]:
+            return
+        with self._lock:
+            for i in range(len(embeddings)):
+                if self._local.next >= len(pending):
+                    break
+                self._queries[pending[self._local.next]] = (embeddings[i].detach(), masks[i].detach())
+                self._local.next += 1
+
+    def _run_seem(self, ctx: InferenceContext) -> Tuple[torch.Tensor, torch.Tensor]:
+        h, w = ctx.image_ori.shape[:2]
+        images = ctx.images if ctx.images is not None else torch.from_numpy(ctx.image_ori).permute(2, 0, 1).to(ctx.device)
+        pending = self._pending()
+        pending.append(ctx)
+        try:
+            # the model reads the active vocabulary and metadata, which
+            # must not change during the pass
+            with text_embeddings.lock(self.seem_model), torch.no_grad():
+                self.seem_model.model.evaluate([{"image": images, "height": h, "width": w}])
+        finally:
+            pending.remove(ctx)
+            self._local.next = 0
+        with self._lock:
+            queries = self._queries.pop(ctx, None)
+        if queries is None:
+            raise RuntimeError("SEEM's predictor returned no 'pred_captions' and 'pred_masks' to label marks with.")
+        return queries
+
+    def _active_class_names(self, num_classes: int) -> List[Any]:
+        names = list(getattr(getattr(self.seem_model.model, "metadata", None), "stuff_classes", None) or [])[:num_classes]
+        if len(names) == num_classes - 1:
+            # the trailing 'background' vocabulary_metadata drops
+            names.append("background")
+        return names + [str(i) for i in range(len(names), num_classes)]
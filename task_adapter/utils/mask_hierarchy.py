@@ -0,0 +1,129 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+
+from typing import Any, Dict, List, Sequence, Tuple
+
+from task_adapter.utils.box_tree import BoxTree
+from task_adapter.utils.mask_nms import pack_segmentation, packed_intersection
+
+
+def containment_parents(
+    packed: Sequence[Tuple[int, np.ndarray]],
+    boxes: np.ndarray,
+    areas: np.ndarray,
+    containment_thresh: float = 0.9,
+) -> np.ndarray:
+    """
+    Finds the part-of tree of a set of masks. The parent of a mask is the
+    smallest larger mask that covers at least containment_thresh of it, so
+    a part hangs under the object it belongs to and not under the whole
+    scene.
+
+    Candidate parents are the masks whose boxes intersect the mask's box,
+    found for all masks at once in an R-tree over the boxes (BoxTree). Box
+    intersection, which bounds the mask intersection, and area discard
+    most of them without touching pixels. The remaining candidates are
+    tried from the smallest up, counting the intersection on bit-packed
+    columns, and the first that passes is the parent. This costs
+    O(N log N + P), with P the number of box-overlapping pairs, plus the
+    exact tests.
+
+    Arguments:
+      packed (list(tuple(int, np.ndarray))): The masks bit-packed by
+        pack_rle_columns.
+      boxes (np.ndarray): The masks' boxes, Nx4 in inclusive XYXY format.
+      areas (np.ndarray): The masks' areas.
+      containment_thresh (float): The fraction of a mask its parent must cover.
+
+    Returns:
+      np.ndarray: The index of the parent of every mask, -1 for roots.
+    """
+    n = len(packed)
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    areas = np.asarray(areas, dtype=np.int64)
+    parents = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return parents
+
+    # Larger masks first; ties keep input order, so only earlier masks can be parents
+    order = np.lexsort((np.arange(n), -areas))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+
+    # Candidate (child, parent) pairs: larger, overlapping enough in box and area
+    child, parent = BoxTree(boxes).query_all(boxes)
+    needed = containment_thresh * areas[child]
+    cb, pb = boxes[child], boxes[parent]
+    iw = np.minimum(cb[:, 2], pb[:, 2]) - np.maximum(cb[:, 0], pb[:, 0]) + 1
+    ih = np.minimum(cb[:, 3], pb[:, 3]) - np.maximum(cb[:, 1], pb[:, 1]) + 1
+    candidate = (rank[parent] < rank[child]) & (areas[child] > 0)
+    candidate &= (iw * ih >= needed) & (areas[parent] >= needed)
+    child, parent = child[candidate], parent[candidate]
+    # by child, then smallest parent first
+    grouped = np.lexsort((-rank[parent], child))
+    child, parent = child[grouped], parent[grouped]
+    ends = np.cumsum(np.bincount(child, minlength=n)).tolist()
+    child, parent = child.tolist(), parent.tolist()
+
+    for i in range(n):
+        start = ends[i - 1] if i > 0 else 0
+        needed = containment_thresh * areas[i]
+        for j in parent[start:ends[i]]:
+            if packed_intersection(packed[i], packed[j], boxes[i], boxes[j]) >= needed:
+                parents[i] = j
+                break
+    return parents
+
+
+def hierarchical_labels(parents: np.ndarray) -> List[str]:
+    """
+    Numbers the nodes of a part-of tree as '3', '3.1', '3.2', ...: roots
+    get 1..R and the children of every node 1..C, both in index order.
+    """
+    labels = [""] * len(parents)
+    num_children = np.zeros(len(parents) + 1, dtype=np.int64)
+    # Parents precede their children in decreasing-area order, but not
+    # necessarily in index order, so resolve labels depth-first.
+    children: Dict[int, List[int]] = {}
+    for i, p in enumerate(parents.tolist()):
+        children.setdefault(p, []).append(i)
+    stack = [(i, "") for i in reversed(children.get(-1, []))]
+    while stack:
+        i, prefix = stack.pop()
+        p = int(parents[i])
+        num_children[p] += 1
+        labels[i] = f"{prefix}{num_children[p]}"
+        stack.extend((c, labels[i] + ".") for c in reversed(children.get(i, [])))
+    return labels
+
+
+def annotate_hierarchy(anns: List[Dict[str, Any]], containment_thresh: float = 0.9) -> List[Dict[str, Any]]:
+    """
+    Adds the part-of tree to mask records, in place: 'parent' (the index
+    of the parent record, or -1), 'children' (indices of the child records)
+    and 'hierarchical_label' (e.g. '3.2'). The records' 'segmentation' must
+    be a binary mask or an uncompressed RLE. Numbering follows the order
+    of anns, so records sorted by decreasing area are numbered like their
+    marks.
+    """
+    boxes = np.array([
+        [ann["bbox"][0], ann["bbox"][1], ann["bbox"][0] + ann["bbox"][2], ann["bbox"][1] + ann["bbox"][3]]
+        for ann in anns
+    ], dtype=np.int64).reshape(-1, 4)
+    areas = np.array([ann["area"] for ann in anns], dtype=np.int64)
+    packed = [pack_segmentation(ann["segmentation"], box) for ann, box in zip(anns, boxes)]
+
+    parents = containment_parents(packed, boxes, areas, containment_thresh)
+    for ann, parent, label in zip(anns, parents.tolist(), hierarchical_labels(parents)):
+        ann["parent"] = parent
+        ann["children"] = []
+        ann["hierarchical_label"] = label
+    for i, parent in enumerate(parents.tolist()):
+        if parent >= 0:
+            anns[parent]["children"].append(i)
+    return anns
@@ -0,0 +1,142 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+
+from typing import Any, Dict, Sequence, Tuple
+
+from task_adapter.utils.box_tree import BoxTree
+from task_adapter.utils.label_map import rle_foreground_indices
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def pack_rle_columns(rle: Dict[str, Any]) -> Tuple[int, np.ndarray]:
+    """
+    Bit-packs the columns an uncompressed RLE spans. Returns the first column
+    and a uint8 array of shape (num_columns, ceil(H / 8)) where bit y of row
+    x - x0 is set if pixel (y, x) is in the mask.
+    """
+    h = int(rle["size"][0])
+    idx = rle_foreground_indices(rle)
+    if len(idx) == 0:
+        return 0, np.zeros((0, (h + 7) // 8), dtype=np.uint8)
+    x0, x1 = int(idx[0] // h), int(idx[-1] // h)
+    columns = np.zeros((x1 - x0 + 1) * h, dtype=bool)
+    columns[idx - x0 * h] = True
+    return x0, np.packbits(columns.reshape(-1, h), axis=1)
+
+
+def pack_segmentation(segmentation: Any, box: np.ndarray) -> Tuple[int, np.ndarray]:
+    """
+    Like pack_rle_columns, for a segmentation that is either an uncompressed
+    RLE or a binary HW mask. For binary masks, the columns of its inclusive
+    XYXY box are packed.
+    """
+    if isinstance(segmentation, dict):
+        return pack_rle_columns(segmentation)
+    x0, x1 = int(box[0]), int(box[2])
+    return x0, np.packbits(np.asarray(segmentation, dtype=bool)[:, x0 : x1 + 1].T, axis=1)
+
+
+def packed_intersection(
+    packed_a: Tuple[int, np.ndarray], packed_b: Tuple[int, np.ndarray], box_a: np.ndarray, box_b: np.ndarray
+) -> int:
+    """
+    Counts the pixels two masks packed by pack_rle_columns have in common,
+    only looking at the overlap of their inclusive XYXY boxes.
+    """
+    (xa, bits_a), (xb, bits_b) = packed_a, packed_b
+    x0 = max(box_a[0], box_b[0])
+    x1 = min(box_a[2], box_b[2])
+    y0 = max(box_a[1], box_b[1]) // 8
+    y1 = min(box_a[3], box_b[3]) // 8
+    if x1 < x0 or y1 < y0:
+        return 0
+    return int(_POPCOUNT[
+        bits_a[x0 - xa : x1 - xa + 1, y0 : y1 + 1] & bits_b[x0 - xb : x1 - xb + 1, y0 : y1 + 1]
+    ].sum())
+
+
+def packed_iou_matrix(masks: np.ndarray) -> np.ndarray:
+    """
+    Returns the KxK IoU matrix of K binary HxW masks, counted on the masks
+    bit-packed, eight pixels per byte. IoUs of two empty masks are 0.
+    """
+    packed = np.packbits(np.asarray(masks, dtype=bool).reshape(len(masks), -1), axis=1)
+    areas = _POPCOUNT[packed].sum(axis=1)
+    inter = np.stack([_POPCOUNT[row & packed].sum(axis=1) for row in packed]) if len(packed) else np.zeros((0, 0), dtype=np.int64)
+    union = areas[:, None] + areas[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1), 0.0)
+
+
+def mask_nms(
+    rles: Sequence[Dict[str, Any]],
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    iou_threshold: float,
+) -> np.ndarray:
+    """
+    Greedy non-maximal suppression on mask IoU. Masks are visited by
+    decreasing score and dropped if their IoU with an already kept mask
+    exceeds iou_threshold, so every cluster of near-identical masks is
+    represented by its best-scoring member.
+
+    Masks are only compared with masks whose boxes intersect their own,
+    found for all masks at once in an R-tree over the boxes (BoxTree), so
+    suppression costs O(N log N + P), with P the number of box-overlapping
+    pairs, instead of comparing every mask with every kept mask. Of those
+    pairs, exact IoUs are only computed for the ones whose upper bound,
+    min(box intersection, smaller area) / larger area, exceeds the
+    threshold, and whose other mask was kept; they are counted on
+    bit-packed columns restricted to the box overlap.
+
+    Arguments:
+      rles (list(dict)): Uncompressed RLEs of the masks.
+      boxes (np.ndarray): The masks' boxes, Nx4 in inclusive XYXY format.
+      scores (np.ndarray): The score of each mask, higher is better.
+      iou_threshold (float): The mask IoU above which masks are duplicates.
+
+    Returns:
+      np.ndarray: The indices of the kept masks, sorted by decreasing score.
+    """
+    n = len(rles)
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    areas = np.array([sum(rle["counts"][1::2]) for rle in rles], dtype=np.int64)
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")
+
+    # candidate duplicate pairs, grouped by their first mask
+    first, second = BoxTree(boxes).query_all(boxes)
+    pb, qb = boxes[first], boxes[second]
+    iw = np.minimum(pb[:, 2], qb[:, 2]) - np.maximum(pb[:, 0], qb[:, 0]) + 1
+    ih = np.minimum(pb[:, 3], qb[:, 3]) - np.maximum(pb[:, 1], qb[:, 1]) + 1
+    larger = np.maximum(np.maximum(areas[first], areas[second]), 1)
+    bound = np.minimum(iw * ih, np.minimum(areas[first], areas[second])) / larger
+    candidate = (bound > iou_threshold) & (first != second)
+    first, second = first[candidate], second[candidate]
+    grouped = np.argsort(first, kind="stable")
+    second = second[grouped].tolist()
+    ends = np.cumsum(np.bincount(first, minlength=n)).tolist()
+
+    keep = []
+    kept = np.zeros(n, dtype=bool)
+    packed = {}
+    for i in order.tolist():
+        start = ends[i - 1] if i > 0 else 0
+        if any(kept[k] and _mask_iou(i, k, rles, boxes, areas, packed) > iou_threshold for k in second[start:ends[i]]):
+            continue
+        keep.append(i)
+        kept[i] = True
+    return np.array(keep, dtype=np.int64)
+
+
+def _mask_iou(i, k, rles, boxes, areas, packed) -> float:
+    for m in (i, k):
+        if m not in packed:
+            packed[m] = pack_rle_columns(rles[m])
+    inter = packed_intersection(packed[i], packed[k], boxes[i], boxes[k])
+    union = areas[i] + areas[k] - inter
+    return float(inter) / float(union) if union > 0 else 0.0
@@ -0,0 +1,263 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from typing import Any, Dict, List, Tuple
+
+
+def _stability_score(masks: torch.Tensor, mask_threshold: float, threshold_offset: float) -> torch.Tensor:
+    # Same as calculate_stability_score in segment_anything.utils.amg
+    intersections = (
+        (masks > (mask_threshold + threshold_offset))
+        .sum(-1, dtype=torch.int16)
+        .sum(-1, dtype=torch.int32)
+    )
+    unions = (
+        (masks > (mask_threshold - threshold_offset))
+        .sum(-1, dtype=torch.int16)
+        .sum(-1, dtype=torch.int32)
+    )
+    return intersections / unions
+
+
+def encode_transposed_masks(masks_t: torch.Tensor) -> Tuple[List[Dict[str, Any]], np.ndarray, np.ndarray]:
+    """
+    Computes the uncompressed RLEs, XYXY boxes and areas of a batch of binary
+    masks stored transposed, i.e. with shape BxWxH, so that each mask is
+    already in the column-major order RLEs use.
+
+    Everything is derived from one pass over the masks that finds where
+    consecutive pixels change value. Only those change indices are copied to
+    the host, and the boxes come from the runs they delimit, so no separate
+    reductions over the masks are needed. Boxes match batched_mask_to_box:
+    inclusive max coordinates, and [0, 0, 0, 0] for empty masks.
+    """
+    b, w, h = masks_t.shape
+    flat = masks_t.reshape(b, w * h)
+    diff = flat[:, 1:] ^ flat[:, :-1]
+    if diff.device.type == "cpu":
+        # numpy's nonzero is several times faster than torch's on the CPU
+        mask_ids, pos = np.divmod(np.flatnonzero(diff.numpy()), w * h - 1)
+    else:
+        change = diff.nonzero().cpu().numpy()
+        mask_ids, pos = change[:, 0], change[:, 1]
+    del diff
+    pos = pos + 1
+    first = flat[:, 0].cpu().numpy()
+
+    n_changes = np.bincount(mask_ids, minlength=b)
+    # Run boundaries of every mask, [0, changes..., H*W], laid out back to back
+    seg_start = np.cumsum(n_changes) - n_changes + 2 * np.arange(b)
+    bounds = np.empty(len(pos) + 2 * b, dtype=np.int64)
+    bounds[seg_start] = 0
+    bounds[seg_start + n_changes + 1] = h * w
+    bounds[np.arange(len(pos)) + 2 * mask_ids + 1] = pos
+    run_lengths = np.diff(bounds).tolist()
+
+    rles = []
+    for i in range(b):
+        counts = [0] if first[i] else []
+        counts.extend(run_lengths[seg_start[i] : seg_start[i] + n_changes[i] + 1])
+        rles.append({"size": [h, w], "counts": counts})
+
+    # Foreground runs: every other run, starting with the first if pixel 0 is set
+    n_runs = n_changes + 1
+    run_mask = np.repeat(np.arange(b), n_runs)
+    run_idx = np.arange(n_runs.sum()) - np.repeat(np.cumsum(n_runs) - n_runs, n_runs)
+    run_pos = np.repeat(seg_start, n_runs) + run_idx
+    is_fg = (run_idx % 2 == 0) == first[run_mask].astype(bool)
+    fg_mask = run_mask[is_fg]
+    start, end = bounds[run_pos[is_fg]], bounds[run_pos[is_fg] + 1] - 1
+
+    x0, x1 = start // h, end // h
+    # A run that wraps into the next column covers the full height
+    single_column = x0 == x1
+    y0 = np.where(single_column, start % h, 0)
+    y1 = np.where(single_column, end % h, h - 1)
+
+    boxes = np.zeros((b, 4), dtype=np.int64)
+    areas = np.zeros(b, dtype=np.int64)
+    if len(fg_mask) > 0:
+        nonempty, group_start = np.unique(fg_mask, return_index=True)
+        boxes[nonempty, 0] = x0[group_start]
+        boxes[nonempty, 1] = np.minimum.reduceat(y0, group_start)
+        boxes[nonempty, 2] = np.maximum.reduceat(x1, group_start)
+        boxes[nonempty, 3] = np.maximum.reduceat(y1, group_start)
+        areas[nonempty] = np.add.reduceat(end - start + 1, group_start)
+    return rles, boxes, areas
+
+
+def _column_major_sums(n: np.ndarray, h: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Sums of x = p // h and y = p % h over the column-major positions p < n
+    q, r = np.divmod(n, h)
+    return h * q * (q - 1) // 2 + q * r, q * (h * (h - 1) // 2) + r * (r - 1) // 2
+
+
+def encode_panoptic(
+    ids_t: torch.Tensor, segment_ids: List[int]
+) -> Tuple[List[Dict[str, Any]], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Computes the uncompressed RLEs, XYXY boxes, areas and anchor points of
+    every segment of a panoptic id map stored transposed, i.e. with shape
+    WxH, without building a mask per segment.
+
+    Like encode_transposed_masks, everything is derived from the positions
+    where consecutive pixels change id: these delimit runs of one id each,
+    and the runs of a segment give its RLE, box and area directly. The
+    anchor is the XY pixel nearest to the segment centroid if the segment
+    covers it, else the middle of its longest run, so it always lies inside
+    the segment. Empty segments get an empty RLE, a zero box and the anchor
+    [0, 0].
+    """
+    w, h = ids_t.shape
+    flat = ids_t.reshape(-1)
+    if flat.device.type == "cpu":
+        change = np.flatnonzero(np.diff(flat.numpy()))
+    else:
+        change = (flat[1:] != flat[:-1]).nonzero()[:, 0].cpu().numpy()
+    starts = np.concatenate([[0], change + 1])
+    ends = np.append(starts[1:], w * h)
+    run_ids = flat[torch.as_tensor(starts, device=flat.device)].cpu().numpy()
+
+    b = len(segment_ids)
+    order = np.argsort(np.asarray(segment_ids, dtype=np.int64), kind="stable")
+    sorted_ids = np.asarray(segment_ids, dtype=np.int64)[order]
+    pos = np.clip(np.searchsorted(sorted_ids, run_ids), 0, max(b - 1, 0))
+    keep = (sorted_ids[pos] == run_ids) if b else np.zeros(len(run_ids), dtype=bool)
+    # Runs of listed segments, grouped by segment and in position order within
+    run_seg = order[pos[keep]]
+    by_seg = np.argsort(run_seg, kind="stable")
+    run_seg, start, end = run_seg[by_seg], starts[keep][by_seg], ends[keep][by_seg]
+    length = end - start
+
+    n_runs = np.bincount(run_seg, minlength=b)
+    first_run = np.cumsum(n_runs) - n_runs
+    is_first = np.zeros(len(run_seg), dtype=bool)
+    is_first[first_run[n_runs > 0]] = True
+    prev_end = np.where(is_first, 0, np.roll(end, 1))
+    # counts: gap, length for every run, then the gap to the end of the
+    # image if there is one, like mask_to_rle_pytorch
+    interleaved = np.stack([start - prev_end, length], axis=1).reshape(-1).tolist()
+    last_end = np.zeros(b, dtype=np.int64)
+    last_end[n_runs > 0] = end[first_run[n_runs > 0] + n_runs[n_runs > 0] - 1]
+    rles = []
+    for i in range(b):
+        counts = interleaved[2 * first_run[i] : 2 * (first_run[i] + n_runs[i])]
+        if last_end[i] < w * h or n_runs[i] == 0:
+            counts.append(int(w * h - last_end[i]))
+        rles.append({"size": [h, w], "counts": counts})
+
+    areas = np.bincount(run_seg, weights=length, minlength=b).astype(np.int64)
+    x0, x1 = start // h, (end - 1) // h
+    # A run that wraps into the next column covers the full height
+    single_column = x0 == x1
+    y0 = np.where(single_column, start % h, 0)
+    y1 = np.where(single_column, (end - 1) % h, h - 1)
+    boxes = np.zeros((b, 4), dtype=np.int64)
+    anchors = np.zeros((b, 2), dtype=np.int64)
+    nonempty = np.flatnonzero(n_runs)
+    if len(nonempty) > 0:
+        group_start = first_run[nonempty]
+        boxes[nonempty, 0] = np.minimum.reduceat(x0, group_start)
+        boxes[nonempty, 1] = np.minimum.reduceat(y0, group_start)
+        boxes[nonempty, 2] = np.maximum.reduceat(x1, group_start)
+        boxes[nonempty, 3] = np.maximum.reduceat(y1, group_start)
+
+        sum_x_end, sum_y_end = _column_major_sums(end, h)
+        sum_x_start, sum_y_start = _column_major_sums(start, h)
+        cx = np.add.reduceat(sum_x_end - sum_x_start, group_start) / areas[nonempty]
+        cy = np.add.reduceat(sum_y_end - sum_y_start, group_start) / areas[nonempty]
+        centroid = np.rint(cx).astype(np.int64) * h + np.rint(cy).astype(np.int64)
+        inside = flat[torch.as_tensor(centroid, device=flat.device)].cpu().numpy() == np.asarray(segment_ids)[nonempty]
+        # the middle of the longest run of every segment
+        longest_run = np.lexsort((-length, run_seg))[group_start]
+        middle = start[longest_run] + length[longest_run] // 2
+        anchor = np.where(inside, centroid, middle)
+        anchors[nonempty, 0], anchors[nonempty, 1] = np.divmod(anchor, h)
+    return rles, boxes, areas, anchors
+
+
+def postprocess_mask_batch(
+    masks: torch.Tensor,
+    iou_preds: torch.Tensor,
+    points: torch.Tensor,
+    crop_box: List[int],
+    orig_size: Tuple[int, ...],
+    pred_iou_thresh: float,
+    stability_score_thresh: float,
+    stability_score_offset: float,
+    mask_threshold: float = 0.0,
+    always_filter: bool = False,
+) -> Dict[str, Any]:
+    """
+    Filters a batch of mask logits and encodes the survivors, fusing the
+    per-batch steps of the automatic mask generators: predicted IoU filter,
+    stability score, thresholding, boxes, crop-edge filter, uncropping and
+    RLE encoding.
+
+    Filters run before any full-size intermediate is created, so rejected
+    masks are never thresholded or encoded. The thresholded masks are
+    transposed once, and encode_transposed_masks turns them into RLEs and
+    boxes in a single pass.
+
+    Like in SamAutomaticMaskGenerator, a threshold of 0 disables its
+    filter, unless always_filter is set: the Semantic-SAM generator always
+    compares, which also drops masks with NaN or non-positive scores.
+
+    Returns a dict with the MaskData fields 'rles', 'boxes', 'iou_preds',
+    'points' and 'stability_score'. The tensors are on the CPU.
+    """
+    orig_h, orig_w = orig_size
+    keep = torch.arange(len(masks), device=masks.device)
+
+    # Filter by predicted IoU
+    if always_filter or pred_iou_thresh > 0.0:
+        keep = keep[iou_preds > pred_iou_thresh]
+    masks = masks[keep]
+
+    # Calculate stability score
+    stability_score = _stability_score(masks, mask_threshold, stability_score_offset)
+    if always_filter or stability_score_thresh > 0.0:
+        keep_stable = stability_score >= stability_score_thresh
+        if not bool(keep_stable.all()):
+            masks = masks[keep_stable]
+            keep, stability_score = keep[keep_stable], stability_score[keep_stable]
+
+    # Threshold, then transpose the 1-byte masks into column-major layout
+    masks_t = (masks > mask_threshold).transpose(1, 2).contiguous()
+    del masks
+
+    # Return to the original image frame
+    x0, y0, x1, y1 = crop_box
+    if x0 != 0 or y0 != 0 or x1 != orig_w or y1 != orig_h:
+        masks_t = F.pad(masks_t, (y0, orig_h - y1, x0, orig_w - x1), value=False)
+
+    rles, boxes, areas = encode_transposed_masks(masks_t)
+    del masks_t
+
+    # Filter boxes that touch crop boundaries
+    boxes = torch.as_tensor(boxes)
+    near_crop_edge = torch.isclose(boxes.float(), torch.tensor([crop_box], dtype=torch.float), atol=20.0, rtol=0)
+    near_image_edge = torch.isclose(boxes.float(), torch.tensor([[0, 0, orig_w, orig_h]], dtype=torch.float), atol=20.0, rtol=0)
+    keep_mask = ~torch.any(near_crop_edge & ~near_image_edge, dim=1)
+
+    # Boxes are returned in the crop frame, like batched_mask_to_box would
+    boxes[areas > 0] -= torch.tensor([x0, y0, x0, y0])
+    data = {
+        "rles": rles,
+        "boxes": boxes,
+        "iou_preds": iou_preds[keep].cpu(),
+        "points": points[keep.to(points.device)].cpu(),
+        "stability_score": stability_score.cpu(),
+    }
+    if not torch.all(keep_mask):
+        data["rles"] = [rle for rle, k in zip(data["rles"], keep_mask.tolist()) if k]
+        for k in ("boxes", "iou_preds", "points", "stability_score"):
+            data[k] = data[k][keep_mask]
+    return data
@@ -0,0 +1,117 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import gc
+from typing import Optional
+
+import torch
+
+
+def is_oom_error(error: BaseException) -> bool:
+    """
+    Returns True if the exception was raised because an allocation failed,
+    on either a CUDA device or the host.
+    """
+    if isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    if not isinstance(error, RuntimeError):
+        return False
+    message = str(error)
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def release_memory(device: torch.device) -> None:
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def reset_peak_memory(device: torch.device) -> Optional[int]:
+    """
+    Starts a new peak-memory measurement window and returns the memory in use
+    at its start, or None if the device does not track peak allocations.
+    """
+    if device.type != "cuda":
+        return None
+    torch.cuda.reset_peak_memory_stats(device)
+    return torch.cuda.memory_allocated(device)
+
+
+def peak_memory_since(device: torch.device, start: Optional[int]) -> Optional[int]:
+    if device.type != "cuda" or start is None:
+        return None
+    return torch.cuda.max_memory_allocated(device) - start
+
+
+class MemoryBudgetBatcher:
+    """
+    Picks how many point prompts to run per model call from a memory budget.
+
+    The cost of one point is modelled as bytes_per_pixel * masks_per_point * H * W,
+    i.e. it scales with the image size and with the number of masks the model
+    returns per point (one per granularity level for Semantic-SAM). The
+    coefficient starts from a conservative guess and is refined from the memory
+    measured on every batch: the batch size grows while there is headroom and is
+    halved whenever a batch runs out of memory.
+
+    Arguments:
+      memory_budget (int): Bytes the point batches may use on top of whatever
+        is already allocated (model weights, cached image features).
+      bytes_per_pixel (float): Initial estimate of the working memory needed
+        per mask pixel. Covers the logits and the temporaries created while
+        scoring and thresholding them.
+      min_batch (int): Smallest batch size.
+      max_batch (int): Largest batch size.
+      max_growth (float): Largest factor the batch size may grow by between
+        two consecutive batches.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int,
+        bytes_per_pixel: float = 16.0,
+        min_batch: int = 1,
+        max_batch: int = 4096,
+        max_growth: float = 2.0,
+    ) -> None:
+        assert memory_budget > 0, "memory_budget must be positive."
+        self.memory_budget = memory_budget
+        self.bytes_per_pixel = bytes_per_pixel
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.max_growth = max_growth
+        self._last_batch = None
+
+    def batch_size(self, pixels_per_point: int) -> int:
+        size = int(self.memory_budget // (self.bytes_per_pixel * pixels_per_point))
+        if self._last_batch is not None:
+            size = min(size, int(self._last_batch * self.max_growth))
+        return max(self.min_batch, min(self.max_batch, size))
+
+    def update(self, batch_size: int, pixels_per_point: int, used_bytes: Optional[int]) -> None:
+        """
+        Refines the cost model from the memory a completed batch actually used.
+        used_bytes is None on devices that do not report peak allocations, in
+        which case the current estimate is kept.
+        """
+        self._last_batch = max(batch_size, self._last_batch or 0)
+        if used_bytes is None or used_bytes <= 0:
+            return
+        self.bytes_per_pixel = used_bytes / float(batch_size * pixels_per_point)
+
+    def backoff(self, batch_size: int, pixels_per_point: int) -> bool:
+        """
+        Shrinks the batch after batch_size points ran out of memory. Returns
+        False if the batch cannot get any smaller.
+        """
+        if batch_size <= self.min_batch:
+            return False
+        smaller = max(self.min_batch, batch_size // 2)
+        self.bytes_per_pixel = max(
+            self.bytes_per_pixel, self.memory_budget / float(smaller * pixels_per_point)
+        )
+        self._last_batch = smaller
+        return True
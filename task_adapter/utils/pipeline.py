@@ -0,0 +1,364 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import contextlib
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from detectron2.data import MetadataCatalog
+
+from task_adapter.utils.annotation_set import AnnotationSet
+from task_adapter.utils.device import get_device
+from task_adapter.utils.image_buffers import image_buffers, resized_size
+from task_adapter.utils.image_io import open_draft
+from task_adapter.utils.label_map import segmentation_mask, segmentations_to_label_map
+from task_adapter.utils.mask_hierarchy import annotate_hierarchy
+from task_adapter.utils.mask_postprocess import encode_panoptic, encode_transposed_masks
+from task_adapter.utils.memory import peak_memory_since, reset_peak_memory
+from task_adapter.utils.resize import get_resize_backend, resize_into
+from task_adapter.utils.visualizer import Visualizer
+
+metadata = MetadataCatalog.get('coco_2017_train_panoptic')
+
+STAGES = ("preprocess", "encode", "decode", "postprocess", "annotate", "render", "encode_output")
+# Stages implemented by the model backend; the others are shared by all models
+BACKEND_STAGES = ("preprocess", "encode", "decode", "postprocess")
+
+
+class InferenceContext:
+    """
+    The state one run of an InferencePipeline passes between its stages.
+
+    Backends read the request from image, text_size and inputs, and must
+    leave the mask records in annotations by the end of postprocess, either
+    as an AnnotationSet or as a list of record dicts. resources is an
+    ExitStack closed when the run ends, e.g. to return a generator acquired
+    from the registry.
+    """
+
+    def __init__(self, image: Image.Image, text_size: int, device: torch.device, inputs: Dict[str, Any]) -> None:
+        self.image = image
+        self.text_size = text_size
+        self.device = device
+        self.inputs = inputs
+        self.resources = contextlib.ExitStack()
+        # set by preprocess: the resized HWC uint8 image, and as a CHW tensor
+        # on device; both are views of a pooled buffer reused after the run
+        self.image_ori: Optional[np.ndarray] = None
+        self.images: Optional[torch.Tensor] = None
+        # free for backends, e.g. prompts derived from inputs, encoder
+        # features and raw model outputs
+        self.prompts: Any = None
+        self.features: Any = None
+        self.outputs: Any = None
+        self.annotations: Optional[Union[AnnotationSet, List[Dict[str, Any]]]] = None
+        self.rendered: Optional[np.ndarray] = None
+        self.label_map: Optional[np.ndarray] = None
+        # per stage {'seconds': ..., 'peak_memory': ...}, filled by StageProfiler
+        self.stage_stats: Dict[str, Dict[str, Any]] = {}
+
+
+class InferenceBackend:
+    """
+    The model-specific stages of an InferencePipeline. Subclasses implement
+    decode, and whichever of preprocess (preprocess_image, then
+    prepare_prompts), encode and postprocess differ from the defaults.
+    Models that encode and decode in one call, like the mask generators, do
+    all of it in decode and leave encode empty.
+    """
+
+    # whether preprocess also moves the image to the device as a CHW tensor
+    needs_tensor = True
+
+    def __init__(
+        self,
+        model,
+        device: Optional[Union[str, torch.device]] = None,
+        resize_backend: Optional[str] = None,
+    ) -> None:
+        self.model = model
+        self.device = get_device(model, device)
+        self.resize_backend = get_resize_backend(resize_backend)
+
+    def preprocess(self, ctx: InferenceContext) -> None:
+        self.preprocess_image(ctx)
+        self.prepare_prompts(ctx)
+
+    def preprocess_image(self, ctx: InferenceContext) -> None:
+        # JPEGs passed undecoded, e.g. straight from Image.open, decode at
+        # reduced resolution, from a copy so the caller's image is untouched
+        image = open_draft(ctx.image, int(ctx.text_size))
+        if image is not ctx.image:
+            ctx.resources.callback(image.close)
+        # resize straight into a pooled buffer: image_ori and images are views
+        # of it, valid until the run ends
+        height, width = resized_size(image.size, int(ctx.text_size))
+        buffer = ctx.resources.enter_context(image_buffers.acquire(height, width, ctx.device))
+        buffer.wait()
+        ctx.image_ori = resize_into(image, buffer.array, self.resize_backend)
+        if self.needs_tensor:
+            ctx.images = buffer.tensor()
+
+    def prepare_prompts(self, ctx: InferenceContext) -> None:
+        """
+        Turns prompts in ctx.inputs, e.g. user strokes, into ctx.prompts.
+        Separate from preprocess_image so an InteractiveSession can prepare
+        new prompts for an image it preprocessed once.
+        """
+        pass
+
+    def encode(self, ctx: InferenceContext) -> None:
+        pass
+
+    def decode(self, ctx: InferenceContext) -> None:
+        raise NotImplementedError
+
+    def decode_batch(self, ctxs: List[InferenceContext]) -> None:
+        """
+        Decodes several preprocessed images with the same batch_key at once.
+        Backends whose model takes a batch override this; by default the
+        images are decoded one by one.
+        """
+        for ctx in ctxs:
+            self.decode(ctx)
+
+    def batch_key(self, size: Tuple[int, int]) -> Hashable:
+        """
+        Returns the key of the (height, width) a preprocessed image has. Only
+        images with equal keys are decoded in one batch, so that batching
+        does not change what the model sees.
+        """
+        return size
+
+    def postprocess(self, ctx: InferenceContext) -> None:
+        pass
+
+
+class StageHook:
+    """
+    Called around every stage of every pipeline it is registered with. Both
+    methods are no-ops; subclasses override what they need.
+    """
+
+    def before_stage(self, stage: str, ctx: InferenceContext) -> None:
+        pass
+
+    def after_stage(self, stage: str, ctx: InferenceContext) -> None:
+        pass
+
+
+class StageProfiler(StageHook):
+    """
+    Records the wall time and peak device memory of every stage in
+    ctx.stage_stats, and keeps per-stage totals across runs in totals. Peak
+    memory is None on devices without allocator statistics. On CUDA, time
+    includes only the work synchronized within the stage.
+    """
+
+    def __init__(self) -> None:
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def before_stage(self, stage: str, ctx: InferenceContext) -> None:
+        ctx.stage_stats[stage] = {"start": time.perf_counter(), "memory_start": reset_peak_memory(ctx.device)}
+
+    def after_stage(self, stage: str, ctx: InferenceContext) -> None:
+        stats = ctx.stage_stats[stage]
+        stats["seconds"] = time.perf_counter() - stats.pop("start")
+        stats["peak_memory"] = peak_memory_since(ctx.device, stats.pop("memory_start"))
+        with self._lock:
+            total = self.totals.setdefault(stage, {"runs": 0, "seconds": 0.0})
+            total["runs"] += 1
+            total["seconds"] += stats["seconds"]
+
+
+# Hooks run by every pipeline, so an optimization or cache registered here
+# applies to all models at once
+pipeline_hooks: List[StageHook] = []
+
+
+class InferencePipeline:
+    """
+    Runs one request through the stages every task adapter shares:
+    preprocess, encode, decode and postprocess come from the backend;
+    annotate (sort by area, optional part-of hierarchy), render (draw the
+    marks) and encode_output (build the label map) are common to all
+    models. Hooks are called around every stage.
+
+    Calling the pipeline returns (rendered image, records, label map), the
+    return value of the task adapters.
+    """
+
+    def __init__(self, backend: InferenceBackend, hooks: Sequence[StageHook] = ()) -> None:
+        self.backend = backend
+        self.hooks = list(hooks)
+
+    def __call__(
+        self,
+        image: Image.Image,
+        text_size: int,
+        label_mode: str = '1',
+        alpha: float = 0.1,
+        anno_mode: List[str] = ['Mask'],
+        hierarchy: bool = False,
+        **inputs,
+    ) -> Tuple[np.ndarray, AnnotationSet, np.ndarray]:
+        ctx = self.run(image, text_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, hierarchy=hierarchy, **inputs)
+        return ctx.rendered, ctx.annotations, ctx.label_map
+
+    def run(self, image: Image.Image, text_size: int, **inputs) -> InferenceContext:
+        """
+        Runs all stages and returns the context, including stage_stats.
+        """
+        ctx = InferenceContext(image, text_size, self.backend.device, inputs)
+        with ctx.resources:
+            for stage in STAGES:
+                owner = self.backend if stage in BACKEND_STAGES else self
+                self._run_stage(stage, [ctx], lambda: getattr(owner, stage)(ctx))
+        return ctx
+
+    def batch(
+        self,
+        images: Sequence[Image.Image],
+        text_size: int,
+        batch_size: int = 4,
+        label_mode: str = '1',
+        alpha: float = 0.1,
+        anno_mode: List[str] = ['Mask'],
+        hierarchy: bool = False,
+        **inputs,
+    ) -> List[Tuple[np.ndarray, AnnotationSet, np.ndarray]]:
+        """
+        Like calling the pipeline on every image, but decodes up to
+        batch_size images of the same batch_key per model call. Returns the
+        results in input order.
+        """
+        results = []
+        for ctx in self.run_batch(images, text_size, batch_size, label_mode=label_mode, alpha=alpha, anno_mode=anno_mode, hierarchy=hierarchy, **inputs):
+            results.append((ctx.rendered, ctx.annotations, ctx.label_map))
+        return results
+
+    def run_batch(self, images: Sequence[Image.Image], text_size: int, batch_size: int = 4, **inputs) -> List[InferenceContext]:
+        """
+        Runs all stages for several images and returns their contexts in
+        input order. Images are grouped by the batch_key of their resized
+        size, and every batch runs through the stages before the next one
+        is preprocessed, so only batch_size images are in memory at once.
+        The decode time of a batch is recorded for each of its images.
+        """
+        groups: Dict[Hashable, List[int]] = {}
+        for i, image in enumerate(images):
+            # the size preprocess_image will resize to, which drafting can
+            # change by a pixel
+            with contextlib.ExitStack() as stack:
+                drafted = open_draft(image, int(text_size))
+                if drafted is not image:
+                    stack.callback(drafted.close)
+                key = self.backend.batch_key(resized_size(drafted.size, int(text_size)))
+            groups.setdefault(key, []).append(i)
+
+        contexts: List[Optional[InferenceContext]] = [None] * len(images)
+        for group in groups.values():
+            for start in range(0, len(group), batch_size):
+                ctxs = [InferenceContext(images[i], text_size, self.backend.device, inputs) for i in group[start:start + batch_size]]
+                with contextlib.ExitStack() as stack:
+                    for ctx in ctxs:
+                        stack.enter_context(ctx.resources)
+                    for stage in STAGES:
+                        if stage == "decode":
+                            self._run_stage(stage, ctxs, lambda: self.backend.decode_batch(ctxs))
+                            continue
+                        owner = self.backend if stage in BACKEND_STAGES else self
+                        for ctx in ctxs:
+                            self._run_stage(stage, [ctx], lambda: getattr(owner, stage)(ctx))
+                for i, ctx in zip(group[start:start + batch_size], ctxs):
+                    contexts[i] = ctx
+        return contexts
+
+    def _run_stage(self, stage: str, ctxs: List[InferenceContext], fn: Callable[[], None]) -> None:
+        hooks = pipeline_hooks + self.hooks
+        for ctx in ctxs:
+            for hook in hooks:
+                hook.before_stage(stage, ctx)
+        fn()
+        for ctx in ctxs:
+            for hook in hooks:
+                hook.after_stage(stage, ctx)
+
+    def annotate(self, ctx: InferenceContext) -> None:
+        if not isinstance(ctx.annotations, AnnotationSet):
+            ctx.annotations = AnnotationSet.from_records(ctx.annotations)
+        ctx.annotations = ctx.annotations.sort_by('area')
+        if ctx.inputs.get('hierarchy'):
+            # number parts under their objects, e.g. '3.2'
+            annotate_hierarchy(ctx.annotations)
+
+    def render(self, ctx: InferenceContext) -> None:
+        label_mode = ctx.inputs.get('label_mode', '1')
+        hierarchical = ctx.inputs.get('hierarchy') and label_mode == '1'
+        visual = Visualizer(ctx.image_ori, metadata=metadata)
+        demo = visual.output
+        for label, ann in enumerate(ctx.annotations, start=1):
+            text = ann['hierarchical_label'] if hierarchical else str(label)
+            demo = visual.draw_binary_mask_with_number(
+                segmentation_mask(ann['segmentation']),
+                text=text,
+                label_mode=label_mode,
+                alpha=ctx.inputs.get('alpha', 0.1),
+                anno_mode=ctx.inputs.get('anno_mode', ['Mask']),
+            )
+        ctx.rendered = demo.get_image()
+
+    def encode_output(self, ctx: InferenceContext) -> None:
+        ctx.label_map = segmentations_to_label_map(ctx.annotations.segmentations, ctx.image_ori.shape[:2])
+
+
+def binary_masks_to_annotations(masks: torch.Tensor) -> AnnotationSet:
+    """
+    Builds the records of NxHxW binary masks that have no quality scores,
+    e.g. panoptic segments or interactive masks: predicted_iou and
+    stability_score are 1 and point_coords are 0.
+    """
+    h, w = masks.shape[-2:]
+    rles, boxes, areas = encode_transposed_masks(masks.transpose(1, 2).contiguous())
+    n = len(rles)
+    boxes[:, 2:] -= boxes[:, :2]
+    return AnnotationSet(
+        segmentations=list(masks.cpu().numpy()),
+        areas=areas,
+        boxes=boxes,
+        predicted_ious=np.ones(n, dtype=np.float32),
+        point_coords=np.zeros((n, 2), dtype=np.float32),
+        stability_scores=np.ones(n, dtype=np.float32),
+        crop_boxes=np.tile(np.array([[0, 0, w, h]], dtype=np.int64), (n, 1)),
+    )
+
+
+def panoptic_to_annotations(pano_ids: torch.Tensor, segment_ids: List[int]) -> AnnotationSet:
+    """
+    Builds the records of the segments of an HxW panoptic id map in one pass
+    over the map with encode_panoptic, instead of comparing the map with
+    every id and stacking the masks. The segmentations are the uncompressed
+    RLEs, so no dense mask is built per segment; rendering decodes them one
+    at a time. point_coords are anchor points inside the segments.
+    """
+    h, w = pano_ids.shape[-2:]
+    rles, boxes, areas, anchors = encode_panoptic(pano_ids.transpose(0, 1).contiguous(), segment_ids)
+    n = len(segment_ids)
+    boxes[:, 2:] -= boxes[:, :2]
+    return AnnotationSet(
+        segmentations=rles,
+        areas=areas,
+        boxes=boxes,
+        predicted_ious=np.ones(n, dtype=np.float32),
+        point_coords=anchors.astype(np.float32).reshape(n, 2),
+        stability_scores=np.ones(n, dtype=np.float32),
+        crop_boxes=np.tile(np.array([[0, 0, w, h]], dtype=np.int64), (n, 1)),
+    )
@@ -0,0 +1,126 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Generator settings per model, ordered from cheapest to most thorough.
+# 'balanced' is what the adapters used before presets existed. max_levels
+# caps how many of the requested Semantic-SAM levels are predicted.
+PRESETS = {
+    "semantic-sam": {
+        "fast": dict(
+            points_per_side=16,
+            pred_iou_thresh=0.88,
+            stability_score_thresh=0.92,
+            min_mask_region_area=0,
+            mask_nms_thresh=0.9,
+            max_levels=2,
+        ),
+        "balanced": dict(
+            points_per_side=32,
+            pred_iou_thresh=0.88,
+            stability_score_thresh=0.92,
+            min_mask_region_area=10,
+            mask_nms_thresh=0.9,
+            max_levels=None,
+        ),
+        "thorough": dict(
+            points_per_side=48,
+            pred_iou_thresh=0.86,
+            stability_score_thresh=0.9,
+            min_mask_region_area=10,
+            mask_nms_thresh=0.9,
+            max_levels=None,
+        ),
+    },
+    "sam": {
+        "fast": dict(points_per_side=16, pred_iou_thresh=0.88, stability_score_thresh=0.95, min_mask_region_area=0),
+        "balanced": dict(points_per_side=32, pred_iou_thresh=0.88, stability_score_thresh=0.95, min_mask_region_area=0),
+        "thorough": dict(points_per_side=48, pred_iou_thresh=0.86, stability_score_thresh=0.92, min_mask_region_area=100),
+    },
+}
+
+
+class LatencyTracker:
+    """
+    Learns how long mask generation takes on this host, per model, from the
+    runs the adapters time. The cost of a run is modelled as proportional to
+    its number of point prompts (points_per_side**2 * levels) times its
+    number of image pixels, since the masks of every prompt are decoded and
+    postprocessed at image resolution; the rate is an exponential moving
+    average, so it follows changes in load. Since the rate also absorbs the
+    fixed image-encoder cost, estimates for larger presets or images err on
+    the slow side.
+    """
+
+    def __init__(self, momentum: float = 0.7) -> None:
+        self.momentum = momentum
+        self._seconds_per_prompt_pixel: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, num_prompts: int, num_pixels: int, seconds: float) -> None:
+        rate = seconds / max(num_prompts * num_pixels, 1)
+        with self._lock:
+            prev = self._seconds_per_prompt_pixel.get(model_name)
+            self._seconds_per_prompt_pixel[model_name] = (
+                rate if prev is None else self.momentum * prev + (1 - self.momentum) * rate
+            )
+
+    def estimate(self, model_name: str, num_prompts: int, num_pixels: int) -> Optional[float]:
+        with self._lock:
+            rate = self._seconds_per_prompt_pixel.get(model_name)
+        return None if rate is None else rate * num_prompts * num_pixels
+
+
+latency_tracker = LatencyTracker()
+
+
+def num_prompts(params: Dict[str, Any], level: Optional[List[int]] = None) -> int:
+    return params["points_per_side"] ** 2 * (len(level) if level else 1)
+
+
+def resolve_preset(
+    model_name: str,
+    preset: str = "balanced",
+    latency_budget: Optional[float] = None,
+    level: Optional[List[int]] = None,
+    num_pixels: Optional[int] = None,
+) -> Tuple[str, Dict[str, Any], Optional[List[int]]]:
+    """
+    Returns the preset name, the generator settings and the levels to use.
+
+    preset is one of the names in PRESETS or 'auto'. With 'auto', the most
+    thorough preset whose estimated latency on an image of num_pixels pixels
+    fits latency_budget (seconds) is picked, based on timings recorded in
+    latency_tracker; 'balanced' is used until the model has been timed
+    once, and 'fast' if nothing fits.
+    """
+    presets = PRESETS[model_name]
+    if preset == "auto":
+        if latency_budget is None or num_pixels is None:
+            raise ValueError("preset='auto' requires a latency_budget and the image size.")
+        preset = "balanced"
+        for name in reversed(list(presets)):
+            params, name_level = _apply(presets[name], level)
+            estimate = latency_tracker.estimate(model_name, num_prompts(params, name_level), num_pixels)
+            if estimate is None:
+                break
+            preset = name
+            if estimate <= latency_budget:
+                break
+    if preset not in presets:
+        raise ValueError(f"Unknown preset {preset}; expected one of {list(presets)} or 'auto'.")
+    params, level = _apply(presets[preset], level)
+    return preset, params, level
+
+
+def _apply(preset: Dict[str, Any], level: Optional[List[int]]):
+    params = dict(preset)
+    max_levels = params.pop("max_levels", None)
+    if level is not None and max_levels is not None:
+        level = level[:max_levels]
+    return params, level
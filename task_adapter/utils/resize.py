@@ -0,0 +1,84 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import os
+from typing import Optional, Union
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from task_adapter.utils.image_buffers import resized_size
+
+# pil: PIL bicubic, identical to transforms.Resize(..., interpolation=BICUBIC)
+# pil-reduce: PIL bicubic after an integer box reduction of large downscales
+# cv2-area, cv2-cubic: OpenCV INTER_AREA / INTER_CUBIC
+# torch: antialiased bicubic F.interpolate
+RESIZE_BACKENDS = ("pil", "pil-reduce", "cv2-area", "cv2-cubic", "torch")
+
+# the scale factor PIL keeps for the bicubic pass after reducing
+_REDUCING_GAP = 2.0
+
+
+def get_resize_backend(backend: Optional[str] = None) -> str:
+    """
+    Resolves the resize backend of the preprocessing stage: the explicit
+    backend, else the SOM_RESIZE_BACKEND environment variable, else 'pil',
+    which reproduces the resize the task adapters always used.
+    """
+    if backend is None:
+        backend = os.environ.get("SOM_RESIZE_BACKEND", "pil")
+    if backend not in RESIZE_BACKENDS:
+        raise ValueError(f"Unknown resize backend {backend!r}, expected one of {RESIZE_BACKENDS}.")
+    return backend
+
+
+def resize_into(
+    image: Image.Image,
+    out: np.ndarray,
+    backend: str = "pil",
+    device: Optional[Union[str, torch.device]] = None,
+) -> np.ndarray:
+    """
+    Resizes an RGB PIL image to the size of out, an HxWx3 uint8 array, and
+    writes the result into it. The OpenCV backends write into out directly.
+
+    Arguments:
+      image (PIL.Image): The image to resize.
+      out (np.ndarray): The output, typically a pooled ImageBuffer array.
+      backend (str): One of RESIZE_BACKENDS.
+      device (str or torch.device or None): Where the 'torch' backend
+        interpolates, the CPU if None.
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    height, width = out.shape[:2]
+    if image.size == (width, height):
+        np.copyto(out, np.asarray(image))
+    elif backend in ("pil", "pil-reduce"):
+        gap = _REDUCING_GAP if backend == "pil-reduce" else None
+        np.copyto(out, np.asarray(image.resize((width, height), Image.BICUBIC, reducing_gap=gap)))
+    elif backend in ("cv2-area", "cv2-cubic"):
+        interpolation = cv2.INTER_AREA if backend == "cv2-area" else cv2.INTER_CUBIC
+        cv2.resize(np.asarray(image), (width, height), dst=out, interpolation=interpolation)
+    elif backend == "torch":
+        x = torch.from_numpy(np.array(image)).to(device).permute(2, 0, 1)[None].float()
+        x = F.interpolate(x, size=(height, width), mode="bicubic", align_corners=False, antialias=True)
+        out[...] = x[0].round_().clamp_(0, 255).to(torch.uint8).permute(1, 2, 0).cpu().numpy()
+    else:
+        raise ValueError(f"Unknown resize backend {backend!r}, expected one of {RESIZE_BACKENDS}.")
+    return out
+
+
+def resize_image(image: Image.Image, short_side: int, backend: Optional[str] = None) -> np.ndarray:
+    """
+    Resizes an image so its short side is short_side, like
+    transforms.Resize(short_side), and returns it as an HxWx3 uint8 array.
+    """
+    height, width = resized_size(image.size, int(short_side))
+    return resize_into(image, np.empty((height, width, 3), dtype=np.uint8), get_resize_backend(backend))
@@ -0,0 +1,133 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+
+def stroke_labels(strokes: Union[np.ndarray, torch.Tensor]) -> Tuple[np.ndarray, int]:
+    """
+    Returns the HxW int32 label array of user strokes, 0 for background and
+    i for the i-th stroke, and the number of strokes. strokes is either
+    such a label array, e.g. from scipy.ndimage.label, or NxHxW binary
+    stroke masks, where later masks win on overlaps.
+    """
+    if isinstance(strokes, torch.Tensor):
+        strokes = strokes.cpu().numpy()
+    strokes = np.asarray(strokes)
+    if strokes.ndim == 2:
+        labels = strokes.astype(np.int32, copy=False)
+        return labels, int(labels.max(initial=0))
+    labels = np.zeros(strokes.shape[1:], dtype=np.int32)
+    for i, mask in enumerate(strokes):
+        labels[mask.astype(bool, copy=False)] = i + 1
+    return labels, len(strokes)
+
+
+def _segment_extents(ids: np.ndarray, values: np.ndarray, num_segments: int) -> Tuple[np.ndarray, np.ndarray]:
+    # per-id minimum and maximum of values, ids in 0..num_segments-1
+    lo = np.full(num_segments, np.iinfo(np.int64).max)
+    hi = np.full(num_segments, -1)
+    np.minimum.at(lo, ids, values)
+    np.maximum.at(hi, ids, values)
+    return lo, hi
+
+
+class StrokePrompts:
+    """
+    The prompts of N user strokes for an image resized to out_size, built
+    from their label array in one pass over the stroke pixels, instead of
+    one full-resolution mask per stroke. Every stroke keeps its own resized
+    mask: the resized pixels any of its pixels falls in, so thin strokes
+    survive downsampling like with the bicubic interpolation of masks, and
+    the ones whose nearest input pixel is its own, which covers upsampling.
+    Strokes closer than a resized pixel therefore share pixels rather than
+    losing them to each other.
+
+      points: N x num_points x 2 float32 (x, y) resized pixels sampled
+        uniformly from every stroke's pixels, with replacement; all lie in
+        the stroke's mask.
+      boxes: N x 4 float32 XYXY extents of every stroke mask, last pixels
+        included.
+
+    masks() builds the N stroke masks on a device.
+
+    Arguments:
+      labels (np.ndarray): HxW stroke labels, see stroke_labels.
+      num_strokes (int): The number of strokes, the largest label.
+      out_size (tuple(int, int)): The (height, width) of the resized image.
+      num_points (int): The number of points sampled per stroke.
+      rng (np.random.Generator or None): The random generator for sampling;
+        NumPy's global one if None.
+    """
+
+    def __init__(
+        self,
+        labels: np.ndarray,
+        num_strokes: int,
+        out_size: Tuple[int, int],
+        num_points: int = 40,
+        rng: Optional[np.random.Generator] = None,
+    ) -> None:
+        height, width = labels.shape
+        out_h, out_w = out_size
+        self.num_strokes = num_strokes
+        self.out_size = (out_h, out_w)
+
+        # stroke pixels grouped by stroke, as flat indices
+        flat = labels.reshape(-1)
+        pixels = np.flatnonzero(flat)
+        ids = flat[pixels]
+        keep = ids <= num_strokes
+        pixels, ids = pixels[keep], ids[keep]
+        order = np.argsort(ids, kind="stable")
+        pixels, ids = pixels[order], ids[order].astype(np.int64) - 1
+        counts = np.bincount(ids, minlength=num_strokes)[:num_strokes]
+        if (counts == 0).any():
+            raise ValueError(f"Strokes {(np.flatnonzero(counts == 0) + 1).tolist()} have no pixels.")
+        starts = np.cumsum(counts) - counts
+
+        # the resized pixel every stroke pixel falls in
+        ys, xs = np.divmod(pixels, width)
+        out_ys = ys * out_h // height
+        out_xs = xs * out_w // width
+
+        uniform = rng.random((num_strokes, num_points)) if rng is not None else np.random.random((num_strokes, num_points))
+        samples = starts[:, None] + (uniform * counts[:, None]).astype(np.int64)
+        self.points = np.stack([out_xs[samples], out_ys[samples]], axis=-1).astype(np.float32)
+
+        # nearest sampling: resized pixel i takes input pixel
+        # floor((i + 0.5) * size / out_size), in integers
+        rows = (2 * np.arange(out_h) + 1) * height // (2 * out_h)
+        cols = (2 * np.arange(out_w) + 1) * width // (2 * out_w)
+        nearest = labels[rows[:, None], cols[None, :]].reshape(-1)
+        nearest_pixels = np.flatnonzero(nearest)
+        nearest_ids = nearest[nearest_pixels].astype(np.int64) - 1
+        keep = nearest_ids < num_strokes
+        nearest_pixels, nearest_ids = nearest_pixels[keep], nearest_ids[keep]
+        nearest_ys, nearest_xs = np.divmod(nearest_pixels, out_w)
+
+        # every (stroke, resized pixel) pair of the masks, as flat indices
+        # into N x out_h x out_w
+        mask_ids = np.concatenate([ids, nearest_ids])
+        mask_ys = np.concatenate([out_ys, nearest_ys])
+        mask_xs = np.concatenate([out_xs, nearest_xs])
+        self._mask_indices = (mask_ids * out_h + mask_ys) * out_w + mask_xs
+
+        x0, x1 = _segment_extents(mask_ids, mask_xs, num_strokes)
+        y0, y1 = _segment_extents(mask_ids, mask_ys, num_strokes)
+        self.boxes = np.stack([x0, y0, x1, y1], axis=-1).astype(np.float32)
+
+    def masks(self, device: Union[str, torch.device] = "cpu") -> torch.Tensor:
+        """
+        Returns the N x out_h x out_w boolean stroke masks, built on device.
+        """
+        out_h, out_w = self.out_size
+        masks = torch.zeros(self.num_strokes * out_h * out_w, dtype=torch.bool, device=device)
+        masks[torch.from_numpy(self._mask_indices).to(masks.device)] = True
+        return masks.view(self.num_strokes, out_h, out_w)
@@ -0,0 +1,215 @@
+# --------------------------------------------------------
+# Set-of-Mark (SoM) Prompting for Visual Grounding in GPT-4V
+# Copyright (c) 2023 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+import torch
+from detectron2.data.catalog import Metadata
+
+
+def _lang_encoder(model):
+    return model.model.sem_seg_head.predictor.lang_encoder
+
+
+def model_fingerprint(module: torch.nn.Module) -> str:
+    """
+    Returns a hash identifying the weights of a module: the name, shape and
+    dtype of every tensor in its state dict, with its first values and its
+    sum. Cheaper than hashing all weights, and still different for every
+    checkpoint in practice.
+    """
+    digest = hashlib.sha256()
+    for name, tensor in module.state_dict().items():
+        flat = tensor.detach().reshape(-1)
+        digest.update(f"{name}{tuple(tensor.shape)}{tensor.dtype}".encode())
+        digest.update(flat[:256].cpu().numpy().tobytes())
+        if flat.is_floating_point():
+            digest.update(repr(float(flat.double().sum())).encode())
+    return digest.hexdigest()
+
+
+class TextEmbeddingStore:
+    """
+    Caches the class-name embeddings of SEEM's language encoder, keyed by
+    (model fingerprint, class list), so switching vocabularies, e.g. COCO,
+    ADE20K or a custom one, is a lookup instead of a text encoder pass.
+
+    The most recently used max_entries vocabularies are kept on the device,
+    and every vocabulary is also saved to cache_dir, so a restarted process
+    loads it instead of encoding it again. cache_dir defaults to the
+    SOM_CACHE_DIR environment variable, else ~/.cache/som; None disables
+    the disk cache.
+
+    The active vocabulary is state of the model shared by every request, so
+    code that changes it or runs the model with it holds lock(model), e.g.
+    through vocabulary().
+    """
+
+    def __init__(self, cache_dir: Optional[str] = "", max_entries: int = 8) -> None:
+        if cache_dir == "":
+            cache_dir = os.environ.get("SOM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "som"))
+        self.cache_dir = None if cache_dir is None else os.path.join(cache_dir, "text_embeddings")
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        # id(lang encoder) -> (lang encoder, fingerprint); keeps the encoder
+        # alive as long as its id is used
+        self._fingerprints: Dict[int, Tuple[torch.nn.Module, str]] = {}
+        # id(lang encoder) -> (lang encoder, lock); never cleared, so a held
+        # lock stays the model's lock
+        self._model_locks: Dict[int, Tuple[torch.nn.Module, threading.RLock]] = {}
+        self._lock = threading.RLock()
+
+    def embeddings(self, model, class_names: Sequence[str], fingerprint: Optional[str] = None) -> torch.Tensor:
+        """
+        Returns the text embeddings of class_names for a SEEM model, from
+        memory, from disk, or encoded and then cached in both.
+
+        Arguments:
+          model: The SEEM BaseModel.
+          class_names (list(str)): The vocabulary, including 'background' if
+            the model expects it.
+          fingerprint (str or None): Identifies the model weights, e.g. a hash
+            of the checkpoint. Computed with model_fingerprint if None.
+        """
+        lang_encoder = _lang_encoder(model)
+        key = self._key(lang_encoder, class_names, fingerprint)
+        with self._lock:
+            emb = self._entries.get(key)
+            if emb is not None:
+                self._entries.move_to_end(key)
+                return emb
+            device = next(lang_encoder.parameters()).device
+            emb = self._load(key, device)
+            if emb is None:
+                previous = getattr(lang_encoder, "default_text_embeddings", None)
+                with torch.no_grad():
+                    lang_encoder.get_text_embeddings(list(class_names), is_eval=True)
+                emb = lang_encoder.default_text_embeddings
+                if previous is not None:
+                    lang_encoder.default_text_embeddings = previous
+                self._save(key, emb)
+            self._entries[key] = emb
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return emb
+
+    def activate(self, model, class_names: Sequence[str], fingerprint: Optional[str] = None) -> None:
+        """
+        Makes class_names the vocabulary a SEEM model classifies with.
+        """
+        _lang_encoder(model).default_text_embeddings = self.embeddings(model, class_names, fingerprint)
+
+    def active(self, model) -> torch.Tensor:
+        """
+        Returns the text embeddings of the vocabulary active on a SEEM
+        model. Hold lock(model) to read them together with the matching
+        class names.
+        """
+        return _lang_encoder(model).default_text_embeddings
+
+    def logit_scale(self, model) -> float:
+        """
+        Returns the scale a SEEM model multiplies the cosine similarity of
+        visual and text embeddings by.
+        """
+        logit_scale = getattr(_lang_encoder(model), "logit_scale", None)
+        return 1.0 if logit_scale is None else float(logit_scale.exp())
+
+    def lock(self, model) -> threading.RLock:
+        """
+        Returns the lock guarding the active vocabulary and metadata of a
+        SEEM model.
+        """
+        lang_encoder = _lang_encoder(model)
+        with self._lock:
+            entry = self._model_locks.get(id(lang_encoder))
+            if entry is None:
+                entry = self._model_locks[id(lang_encoder)] = (lang_encoder, threading.RLock())
+            return entry[1]
+
+    @contextlib.contextmanager
+    def vocabulary(self, model, class_names: Sequence[str], metadata: Any = None, fingerprint: Optional[str] = None) -> Iterator[None]:
+        """
+        Makes class_names, and metadata if given, the vocabulary of a SEEM
+        model for the body of a with statement, holding lock(model), and
+        restores the previous ones afterwards. Run the model inside it.
+        """
+        lang_encoder = _lang_encoder(model)
+        with self.lock(model):
+            previous = getattr(lang_encoder, "default_text_embeddings", None)
+            previous_metadata = getattr(model.model, "metadata", None)
+            try:
+                self.activate(model, class_names, fingerprint)
+                if metadata is not None:
+                    model.model.metadata = metadata
+                yield
+            finally:
+                if previous is not None:
+                    lang_encoder.default_text_embeddings = previous
+                model.model.metadata = previous_metadata
+
+    def clear(self) -> None:
+        """
+        Drops the in-memory entries; the disk cache is kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._fingerprints.clear()
+
+    def _key(self, lang_encoder: torch.nn.Module, class_names: Sequence[str], fingerprint: Optional[str]) -> str:
+        if fingerprint is None:
+            with self._lock:
+                cached = self._fingerprints.get(id(lang_encoder))
+                if cached is None:
+                    cached = self._fingerprints[id(lang_encoder)] = (lang_encoder, model_fingerprint(lang_encoder))
+            fingerprint = cached[1]
+        return hashlib.sha256(json.dumps([fingerprint, list(class_names)]).encode()).hexdigest()
+
+    def _path(self, key: str) -> Optional[str]:
+        return None if self.cache_dir is None else os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _load(self, key: str, device: torch.device) -> Optional[torch.Tensor]:
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        return torch.load(path, map_location=device)
+
+    def _save(self, key: str, emb: torch.Tensor) -> None:
+        path = self._path(key)
+        if path is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write then rename, so concurrent processes never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(emb.detach().cpu(), tmp_path)
+        os.replace(tmp_path, path)
+
+
+def vocabulary_metadata(class_names: Sequence[str]) -> Metadata:
+    """
+    Returns panoptic metadata for a custom vocabulary, with every class but
+    a trailing 'background' as a thing class, so SEEM returns one segment
+    per instance.
+    """
+    names = list(class_names)
+    if names and names[-1] == "background":
+        names = names[:-1]
+    return Metadata(
+        name="som_vocabulary",
+        thing_classes=names,
+        stuff_classes=names,
+        thing_dataset_id_to_contiguous_id={i: i for i in range(len(names))},
+        stuff_dataset_id_to_contiguous_id={i: i for i in range(len(names))},
+    )
+
+
+text_embeddings = TextEmbeddingStore()